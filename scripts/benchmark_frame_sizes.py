@@ -0,0 +1,106 @@
+# Benchmark of the CPU cost of each frame size.
+#
+# For each frame duration that AudioFormat supports, one room's tick
+# is simulated: every participant's packet is decoded into the mixer,
+# the mixes are computed (with the mixer's dynamics stage), and each
+# participant's mix-minus is encoded, as Room.process_audio_frame()
+# does when everyone is singing.  The cost of a tick is reported, along
+# with the fraction of one core that the room needs to keep up, which
+# is the cost of a tick divided by the frame's duration.
+#
+# Shorter frames halve the latency of capture and playback, but as
+# Opus and the mixer have a fixed cost per call, the CPU needed grows.
+# Choose the smallest frame for which the fraction of a core, across
+# the rooms that a host will run, leaves comfortable headroom.
+#
+# Usage: python benchmark_frame_sizes.py [participant counts...]
+
+import math
+import sys
+import timeit
+
+import numpy
+
+from singtserver.audio_format import AudioFormat
+from singtserver.mixer import Mixer
+from singtserver.opus_codec import FloatOpusDecoder
+from singtserver.opus_codec import FloatOpusEncoder
+
+samples_per_second = 48000
+repeats = 5
+
+
+def make_packet(audio_format):
+    # A 440 Hz tone with a little noise, so the packet isn't DTX
+    samples_per_frame = audio_format.samples_per_frame
+    t = numpy.arange(samples_per_frame) / audio_format.samples_per_second
+    pcm = 0.5 * numpy.sin(2 * math.pi * 440 * t)
+    pcm += 0.01 * numpy.random.standard_normal(samples_per_frame)
+    encoder = make_encoder(audio_format)
+    return encoder.encode(pcm.astype(numpy.float32))
+
+
+def make_encoder(audio_format):
+    # Configured as UDPServer.create_encoder() does
+    encoder = FloatOpusEncoder(
+        audio_format.samples_per_second,
+        audio_format.channels,
+        audio_format.samples_per_frame,
+        application="audio"
+    )
+    encoder.set_inband_fec(True)
+    encoder.set_dtx(True)
+    return encoder
+
+
+def make_tick(audio_format, participants):
+    packet = make_packet(audio_format)
+    mixer = Mixer(audio_format.samples_per_frame)
+    slots = [mixer.add_source() for _ in range(participants)]
+    decoders = [
+        FloatOpusDecoder(
+            audio_format.samples_per_second,
+            audio_format.channels,
+            audio_format.samples_per_frame
+        )
+        for _ in range(participants)
+    ]
+    encoders = [make_encoder(audio_format) for _ in range(participants)]
+
+    def tick():
+        for slot, decoder in zip(slots, decoders):
+            numpy.copyto(mixer.get_frame(slot), decoder.decode(packet))
+        combined, mix_minus = mixer.mix()
+        for slot, encoder in zip(slots, encoders):
+            encoder.encode(mix_minus[slot])
+
+    return tick
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        participant_counts = [int(arg) for arg in sys.argv[1:]]
+    else:
+        participant_counts = [8, 16, 32, 50]
+
+    print(f"{'frame':>6} {'participants':>13} {'per tick':>10} "+
+          f"{'per second':>11} {'of a core':>10}")
+    for frame_duration_ms in AudioFormat.frame_durations_ms:
+        audio_format = AudioFormat(
+            samples_per_second=samples_per_second,
+            frame_duration_ms=frame_duration_ms
+        )
+        # Simulate about a second of audio per repeat
+        number = 1000 // frame_duration_ms
+
+        for participants in participant_counts:
+            tick = make_tick(audio_format, participants)
+            tick() # Warm up
+            durations = timeit.repeat(tick, number=number, repeat=repeats)
+            per_tick = min(durations) / number
+            per_second = per_tick * 1000 / frame_duration_ms
+            print(
+                f"{frame_duration_ms:>4}ms {participants:>13} "+
+                f"{per_tick*1000:>8.2f}ms {per_second*1000:>9.1f}ms "+
+                f"{per_second*100:>9.1f}%"
+            )
@@ -0,0 +1,192 @@
+# Benchmark of how many participants one host can mix as the number
+# of media worker processes grows.
+#
+# For each worker count, rooms of simulated participants are added
+# one at a time.  Each participant sends a 20 ms Opus packet every
+# frame from its own UDP socket, as a client would.  After each room
+# is added, the workers' audio clocks are sampled; once more than 1%
+# of frames are missed, or the mean processing time of any room
+# exceeds half a frame, the host is taken to be full.  The last
+# participant count that passed is reported.
+#
+# The simulated clients run in this process, so on small hosts they
+# compete with the workers for CPU; the figures are therefore a lower
+# bound.
+#
+# Usage: python benchmark_media_workers.py [worker counts...]
+
+import math
+import os
+import struct
+import sys
+import time
+
+import numpy
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet.protocol import DatagramProtocol
+
+from singtserver.media_workers import MediaWorkerPool
+from singtserver.opus_codec import FloatOpusEncoder
+
+samples_per_second = 48000
+samples_per_frame = samples_per_second // 1000 * 20
+frame_duration = 0.02
+room_size = 8
+max_participants = 400
+settle_seconds = 2
+measure_seconds = 5
+base_port = 23456
+
+
+def make_packet():
+    # A 440 Hz tone with a little noise, so the packet isn't DTX
+    t = numpy.arange(samples_per_frame) / samples_per_second
+    pcm = 0.5 * numpy.sin(2 * math.pi * 440 * t)
+    pcm += 0.01 * numpy.random.standard_normal(samples_per_frame)
+    encoder = FloatOpusEncoder(samples_per_second, 1, samples_per_frame)
+    return encoder.encode(pcm.astype(numpy.float32))
+
+
+def make_datagram(seq_no, payload):
+    # The server's UDP layout: a 4-byte timestamp, a 2-byte sequence
+    # number (-1 for an announcement), then the payload
+    timestamp = int(time.monotonic() * 1000) % 2**32
+    seq_no = (seq_no + 2**15) % 2**16 - 2**15
+    return struct.pack(">Ih", timestamp, seq_no) + payload
+
+
+class SimulatedClient(DatagramProtocol):
+    def __init__(self, client_id, server_port, packet):
+        self._client_id = client_id
+        self._addr = ("127.0.0.1", server_port)
+        self._packet = packet
+        self._seq_no = 0
+
+    def startProtocol(self):
+        announcement = struct.pack(">Q", self._client_id)
+        self.transport.write(make_datagram(-1, announcement), self._addr)
+
+    def send_frame(self):
+        self.transport.write(
+            make_datagram(self._seq_no, self._packet),
+            self._addr
+        )
+        self._seq_no += 1
+
+    def datagramReceived(self, data, addr):
+        # We don't listen to the mix
+        pass
+
+
+class NullParticipants:
+    def join_udp(self, client_id):
+        return False
+
+    def leave(self, client_id):
+        pass
+
+
+def summarise(statistics):
+    """Totals the frames and missed frames, and finds the worst room's
+    mean processing time."""
+    frames = 0
+    missed = 0
+    worst_processing = 0
+    for worker in statistics["workers"]:
+        for room in worker["rooms"].values():
+            frames += room["frames"]
+            missed += room["missed_frames"]
+            worst_processing = max(
+                worst_processing,
+                room["mean_processing_ms"]
+            )
+    return frames, missed, worst_processing
+
+
+@defer.inlineCallbacks
+def measure(workers, packet):
+    """Returns the most participants that the workers could mix."""
+    pool = MediaWorkerPool(
+        {"participants": NullParticipants()},
+        workers,
+        base_port
+    )
+    pool.start()
+    yield task.deferLater(reactor, 2, lambda: None)
+
+    clients = []
+    ports = []
+    sender = task.LoopingCall(
+        lambda: [client.send_frame() for client in clients]
+    )
+    sender.start(frame_duration)
+
+    capacity = 0
+    room_number = 0
+    while len(clients) < max_participants:
+        # Add another room of participants
+        room = f"room-{room_number}"
+        room_number += 1
+        for _ in range(room_size):
+            client_id = len(clients) + 1
+            server_port = pool.assign_room(client_id, room)
+            client = SimulatedClient(client_id, server_port, packet)
+            ports.append(reactor.listenUDP(0, client))
+            clients.append(client)
+
+        # Let the rooms settle, then measure
+        yield task.deferLater(reactor, settle_seconds, lambda: None)
+        before = summarise((yield pool.get_audio_statistics()))
+        yield task.deferLater(reactor, measure_seconds, lambda: None)
+        after = summarise((yield pool.get_audio_statistics()))
+
+        frames = after[0] - before[0]
+        missed = after[1] - before[1]
+        missed_ratio = missed / max(1, frames + missed)
+        worst_processing = after[2]
+        print(
+            f"  {workers} worker(s), {len(clients)} participants: "+
+            f"{missed_ratio:.2%} frames missed, worst room's mean "+
+            f"processing {worst_processing:.2f} ms"
+        )
+        if (missed_ratio > 0.01
+            or worst_processing > frame_duration * 1000 / 2):
+            break
+        capacity = len(clients)
+
+    sender.stop()
+    for port in ports:
+        yield port.stopListening()
+    yield pool.stop()
+
+    return capacity
+
+
+@defer.inlineCallbacks
+def main(reactor, *worker_counts):
+    if len(worker_counts) == 0:
+        cpus = os.cpu_count() or 1
+        worker_counts = sorted(set(
+            [2**n for n in range(int(math.log2(cpus)) + 1)] + [cpus]
+        ))
+    else:
+        worker_counts = [int(count) for count in worker_counts]
+
+    packet = make_packet()
+    print(f"Opus packet of {len(packet)} bytes; rooms of {room_size}")
+
+    results = []
+    for workers in worker_counts:
+        capacity = yield measure(workers, packet)
+        results.append((workers, capacity))
+
+    print()
+    print("workers  participants per host")
+    for workers, capacity in results:
+        print(f"{workers:7}  {capacity:21}")
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,85 @@
+# Micro-benchmark comparing the server's original int16 Opus path
+# with the float-native path of singtserver.opus_codec.
+#
+# Each iteration decodes one 20 ms mono packet, places it in a mixer
+# row, and encodes a frame back to Opus, which is the per-client work
+# done every tick by Room.process_audio_frame().
+
+import math
+import timeit
+
+import numpy
+from pyogg import OpusDecoder
+from pyogg import OpusEncoder
+
+from singtserver.opus_codec import FloatOpusDecoder
+from singtserver.opus_codec import FloatOpusEncoder
+
+samples_per_second = 48000
+channels = 1
+samples_per_frame = samples_per_second // 1000 * 20
+iterations = 5000
+
+
+def make_packet():
+    # A 440 Hz tone with a little noise, encoded with PyOgg
+    t = numpy.arange(samples_per_frame) / samples_per_second
+    pcm = 0.5 * numpy.sin(2 * math.pi * 440 * t)
+    pcm += 0.01 * numpy.random.standard_normal(samples_per_frame)
+    pcm_int16 = (pcm * (2**15-1)).astype(numpy.int16)
+
+    encoder = OpusEncoder()
+    encoder.set_application("audio")
+    encoder.set_sampling_frequency(samples_per_second)
+    encoder.set_channels(channels)
+    return bytes(encoder.encode(pcm_int16.tobytes()))
+
+
+def benchmark_original(packet):
+    decoder = OpusDecoder()
+    decoder.set_sampling_frequency(samples_per_second)
+    decoder.set_channels(channels)
+    encoder = OpusEncoder()
+    encoder.set_application("audio")
+    encoder.set_sampling_frequency(samples_per_second)
+    encoder.set_channels(channels)
+    row = numpy.zeros(samples_per_frame, dtype=numpy.float32)
+
+    def run():
+        pcm = decoder.decode(packet)
+        pcm_int16 = numpy.frombuffer(pcm, dtype=numpy.int16)
+        pcm_float = pcm_int16.astype(numpy.float32)
+        pcm_float /= 2**15
+        pcm_float = numpy.reshape(pcm_float, (len(pcm_float), 1))
+        row[:] = pcm_float[:, 0]
+
+        pcm_int16 = row * (2**15-1)
+        pcm_int16 = pcm_int16.astype(numpy.int16)
+        encoder.encode(pcm_int16.tobytes())
+
+    return run
+
+
+def benchmark_float(packet):
+    decoder = FloatOpusDecoder(samples_per_second, channels, samples_per_frame)
+    encoder = FloatOpusEncoder(samples_per_second, channels, samples_per_frame)
+    row = numpy.zeros(samples_per_frame, dtype=numpy.float32)
+
+    def run():
+        pcm = decoder.decode(packet)
+        numpy.copyto(row, pcm)
+        encoder.encode(row)
+
+    return run
+
+
+if __name__ == "__main__":
+    packet = make_packet()
+
+    for name, make_run in [("original int16 path", benchmark_original),
+                           ("float-native path", benchmark_float)]:
+        run = make_run(packet)
+        run() # Warm up
+        durations = timeit.repeat(run, number=iterations, repeat=5)
+        per_frame_us = min(durations) / iterations * 1e6
+        print(f"{name:>20}: {per_frame_us:7.1f} us per client per frame")
@@ -1,3 +1,35 @@
+import argparse
+
 from singtserver import start
+from singtserver.audio_format import AudioFormat
+
+parser = argparse.ArgumentParser(description="Singt server")
+parser.add_argument(
+    "--media-workers",
+    type=int,
+    default=0,
+    help="number of media worker processes to mix audio in (default: "+
+         "mix in the server process)"
+)
+parser.add_argument(
+    "--sample-rate",
+    type=int,
+    default=48000,
+    choices=AudioFormat.sample_rates,
+    help="sample rate of the participants' audio (default: 48000)"
+)
+parser.add_argument(
+    "--frame-duration",
+    type=int,
+    default=20,
+    choices=AudioFormat.frame_durations_ms,
+    help="duration, in milliseconds, of each frame of audio; shorter "+
+         "frames reduce latency but cost more CPU (default: 20)"
+)
+args = parser.parse_args()
 
-start()
+audio_format = AudioFormat(
+    samples_per_second=args.sample_rate,
+    frame_duration_ms=args.frame_duration
+)
+start(media_workers=args.media_workers, audio_format=audio_format)
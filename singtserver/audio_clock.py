@@ -0,0 +1,152 @@
+import time
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("audio_clock")
+
+
+class AudioClock:
+    """Calls a function once per frame, against a monotonic deadline.
+
+    Every frame has a deadline, a whole number of intervals after the
+    clock was started.  Each wake-up measures how late it is relative
+    to its deadline.  If the clock has fallen behind by one or more
+    whole frames, those frames are reported to on_missed_frames()
+    (which applies the overload policy) rather than being processed
+    back to back, and the deadline skips ahead so that clients never
+    receive a burst of packets.
+
+    If is_idle() returns True after a frame, the clock stops until
+    wake() is called.
+
+    The clock's load is the fraction of each interval spent in
+    on_frame(), smoothed over recent frames with the given smoothing
+    factor.
+
+    """
+    def __init__(self, reactor, interval, on_frame, on_missed_frames,
+                 is_idle=None, monotonic=time.monotonic, smoothing=0.05):
+        self._reactor = reactor
+        self._interval = interval
+        self._on_frame = on_frame
+        self._on_missed_frames = on_missed_frames
+        self._is_idle = is_idle
+        self._monotonic = monotonic
+
+        self._deadline = None
+        self._delayed_call = None
+
+        self._smoothing = smoothing
+        self._load = 0
+
+        self.reset_statistics()
+
+    @property
+    def running(self):
+        return self._delayed_call is not None
+
+    @property
+    def load(self):
+        """The smoothed fraction of each interval spent processing.
+
+        An idle clock has no load.
+
+        """
+        if not self.running:
+            return 0
+        return self._load
+
+    def wake(self):
+        """Starts the clock if it isn't already running."""
+        if self.running:
+            return
+        log.info("Starting audio clock")
+        self._deadline = self._monotonic()
+        self._delayed_call = self._reactor.callLater(0, self._tick)
+
+    def stop(self):
+        """Stops the clock."""
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+
+    def _tick(self):
+        now = self._monotonic()
+        lateness = now - self._deadline
+
+        # Check if we've fallen a whole frame (or more) behind
+        missed = int(lateness // self._interval)
+        if missed > 0:
+            log.warn(
+                f"Audio clock is {round(lateness*1000)} ms late; "+
+                f"missed {missed} frame(s)"
+            )
+            self._deadline += missed * self._interval
+            self._missed_frames += missed
+            try:
+                self._on_missed_frames(missed)
+            except Exception:
+                log.failure("Failed to process missed audio frames")
+            lateness -= missed * self._interval
+
+        # Process this frame
+        try:
+            self._on_frame()
+        except Exception:
+            log.failure("Failed to process audio frame")
+        duration = self._monotonic() - now
+
+        self._record(lateness, duration)
+
+        # Schedule the next frame, unless there's nothing to do
+        self._deadline += self._interval
+        if self._is_idle is not None and self._is_idle():
+            log.info("Audio clock going idle")
+            self._delayed_call = None
+            return
+        delay = max(0, self._deadline - self._monotonic())
+        self._delayed_call = self._reactor.callLater(delay, self._tick)
+
+    def _record(self, lateness, duration):
+        self._load += self._smoothing * (duration / self._interval - self._load)
+
+        self._frames += 1
+        self._total_lateness += lateness
+        self._max_lateness = max(self._max_lateness, lateness)
+        self._total_duration += duration
+        self._max_duration = max(self._max_duration, duration)
+
+        # Histogram of lateness, in bins of a millisecond
+        bin_ = min(max(0, int(lateness * 1000)),
+                   len(self._lateness_histogram) - 1)
+        self._lateness_histogram[bin_] += 1
+
+    def reset_statistics(self):
+        self._frames = 0
+        self._missed_frames = 0
+        self._total_lateness = 0
+        self._max_lateness = 0
+        self._total_duration = 0
+        self._max_duration = 0
+        self._lateness_histogram = [0] * (int(self._interval * 1000) + 1)
+
+    def get_statistics(self):
+        """Returns the clock's statistics, with times in milliseconds.
+
+        lateness_histogram counts the frames by how late their wake-up
+        was, in bins of one millisecond; the last bin also counts any
+        wake-up that was later than that.  processing is the time
+        spent in on_frame().
+
+        """
+        frames = max(1, self._frames)
+        return {
+            "frames": self._frames,
+            "missed_frames": self._missed_frames,
+            "interval_ms": self._interval * 1000,
+            "mean_lateness_ms": self._total_lateness / frames * 1000,
+            "max_lateness_ms": self._max_lateness * 1000,
+            "mean_processing_ms": self._total_duration / frames * 1000,
+            "max_processing_ms": self._max_duration * 1000,
+            "lateness_histogram": list(self._lateness_histogram)
+        }
@@ -0,0 +1,101 @@
+class AudioFormat:
+    """The format of the audio exchanged with clients.
+
+    The sample rate must be one that Opus supports, and the frame
+    duration, in milliseconds, one of 20, 10 or 5.  Shorter frames
+    reduce latency, as each frame must be captured in full before it
+    is sent, at the cost of more packets and more codec calls per
+    second (see scripts/benchmark_frame_sizes.py).
+
+    Formats are compared by value, so they may be used as keys.
+
+    """
+    sample_rates = [8000, 12000, 16000, 24000, 48000]
+    frame_durations_ms = [20, 10, 5]
+
+    def __init__(self, samples_per_second=48000, channels=1,
+                 frame_duration_ms=20):
+        if samples_per_second not in AudioFormat.sample_rates:
+            raise Exception(
+                f"Unsupported sample rate ({samples_per_second}); "+
+                f"choose one of {AudioFormat.sample_rates}"
+            )
+        # Playback streams are mixed down to mono, so that's all we
+        # can mix
+        if channels != 1:
+            raise Exception(
+                f"Unsupported number of channels ({channels}); only "+
+                f"mono audio is supported"
+            )
+        if frame_duration_ms not in AudioFormat.frame_durations_ms:
+            raise Exception(
+                f"Unsupported frame duration ({frame_duration_ms} ms); "+
+                f"choose one of {AudioFormat.frame_durations_ms}"
+            )
+        self._samples_per_second = samples_per_second
+        self._channels = channels
+        self._frame_duration_ms = frame_duration_ms
+
+    @property
+    def samples_per_second(self):
+        return self._samples_per_second
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def frame_duration_ms(self):
+        return self._frame_duration_ms
+
+    @property
+    def frame_duration(self):
+        """The duration of a frame in seconds."""
+        return self._frame_duration_ms / 1000
+
+    @property
+    def samples_per_frame(self):
+        return self._samples_per_second // 1000 * self._frame_duration_ms
+
+    def to_dict(self):
+        """Returns the format as a dictionary, for sending as JSON."""
+        return {
+            "samples_per_second": self._samples_per_second,
+            "channels": self._channels,
+            "frame_duration_ms": self._frame_duration_ms
+        }
+
+    @staticmethod
+    def from_dict(data):
+        """Creates a format from a dictionary made by to_dict().
+
+        Missing entries take their default values.
+
+        """
+        return AudioFormat(**{
+            key: data[key]
+            for key in ["samples_per_second", "channels",
+                        "frame_duration_ms"]
+            if key in data
+        })
+
+    def _key(self):
+        return (
+            self._samples_per_second,
+            self._channels,
+            self._frame_duration_ms
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, AudioFormat):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __str__(self):
+        return (
+            f"{self._samples_per_second} Hz, {self._channels} "+
+            f"channel(s), {self._frame_duration_ms} ms frames"
+        )
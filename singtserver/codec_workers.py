@@ -0,0 +1,101 @@
+import queue
+import threading
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("codec_workers")
+
+
+class CodecWorkerPool:
+    """Shards per-connection codec work across a fixed set of threads.
+
+    Each worker thread owns a partition of the items it is given:
+    item i is always handled by worker i modulo the number of
+    workers.  run() hands every worker its shard and returns once they
+    have all finished, so the calling thread only gathers the results.
+
+    The work is expected to be dominated by libopus calls, which are
+    made through ctypes and so release the GIL, allowing the shards to
+    run in parallel.  With a single worker, the work is done on the
+    calling thread and no threads are started.
+
+    """
+    def __init__(self, workers):
+        self._workers = max(1, workers)
+        self._job_queues = []
+        self._threads = []
+        self._results = queue.SimpleQueue()
+
+        if self._workers > 1:
+            for index in range(self._workers):
+                job_queue = queue.SimpleQueue()
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(job_queue,),
+                    name=f"codec-worker-{index}",
+                    daemon=True
+                )
+                thread.start()
+                self._job_queues.append(job_queue)
+                self._threads.append(thread)
+
+        log.info(f"Started codec worker pool with {self._workers} workers")
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def _work(self, job_queue):
+        while True:
+            job = job_queue.get()
+            if job is None:
+                # We've been asked to stop
+                return
+            function, items = job
+            try:
+                for item in items:
+                    function(item)
+                self._results.put(None)
+            except Exception as e:
+                self._results.put(e)
+
+    def run(self, function, items):
+        """Calls function on every item, sharded across the workers.
+
+        Blocks until every call has completed.  If any call raised an
+        exception, the first one is re-raised once all the shards have
+        finished.
+
+        """
+        if self._workers == 1:
+            for item in items:
+                function(item)
+            return
+
+        # Hand each worker its shard
+        jobs = 0
+        for index, job_queue in enumerate(self._job_queues):
+            shard = items[index::self._workers]
+            if len(shard) > 0:
+                job_queue.put((function, shard))
+                jobs += 1
+
+        # Gather the results
+        error = None
+        for _ in range(jobs):
+            result = self._results.get()
+            if result is not None and error is None:
+                error = result
+
+        if error is not None:
+            raise error
+
+    def stop(self):
+        """Stops the worker threads."""
+        for job_queue in self._job_queues:
+            job_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._job_queues = []
+        self._threads = []
+        self._workers = 1
@@ -4,6 +4,10 @@ from twisted.internet import defer
 from twisted.internet.defer import gatherResults
 from twisted.logger import Logger
 
+from .content_hashes import ContentHashes
+from .download_coordinator import merge_download_results
+from .mixdown import MixdownRenderer
+
 # Start a logger with a namespace for a particular subsystem of our application.
 log = Logger("command")
 
@@ -17,6 +21,17 @@ class Command:
         self._tcp_server_factory = None
         self._web_server = None
 
+        # Audio ids of the rooms currently being recorded
+        self._live_recordings = {}
+
+        # Hashes of the audio files that clients download, so that
+        # clients needn't download audio they've already cached
+        self._content_hashes = ContentHashes()
+
+        # Renders combinations into single files, so that clients
+        # download one file rather than the track and every take
+        self._mixdown_renderer = MixdownRenderer(self._session_files)
+
 
     def set_tcp_server_factory(self, tcp_server_factory):
         self._tcp_server_factory = tcp_server_factory
@@ -26,27 +41,147 @@ class Command:
         self._web_server = web_server
 
         
-    def play_for_everyone(self, track_id, take_ids):
+    def play_for_everyone(self, track_id, take_ids, room="default"):
         if track_id is None and len(take_ids) == 0:
             raise Exception("'Play for everyone' requires at least a track ID or a take ID")
         
-        # Get path of the track
-        track_path = self._session_files.get_track_path(track_id)
-        
         # Get paths of the takes
         take_paths = [self._session_files.get_take_path(take_id)
                       for take_id in take_ids]
 
-        # Combine paths
+        # Combine paths, adding the track if there is one
         paths = take_paths
-        paths.append(track_path)
+        if track_id is not None:
+            track_path = self._session_files.get_track_path(track_id)
+            paths.append(track_path)
         
-        # Request ServerUDP to play the audio
-        self._udp_server.play_audio(paths)
+        # Request ServerUDP to play all the audio at once to
+        # everyone in the room.  The deferred fires once it's playing.
+        return defer.maybeDeferred(
+            self._udp_server.play_audio,
+            paths,
+            room=room
+        )
 
         
-    def stop_for_everyone(self):
-        self._udp_server.stop_audio()
+    def stop_for_everyone(self, room="default"):
+        return defer.maybeDeferred(self._udp_server.stop_audio, room=room)
+
+
+    def start_live_recording(self, room="default", participants=False):
+        """Starts recording what the room hears.
+
+        A new audio id is created for the recording, which is written
+        to the audio id's path.  If participants is True, each
+        participant's audio is also recorded, alongside it.
+
+        Returns a deferred that fires with the audio id once recording
+        has started.
+
+        """
+        d = self._database.add_audio_id()
+
+        def on_success(audio_id):
+            mix_path = self._session_files.get_audio_path(audio_id)
+            if participants:
+                participant_path = str(
+                    self._session_files.get_participant_audio_path(
+                        audio_id,
+                        "{client_id}"
+                    )
+                )
+            else:
+                participant_path = None
+            d = defer.maybeDeferred(
+                self._udp_server.start_recording,
+                str(mix_path),
+                participant_path,
+                room=room
+            )
+            def on_started(_):
+                self._live_recordings[room] = audio_id
+                return audio_id
+            d.addCallback(on_started)
+            return d
+        d.addCallback(on_success)
+
+        def on_error(error):
+            log.error(f"Failed to start recording room '{room}': {error}")
+            return error
+        d.addErrback(on_error)
+
+        return d
+
+    def stop_live_recording(self, room="default"):
+        """Stops recording the room.
+
+        Returns a deferred that fires with the recording's audio id
+        once the files have been written, at which point the recording
+        is announced over EventSource so that it may be reviewed.
+
+        """
+        try:
+            audio_id = self._live_recordings.pop(room)
+        except KeyError:
+            raise Exception(f"Room '{room}' is not being recorded")
+
+        d = defer.maybeDeferred(self._udp_server.stop_recording, room=room)
+
+        eventsource = self._context["web_server"].eventsource_resource
+        def on_success(filenames):
+            relpath = self._session_files.get_audio_relpath(audio_id)
+            message = {
+                "room": room,
+                "audio_id": audio_id,
+                "url": self._web_server.session_files_location+"/"+
+                       relpath.as_posix()
+            }
+            eventsource.publish_to_all(
+                "live_recording_ready",
+                json.dumps(message)
+            )
+            return audio_id
+        d.addCallback(on_success)
+
+        def on_error(error):
+            log.error(f"Failed to stop recording room '{room}': {error}")
+            return error
+        d.addErrback(on_error)
+
+        return d
+
+    def get_audio_statistics(self):
+        return self._udp_server.get_audio_statistics()
+
+    def set_monitor_mix(self, client_id, gains=None):
+        """Sets the balance of what a participant hears.
+
+        gains gives the gain at which the participant hears each other
+        participant, keyed by client id, and the playback, keyed by
+        "playback".  If gains is None, the participant hears everyone
+        equally again.  Returns a deferred that fires once the mix has
+        been set.
+
+        """
+        return defer.maybeDeferred(
+            self._udp_server.set_monitor_gains,
+            client_id,
+            gains
+        )
+
+    def set_audio_format(self, audio_format, room="default"):
+        """Sets the audio format used by the room's participants.
+
+        The room must be empty.  Returns a deferred that fires once the
+        format has been changed.
+
+        """
+        log.info(f"Setting audio format of room '{room}' to {audio_format}")
+        return defer.maybeDeferred(
+            self._udp_server.set_audio_format,
+            audio_format,
+            room=room
+        )
 
 
     def prepare_combination(self, track_id, take_ids):
@@ -77,7 +212,10 @@ class Command:
     def request_download(self, track_id=None, take_ids=[], participants=[]):
         """Requests download by the clients.
 
-        Returns a list of deferreds, once for each participant.
+        Returns a deferred that resolves, once every download has
+        finished or failed, with a dict: "ready" lists the client ids
+        of the participants that have all the audio, and "failed"
+        gives the reason that each of the others failed.
 
         """
         # List of deferreds to gather
@@ -85,43 +223,29 @@ class Command:
         
         # Track
         if track_id is not None:
-            track_path = self._session_files.get_track_relpath(track_id)
-            track_path = (
-                self._web_server.get_partial_url_prefix() +
-                str(track_path)
+            d = self._request_download(
+                self._database.get_track_audio_id(track_id),
+                self._session_files.get_track_path(track_id),
+                self._session_files.get_track_relpath(track_id),
+                participants
             )
-            
-            d = self._database.get_track_audio_id(track_id)
-            def request_download_track(audio_id):
-                return self._tcp_server_factory.broadcast_download_request(
-                    audio_id,
-                    track_path,
-                    participants
-                )
-            d.addCallback(request_download_track)
             ds.append(d)
 
         # Takes
         for take_id in take_ids:
-            take_path = self._session_files.get_take_relpath(take_id)
-            take_path = (
-                self._web_server.get_partial_url_prefix() +
-                str(take_path)
+            d = self._request_download(
+                self._database.get_take_audio_id(take_id),
+                self._session_files.get_take_path(take_id),
+                self._session_files.get_take_relpath(take_id),
+                participants
             )
-            
-            d = self._database.get_take_audio_id(take_id)
-            def request_download_take(audio_id):
-                this_take_path = take_path
-                return self._tcp_server_factory.broadcast_download_request(
-                    audio_id,
-                    this_take_path,
-                    participants
-                )
-            d.addCallback(request_download_take)
             ds.append(d)
 
         # Gather deferreds
         d = gatherResults(ds)
+        def merge_results(results):
+            return merge_download_results(results, participants)
+        d.addCallback(merge_results)
         def on_error(error):
             log.warn("Error in requesting client downloads: "+str(error))
             return error
@@ -129,6 +253,92 @@ class Command:
             
         return d
 
+    def request_combination_download(self, combination_id, participants=[]):
+        """Requests download of a combination by the clients.
+
+        If the combination is made of more than one track or take, its
+        mixdown is rendered (or the existing mixdown reused) and the
+        clients download only that.  If the mixdown can't be rendered,
+        the clients download the track and takes separately.
+
+        Returns a deferred that resolves as request_download() does.
+
+        """
+        d = self._database.get_combination_sources(combination_id)
+
+        def on_sources(sources):
+            audio_id, track_id, take_ids = sources
+            filenames = [
+                self._session_files.get_take_path(take_id)
+                for take_id in take_ids
+            ]
+            if track_id is not None:
+                filenames.insert(0, self._session_files.get_track_path(track_id))
+            if len(filenames) < 2:
+                # There's nothing to mix
+                return self.request_download(track_id, take_ids, participants)
+
+            d = self._mixdown_renderer.render(audio_id, filenames)
+
+            def on_rendered(path):
+                d = self._request_download(
+                    defer.succeed(audio_id),
+                    path,
+                    self._session_files.get_audio_relpath(audio_id),
+                    participants
+                )
+                def merge_results(result):
+                    return merge_download_results([result], participants)
+                d.addCallback(merge_results)
+                return d
+
+            def on_render_error(error):
+                log.warn(
+                    f"Failed to render mixdown of combination id "+
+                    f"{combination_id}; clients will download its "+
+                    f"track and takes instead: {error}"
+                )
+                return self.request_download(track_id, take_ids, participants)
+
+            d.addCallbacks(on_rendered, on_render_error)
+            return d
+        d.addCallback(on_sources)
+
+        return d
+
+    def _request_download(self, audio_id_deferred, path, relpath,
+                          participants):
+        """Requests download of a single audio file by the clients.
+
+        The file's contents are hashed so that clients that have
+        already cached it aren't asked to download it again.  If the
+        file can't be hashed, every client is asked to download it.
+
+        """
+        partial_url = (
+            self._web_server.get_partial_url_prefix() +
+            str(relpath)
+        )
+
+        d_hash = self._content_hashes.get_hash(path)
+        def on_hash_error(error):
+            log.warn(f"Failed to hash '{path}': {error}")
+            return None
+        d_hash.addErrback(on_hash_error)
+
+        d = gatherResults([audio_id_deferred, d_hash])
+        def broadcast(data):
+            audio_id, content_hash = data
+            return self._tcp_server_factory.broadcast_download_request(
+                audio_id,
+                partial_url,
+                participants,
+                content_hash
+            )
+        d.addCallback(broadcast)
+
+        return d
+
     def prepare_for_recording(self, track_id, take_ids, participants):
         """Prepares the clients for recording.
 
@@ -136,7 +346,13 @@ class Command:
         when the combination id has been obtained from the database
         and the download requests have been send, and a second item is
         a deferred that resolves when the clients have all finished
-        their downloads.
+        their downloads, or failed to.
+
+        A client that fails, or that takes too long, doesn't hold up
+        the others: the "ready_to_record" event lists the participants
+        that are ready, so the conductor may record without the
+        stragglers.  Its result is "success" if everyone is ready,
+        "partial" if only some are, and "failure" if no one is.
 
         """
         d1 = self.prepare_combination(track_id, take_ids)
@@ -148,27 +364,49 @@ class Command:
         d1.addCallback(on_combination_prepared)
         
         def request_download(combo_id):
-            d = self.request_download(track_id, take_ids, participants)
-            def on_success(data):
-                print("All downloads completed successfully")
-                return (combo_id, "success")
+            d = self.request_combination_download(combo_id, participants)
+            def on_success(downloads):
+                if len(downloads["failed"]) == 0:
+                    print("All downloads completed successfully")
+                    result = "success"
+                elif len(downloads["ready"]) > 0:
+                    log.warn(
+                        f"Some clients failed to download: "+
+                        f"{downloads['failed']}"
+                    )
+                    result = "partial"
+                else:
+                    log.error(
+                        f"Every client failed to download: "+
+                        f"{downloads['failed']}"
+                    )
+                    result = "failure"
+                return (combo_id, result, downloads)
             d.addCallback(on_success)
             def on_error(error):
                 log.error(f"Failed to download for all clients: {error}")
                 # Note that the error is being absorbed
-                return (combo_id, "failure")
+                downloads = {"ready": [], "failed": {}}
+                return (combo_id, "failure", downloads)
             d.addErrback(on_error)
             return d
         d2.addCallback(request_download)
 
         eventsource = self._context["web_server"].eventsource_resource
         def on_success(data):
-            combo_id, result = data
-            # Send notification over EventSource: this may be either
-            # success or failure
+            combo_id, result, downloads = data
+            # Send notification over EventSource: this may be
+            # success, partial success or failure.  Client ids are
+            # sent as strings, as Javascript's unable to handle ints
+            # larger than 53 bits.
             message =  {
                 "combination_id": combo_id,
-                "result": result
+                "result": result,
+                "ready": [str(id_) for id_ in downloads["ready"]],
+                "failed": {
+                    str(id_): reason
+                    for id_, reason in downloads["failed"].items()
+                }
             }
             message_json = json.dumps(message)
             eventsource.publish_to_all(
@@ -186,10 +424,29 @@ class Command:
         return (d1, d2)
 
     def record(self, take_name, combination_id, participants):
+        """Records a new take over the given combination.
+
+        Returns a tuple: the first item is a deferred that resolves
+        once the participants have been asked to record, and the
+        second is a deferred that resolves once every participant's
+        recording has been uploaded (or has failed), with the take's
+        result; see TakeTracker.track_take().
+
+        """
         # We need the audio ids of the track and takes that make up
-        # the combination.
-        d1 = self._database.get_audio_ids_from_combination_id(combination_id)
-        
+        # the combination, or, if the combination was mixed down
+        # when the clients prepared, just the combination's audio id.
+        d1 = self._database.get_combination_sources(combination_id)
+
+        def get_backing_audio_ids(sources):
+            audio_id, track_id, take_ids = sources
+            if self._mixdown_renderer.has_mixdown(audio_id):
+                return [audio_id]
+            return self._database.get_audio_ids_from_combination_id(
+                combination_id
+            )
+        d1.addCallback(get_backing_audio_ids)
+
         def on_success(audio_ids):
             print(f"Given combination id {combination_id} we got these backing audio ids: {audio_ids}")
             return audio_ids
@@ -209,28 +466,57 @@ class Command:
         # We need the audio_ids of the recordings that the clients
         # will send back
         def add_recording_ids(take_id):
-            return self._database.add_recording_audio_ids(
+            d = self._database.add_recording_audio_ids(
                 take_id,
                 participants
             )
+            def with_take_id(recording_ids):
+                return take_id, recording_ids
+            d.addCallback(with_take_id)
+            return d
         d2.addCallback(add_recording_ids)
 
         d = gatherResults([d1, d2])
 
+        # The deferred that resolves once the uploads have landed
+        d_uploads = defer.Deferred()
+
         def on_success(data):
-            backing_audio_ids, recording_ids = data
+            backing_audio_ids, (take_id, recording_ids) = data
             # Send the record command to each of the participants
-            return self._tcp_server_factory.broadcast_record_request(
+            d = self._tcp_server_factory.broadcast_record_request(
+                take_id,
                 backing_audio_ids,
                 recording_ids,
                 participants
             )
+            d.chainDeferred(d_uploads)
+            return take_id
         d.addCallback(on_success)
 
         def on_error(error):
             log.error(f"Failed to broadcast record request: {error}")
+            # No one was asked to record, so no one will upload
+            d_uploads.callback({
+                "take_id": None,
+                "uploaded": [],
+                "failed": {
+                    client_id: "Failed to start recording"
+                    for client_id in participants
+                },
+                "complete": False
+            })
             return error
         d.addErrback(on_error)
 
-        return d
+        def on_uploads(result):
+            log.info(
+                f"Take id {result['take_id']} has finished uploading; "+
+                f"{len(result['uploaded'])} recording(s) uploaded and "+
+                f"{len(result['failed'])} failed"
+            )
+            return result
+        d_uploads.addCallback(on_uploads)
+
+        return (d, d_uploads)
 
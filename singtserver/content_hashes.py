@@ -0,0 +1,59 @@
+import hashlib
+
+from twisted.internet import defer
+from twisted.internet import threads
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("content_hashes")
+
+
+def hash_file(path, chunk_size=1024*1024):
+    """Returns the SHA-256 hash of a file's contents, in hex."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class ContentHashes:
+    """Hashes the audio files that clients download.
+
+    Clients report the hashes of the audio they've cached, so that
+    audio they already have needn't be downloaded again.  Hashing is
+    done on a thread, so as not to block the reactor, and each file's
+    hash is remembered until the file's size or modification time
+    changes.
+
+    """
+    def __init__(self, defer_to_thread=threads.deferToThread):
+        self._defer_to_thread = defer_to_thread
+
+        # Hashes keyed by path, of (size, modification time, hash)
+        self._hashes = {}
+
+    def get_hash(self, path):
+        """Returns a deferred that resolves to the hash of the file."""
+        try:
+            stat = path.stat()
+        except OSError as e:
+            return defer.fail(e)
+        try:
+            size, mtime, content_hash = self._hashes[path]
+            if size == stat.st_size and mtime == stat.st_mtime_ns:
+                return defer.succeed(content_hash)
+        except KeyError:
+            pass
+
+        d = self._defer_to_thread(hash_file, path)
+
+        def on_success(content_hash):
+            self._hashes[path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+            return content_hash
+        d.addCallback(on_success)
+
+        return d
@@ -249,6 +249,27 @@ class Database:
         return d
         
 
+    def add_audio_id(self):
+        """Creates and returns a new audio id."""
+        def execute_sql(cursor):
+            cursor.execute("INSERT INTO AudioIdentifiers DEFAULT VALUES")
+            return cursor.lastrowid
+
+        def when_ready(dbpool):
+            return dbpool.runInteraction(execute_sql)
+        d = self.get_dbpool()
+        d.addCallback(when_ready)
+
+        def on_error(error):
+            log.warn(
+                "Failed to add audio id: "+
+                str(error)
+            )
+            return error
+        d.addErrback(on_error)
+
+        return d
+
     def get_track_audio_id(self, track_id):
         """Returns track's audio id or None."""
         def execute_sql(cursor):
@@ -373,6 +394,48 @@ class Database:
 
         return d
         
+    def get_combination_sources(self, combination_id):
+        """Returns the audio id, track id and take ids of a combination.
+
+        The track id is None if the combination doesn't have a
+        backing track.
+
+        """
+        def execute_sql(cursor):
+            cursor.execute(
+                "SELECT audioId, backingTrackId FROM Combinations WHERE id = ?",
+                (combination_id,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                raise Exception(
+                    f"Failed to find combination id {combination_id}"
+                )
+            audio_id, track_id = row
+
+            cursor.execute(
+                "SELECT takeId FROM CombinationsDetail "+
+                "WHERE combinationId = ? ORDER BY id",
+                (combination_id,)
+            )
+            take_ids = [row[0] for row in cursor.fetchall()]
+            return audio_id, track_id, take_ids
+
+        def when_ready(dbpool):
+            return dbpool.runInteraction(execute_sql)
+        d = self.get_dbpool()
+        d.addCallback(when_ready)
+
+        def on_error(error):
+            log.warn(
+                f"Failed to get the sources of combination id "+
+                f"{combination_id}: {error}"
+            )
+            return error
+        d.addErrback(on_error)
+
+        return d
+
     def get_audio_ids_from_combination_id(self, combination_id):
         def execute_sql(cursor):
             # Get Track ID.  There should be either zero or one, but
@@ -511,3 +574,55 @@ class Database:
 
         return d
 
+    def mark_recording_complete(self, audio_id):
+        """Marks the recording with the given audio id as complete.
+
+        If every recording of the recording's take is then complete,
+        the take is marked complete too.  Returns a deferred that
+        resolves to a tuple of the take id and whether the take is
+        complete.
+
+        """
+        def execute_sql(cursor):
+            cursor.execute(
+                "UPDATE Recordings SET complete = 1 WHERE audioId = ?",
+                (audio_id,)
+            )
+            if cursor.rowcount == 0:
+                raise Exception(
+                    f"Failed to find recording with audio id {audio_id}"
+                )
+
+            cursor.execute(
+                "SELECT takeId FROM Recordings WHERE audioId = ?",
+                (audio_id,)
+            )
+            take_id = cursor.fetchone()[0]
+
+            cursor.execute(
+                "SELECT COUNT(*) FROM Recordings "+
+                "WHERE takeId = ? AND complete = 0",
+                (take_id,)
+            )
+            incomplete = cursor.fetchone()[0]
+            if incomplete == 0:
+                cursor.execute(
+                    "UPDATE Takes SET complete = 1 WHERE id = ?",
+                    (take_id,)
+                )
+            return take_id, incomplete == 0
+
+        def when_ready(dbpool):
+            return dbpool.runInteraction(execute_sql)
+        d = self.get_dbpool()
+        d.addCallback(when_ready)
+
+        def on_error(error):
+            log.warn(
+                f"Failed to mark recording with audio id {audio_id} "+
+                f"complete: {error}"
+            )
+            return error
+        d.addErrback(on_error)
+
+        return d
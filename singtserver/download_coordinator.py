@@ -0,0 +1,209 @@
+import json
+
+from twisted.internet import defer
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("download_coordinator")
+
+
+class DownloadCoordinator:
+    """Tracks the audio that clients have been asked to download.
+
+    Each download, identified by a client id and an audio id, has a
+    deferred that resolves with (client_id, audio_id) when the client
+    reports that it has the audio, or fails if the client reports an
+    error, if the client's connection is lost (see cancel_client()),
+    or if nothing is heard from the client about the download for
+    timeout seconds.  Progress reports from the client push the
+    deadline back, so large downloads over slow links aren't cut off.
+
+    Every change to a download is published on the eventsource as a
+    "download_progress" event, so that the conductor can see who's
+    holding things up.
+
+    """
+    def __init__(self, eventsource, timeout=120, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._eventsource = eventsource
+        self._timeout = timeout
+
+        # A dict of dicts, keyed by client id and then by audio id,
+        # of [deferred, delayed call] pairs
+        self._downloads = {}
+
+    def request(self, client_id, audio_id):
+        """Starts tracking a download.
+
+        Returns the download's deferred.  If the download is already
+        being tracked, its existing deferred is returned and its
+        deadline is reset.
+
+        """
+        downloads = self._downloads.setdefault(client_id, {})
+        try:
+            download = downloads[audio_id]
+            download[1].reset(self._timeout)
+            return download[0]
+        except KeyError:
+            pass
+
+        d = defer.Deferred()
+        delayed_call = self._reactor.callLater(
+            self._timeout,
+            self._on_timeout,
+            client_id,
+            audio_id
+        )
+        downloads[audio_id] = [d, delayed_call]
+        self._publish(client_id, audio_id, "requested", progress=0)
+        return d
+
+    def skip(self, client_id, audio_id):
+        """Resolves a download that isn't needed, as the client has
+        already cached the audio.
+
+        Returns a deferred that has already resolved.
+
+        """
+        self._publish(client_id, audio_id, "cached", progress=1)
+        return defer.succeed((client_id, audio_id))
+
+    def is_pending(self, client_id, audio_id):
+        return audio_id in self._downloads.get(client_id, {})
+
+    def update_progress(self, client_id, audio_id, progress):
+        """Records the fraction of a download that's complete."""
+        try:
+            download = self._downloads[client_id][audio_id]
+        except KeyError:
+            log.warn(
+                f"Progress reported for download of audio id {audio_id} "+
+                f"by client id {client_id}, which isn't being tracked"
+            )
+            return
+        download[1].reset(self._timeout)
+        self._publish(client_id, audio_id, "downloading", progress=progress)
+
+    def complete(self, client_id, audio_id):
+        """Resolves a download that the client has finished."""
+        d = self._remove(client_id, audio_id)
+        if d is None:
+            log.warn(
+                f"Client id {client_id} completed download of audio id "+
+                f"{audio_id}, which isn't being tracked"
+            )
+            return
+        self._publish(client_id, audio_id, "downloaded", progress=1)
+        d.callback((client_id, audio_id))
+
+    def fail(self, client_id, audio_id, reason):
+        """Fails a download."""
+        d = self._remove(client_id, audio_id)
+        if d is None:
+            log.warn(
+                f"Client id {client_id} failed download of audio id "+
+                f"{audio_id}, which isn't being tracked: {reason}"
+            )
+            return
+        log.warn(
+            f"Download of audio id {audio_id} by client id {client_id} "+
+            f"failed: {reason}"
+        )
+        self._publish(client_id, audio_id, "failed", error=str(reason))
+        d.errback(Exception(reason))
+
+    def cancel_client(self, client_id, reason="Connection lost"):
+        """Fails all of a client's downloads."""
+        for audio_id in list(self._downloads.get(client_id, {})):
+            self.fail(client_id, audio_id, reason)
+
+    def _on_timeout(self, client_id, audio_id):
+        # The delayed call has fired, so mustn't be cancelled
+        self._downloads[client_id][audio_id][1] = None
+        self.fail(
+            client_id,
+            audio_id,
+            f"Timed out after {self._timeout} seconds without progress"
+        )
+
+    def _remove(self, client_id, audio_id):
+        downloads = self._downloads.get(client_id, {})
+        try:
+            d, delayed_call = downloads.pop(audio_id)
+        except KeyError:
+            return None
+        if len(downloads) == 0:
+            del self._downloads[client_id]
+        if delayed_call is not None:
+            delayed_call.cancel()
+        return d
+
+    def _publish(self, client_id, audio_id, state, progress=None,
+                 error=None):
+        # Client ids are sent as strings, as Javascript's unable to
+        # handle ints larger than 53 bits
+        message = {
+            "client_id": str(client_id),
+            "audio_id": audio_id,
+            "state": state
+        }
+        if progress is not None:
+            message["progress"] = progress
+        if error is not None:
+            message["error"] = error
+        self._eventsource.publish_to_all(
+            "download_progress",
+            json.dumps(message)
+        )
+
+
+def gather_downloads(deferreds_by_client_id):
+    """Waits for the downloads of many clients.
+
+    Given a dict of download deferreds keyed by client id, returns a
+    deferred that always succeeds, once every download has finished,
+    with a dict: "ready" is the list of client ids whose downloads
+    succeeded and "failed" is a dict of the reasons that the others
+    failed, keyed by client id.
+
+    """
+    client_ids = list(deferreds_by_client_id)
+    d = defer.DeferredList(
+        [deferreds_by_client_id[client_id] for client_id in client_ids],
+        consumeErrors=True
+    )
+
+    def on_finished(results):
+        ready = []
+        failed = {}
+        for client_id, (success, result) in zip(client_ids, results):
+            if success:
+                ready.append(client_id)
+            else:
+                failed[client_id] = result.getErrorMessage()
+        return {"ready": ready, "failed": failed}
+    d.addCallback(on_finished)
+
+    return d
+
+
+def merge_download_results(results, participants):
+    """Merges the results of gather_downloads() for several downloads.
+
+    A participant is ready only if they are ready in every result
+    (and they're all ready if there were no downloads to make).
+
+    """
+    failed = {}
+    for result in results:
+        for client_id, reason in result["failed"].items():
+            failed.setdefault(client_id, reason)
+    ready = [
+        client_id for client_id in participants
+        if client_id not in failed
+        and all(client_id in result["ready"] for result in results)
+    ]
+    return {"ready": ready, "failed": failed}
@@ -0,0 +1,279 @@
+import numpy
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("dynamics")
+
+
+class AutomaticGainControl:
+    """Brings every source to a common level in a few operations.
+
+    Each source (a row of the mixer's matrix) has its own gain, which
+    moves towards the gain that would bring the frame's RMS level to
+    target_rms.  The gain falls quickly (attack) when a source gets
+    louder and rises slowly (release) when it gets quieter, and is
+    held while a source is quieter than gate_rms, so that background
+    noise isn't raised during pauses.  Within a frame the gain ramps
+    linearly from its old value to its new one, so changes don't
+    click.
+
+    """
+    def __init__(self, samples_per_frame, capacity, target_rms=0.1,
+                 min_gain=0.1, max_gain=4.0, gate_rms=0.005,
+                 attack=0.5, release=0.05):
+        self._target_rms = numpy.float32(target_rms)
+        self._min_gain = min_gain
+        self._max_gain = max_gain
+        self._gate_rms = numpy.float32(gate_rms)
+        self._attack = numpy.float32(attack)
+        self._release = numpy.float32(release)
+
+        # The fraction of the way from the old gain to the new gain
+        # for each sample of a frame
+        self._ramp = numpy.arange(
+            1, samples_per_frame+1,
+            dtype=numpy.float32
+        ) / samples_per_frame
+
+        self._gains = numpy.ones(0, dtype=numpy.float32)
+        self.resize(capacity)
+
+    @property
+    def gains(self):
+        """The current gain of each source."""
+        return self._gains
+
+    def resize(self, capacity):
+        """Grows the gains to the given number of sources."""
+        gains = numpy.ones(capacity, dtype=numpy.float32)
+        gains[:len(self._gains)] = self._gains
+        self._gains = gains
+
+    def reset(self, row):
+        """Resets the gain of a new source."""
+        self._gains[row] = 1
+
+    def apply(self, frames, active):
+        """Applies each source's gain to its frame, in place.
+
+        frames is a (sources x samples) matrix and active is a boolean
+        array marking the sources that have a signal this tick; the
+        gains of the other sources are left unchanged.
+
+        """
+        rows = numpy.flatnonzero(active)
+        if len(rows) == 0:
+            return
+        signals = frames[rows]
+        old_gains = self._gains[rows]
+
+        # Measure each source's RMS level
+        mean_squares = numpy.einsum("ij,ij->i", signals, signals)
+        mean_squares /= signals.shape[1]
+        rms = numpy.sqrt(mean_squares)
+
+        # Calculate the gain that would bring each source to the
+        # target level, holding the gain of sources below the gate
+        target_gains = numpy.divide(
+            self._target_rms,
+            rms,
+            out=old_gains.copy(),
+            where=rms >= self._gate_rms
+        )
+        numpy.clip(target_gains, self._min_gain, self._max_gain,
+                   out=target_gains)
+
+        # Move towards the target gains, quickly if the gain is
+        # falling and slowly if it is rising
+        rates = numpy.where(
+            target_gains < old_gains,
+            self._attack,
+            self._release
+        )
+        new_gains = old_gains + (target_gains - old_gains) * rates
+        self._gains[rows] = new_gains
+
+        # Ramp from the old gains to the new gains across the frame
+        ramps = (new_gains - old_gains)[:, numpy.newaxis] * self._ramp
+        ramps += old_gains[:, numpy.newaxis]
+        signals *= ramps
+        frames[rows] = signals
+
+
+class LookAheadLimiter:
+    """Keeps many signals below a threshold without distorting them.
+
+    Each row of the matrix passed to apply() is a separate signal
+    (typically one listener's mix) with its own gain.  The signals are
+    delayed by a block of samples, of up to lookahead samples, so that
+    the gain can start to fall a block before a peak arrives; within
+    each block the gain ramps linearly, so it never jumps.  Peaks are
+    measured per block rather than per sample, which keeps the work
+    for every row down to a handful of numpy operations.  Once a peak
+    has passed, the gain recovers by at most a factor of release per
+    block.
+
+    """
+    def __init__(self, samples_per_frame, capacity, threshold=0.9,
+                 lookahead=48, release=1.05):
+        self._threshold = numpy.float32(threshold)
+        self._release = numpy.float32(release)
+
+        # Choose the largest block that evenly divides the frame
+        self._block_size = max(
+            size for size in range(1, min(lookahead, samples_per_frame)+1)
+            if samples_per_frame % size == 0
+        )
+        self._blocks = samples_per_frame // self._block_size
+        self._samples_per_frame = samples_per_frame
+
+        # The fraction of the way from the previous block's gain to
+        # the block's gain for each sample of a block
+        self._ramp = numpy.arange(
+            1, self._block_size+1,
+            dtype=numpy.float32
+        ) / self._block_size
+
+        self._gains = numpy.ones(0, dtype=numpy.float32)
+        self._delayed = numpy.zeros((0, self._block_size), dtype=numpy.float32)
+        self.resize(capacity)
+
+    @property
+    def latency(self):
+        """The delay, in samples, added to the signals."""
+        return self._block_size
+
+    def resize(self, capacity):
+        """Grows the state to the given number of signals."""
+        gains = numpy.ones(capacity, dtype=numpy.float32)
+        gains[:len(self._gains)] = self._gains
+        delayed = numpy.zeros(
+            (capacity, self._block_size),
+            dtype=numpy.float32
+        )
+        delayed[:len(self._delayed)] = self._delayed
+        self._gains = gains
+        self._delayed = delayed
+
+    def reset(self, row):
+        """Clears the state of a new signal."""
+        self._gains[row] = 1
+        self._delayed[row] = 0
+
+    def apply(self, signals):
+        """Limits the (signals x samples) matrix, in place."""
+        rows = signals.shape[0]
+        gains = self._gains[:rows]
+        delayed = self._delayed[:rows]
+
+        # Prepend the block held back from the previous frame, and
+        # hold back this frame's last block
+        buffer = numpy.concatenate((delayed, signals), axis=1)
+        delayed[:] = buffer[:, self._samples_per_frame:]
+        blocks = buffer.reshape(rows, self._blocks+1, self._block_size)
+
+        # Find the gain that keeps each block, and the block after
+        # it, below the threshold
+        peaks = numpy.abs(blocks).max(axis=2)
+        numpy.maximum(peaks[:, :-1], peaks[:, 1:], out=peaks[:, :-1])
+        peaks = peaks[:, :-1]
+        targets = numpy.minimum(
+            self._threshold / numpy.maximum(peaks, self._threshold),
+            1
+        )
+
+        # Limit how quickly the gain recovers.  This only runs along
+        # the blocks; every row is handled at once.
+        block_gains = numpy.empty((rows, self._blocks+1), dtype=numpy.float32)
+        block_gains[:, 0] = gains
+        for block in range(self._blocks):
+            numpy.minimum(
+                targets[:, block],
+                block_gains[:, block] * self._release,
+                out=block_gains[:, block+1]
+            )
+        gains[:] = block_gains[:, -1]
+
+        # Ramp between the blocks' gains and apply them to the
+        # delayed signals
+        steps = numpy.diff(block_gains, axis=1)[:, :, numpy.newaxis]
+        ramps = steps * self._ramp
+        ramps += block_gains[:, :-1, numpy.newaxis]
+        signals[:] = (blocks[:, :-1] * ramps).reshape(rows, -1)
+
+
+def soft_clip(signals, knee=0.95):
+    """Softly clips samples beyond the knee, in place.
+
+    Samples whose magnitude is below the knee are unchanged; beyond
+    it, they are smoothly compressed so that they never exceed 1.
+
+    """
+    over = numpy.flatnonzero(numpy.abs(signals) > knee)
+    if len(over) == 0:
+        return
+    flat = signals.reshape(-1)
+    values = flat[over]
+    headroom = 1 - knee
+    magnitudes = knee + headroom * numpy.tanh(
+        (numpy.abs(values) - knee) / headroom
+    )
+    flat[over] = numpy.copysign(magnitudes, values)
+
+
+class MixBusDynamics:
+    """The dynamics processing applied by the mixer.
+
+    Each source's frame is levelled by automatic gain control before
+    mixing.  Every listener's mix (the combined mix and each
+    mix-minus) is then passed through a look-ahead limiter and finally
+    a soft clipper, so that however many people sing at once the
+    output stays within [-1, 1] without being divided down for
+    everyone.  The soft clipper's knee must be at or above the
+    limiter's threshold, so that it only catches what the limiter
+    lets past, rather than bending everything the limiter leaves just
+    below its threshold.
+
+    Sources are identified by their slot in the mixer; the mixes are
+    identified by their row in the mixer's output matrix.
+
+    """
+    def __init__(self, samples_per_frame, capacity, target_rms=0.1,
+                 threshold=0.9, knee=0.95, lookahead=48):
+        if knee < threshold:
+            raise Exception(
+                f"The soft clipper's knee ({knee}) must not be below "+
+                f"the limiter's threshold ({threshold})"
+            )
+        self._knee = knee
+        self.automatic_gain_control = AutomaticGainControl(
+            samples_per_frame,
+            capacity,
+            target_rms=target_rms
+        )
+        self.limiter = LookAheadLimiter(
+            samples_per_frame,
+            capacity+1,
+            threshold=threshold,
+            lookahead=lookahead
+        )
+
+    def resize(self, capacity):
+        """Grows the state to the given number of sources."""
+        self.automatic_gain_control.resize(capacity)
+        self.limiter.resize(capacity+1)
+
+    def reset_source(self, slot):
+        self.automatic_gain_control.reset(slot)
+
+    def reset_output(self, row):
+        self.limiter.reset(row)
+
+    def process_sources(self, frames, active):
+        """Levels the sources' frames, in place, before they're mixed."""
+        self.automatic_gain_control.apply(frames, active)
+
+    def process_outputs(self, outputs):
+        """Limits and clips the mixes, in place."""
+        self.limiter.apply(outputs)
+        soft_clip(outputs, self._knee)
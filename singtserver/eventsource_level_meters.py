@@ -0,0 +1,61 @@
+import json
+
+from twisted.internet import defer
+from twisted.internet import task
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("eventsource_level_meters")
+
+
+class EventSourceLevelMeters:
+    """Publishes the rooms' level meters to the eventsource.
+
+    Every interval seconds (by default ten times a second, however
+    long the audio frames are), the levels metered by the UDP server
+    since the last publication are sent as a single "update_levels"
+    event holding every room; see UDPServer.get_levels().  If the
+    previous levels haven't yet been gathered (from media workers, for
+    example) that publication is skipped.  Nothing is read or
+    published while there are no clients to meter, or no one is
+    listening to the eventsource.
+
+    """
+    def __init__(self, udp_server, eventsource, interval=0.1):
+        self._udp_server = udp_server
+        self._eventsource = eventsource
+        self._interval = interval
+        self._pending = False
+        self._looping_call = task.LoopingCall(self._publish)
+
+    def start(self):
+        self._looping_call.start(self._interval, now=False)
+
+    def stop(self):
+        if self._looping_call.running:
+            self._looping_call.stop()
+
+    def _publish(self):
+        if self._pending:
+            return
+        if (not self._udp_server.has_clients()
+            or self._eventsource.listeners == 0):
+            return
+        self._pending = True
+
+        d = defer.maybeDeferred(self._udp_server.get_levels)
+
+        def on_success(levels):
+            self._pending = False
+            if len(levels) == 0:
+                return
+            self._eventsource.publish_to_all(
+                "update_levels",
+                json.dumps(levels, separators=(",", ":"))
+            )
+
+        def on_error(error):
+            self._pending = False
+            log.error(f"Failed to publish levels: {error}")
+
+        d.addCallbacks(on_success, on_error)
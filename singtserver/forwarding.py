@@ -0,0 +1,100 @@
+import heapq
+import struct
+
+from .opus_codec import is_dtx_packet
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("forwarding")
+
+
+# The source id given to the playback audio within a bundle; client
+# ids are random 64-bit numbers, so this won't clash in practice
+PLAYBACK_SOURCE_ID = 0
+
+# Each bundle starts with the number of packets it contains, and each
+# packet is preceded by its source id and its length
+_bundle_header = struct.Struct(">B")
+_packet_header = struct.Struct(">QH")
+
+
+def pack_bundle(packets):
+    """Packs a list of (source_id, packet) pairs into one datagram."""
+    parts = [_bundle_header.pack(len(packets))]
+    for source_id, packet in packets:
+        parts.append(_packet_header.pack(source_id, len(packet)))
+        parts.append(packet)
+    return b"".join(parts)
+
+
+def unpack_bundle(data):
+    """Returns the list of (source_id, packet) pairs in a bundle."""
+    count = _bundle_header.unpack_from(data)[0]
+    offset = _bundle_header.size
+    packets = []
+    for _ in range(count):
+        source_id, length = _packet_header.unpack_from(data, offset)
+        offset += _packet_header.size
+        packets.append((source_id, data[offset:offset+length]))
+        offset += length
+    if offset != len(data):
+        raise Exception(
+            f"Bundle had {len(data)-offset} bytes left over after "+
+            f"unpacking {count} packets"
+        )
+    return packets
+
+
+class SpeakerSelector:
+    """Chooses the most active speakers without decoding their audio.
+
+    Opus uses a variable bitrate, so the size of a packet is a cheap
+    hint of how much is going on in it: silence and DTX packets are
+    tiny, while singing produces large packets.  Each source's activity
+    is a smoothed average of its packet sizes (with missing and DTX
+    packets counting as zero), and the sources with the highest
+    activity are selected.  The smoothing stops the selection from
+    flickering between sources from one frame to the next.
+
+    """
+    def __init__(self, speakers, smoothing=0.2):
+        self._speakers = speakers
+        self._smoothing = smoothing
+        self._activity = {}
+
+    @property
+    def speakers(self):
+        return self._speakers
+
+    def get_activity(self, source_id):
+        return self._activity.get(source_id, 0)
+
+    def remove(self, source_id):
+        """Forgets a source that has left."""
+        self._activity.pop(source_id, None)
+
+    def select(self, packets):
+        """Returns the (source_id, packet) pairs to forward this frame.
+
+        packets is a list of (source_id, packet) pairs, where packet is
+        None if it was missing.  Only sources with a non-DTX packet this
+        frame can be selected.
+
+        """
+        candidates = []
+        for source_id, packet in packets:
+            if packet is None or is_dtx_packet(packet):
+                size = 0
+            else:
+                size = len(packet)
+                candidates.append((source_id, packet))
+
+            activity = self._activity.get(source_id, 0)
+            activity += (size - activity) * self._smoothing
+            self._activity[source_id] = activity
+
+        return heapq.nlargest(
+            self._speakers,
+            candidates,
+            key=lambda candidate: self._activity[candidate[0]]
+        )
@@ -0,0 +1,225 @@
+import math
+import time
+
+from .opus_codec import is_dtx_packet
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("jitter_buffer")
+
+
+class AdaptiveJitterBuffer:
+    """A jitter buffer whose depth adapts to its connection.
+
+    Packets are put into the buffer as they arrive and taken out once
+    per frame.  The buffer measures the connection's inter-arrival
+    jitter (as per RFC 3550) along with the proportion of packets that
+    were lost or arrived too late to be played, and adjusts its target
+    depth, in packets, within [min_depth, max_depth]:
+
+    * An underrun (nothing to play and nothing buffered) immediately
+      grows the depth by one packet and rebuffers.
+
+    * Once per adaptation window the depth is set from the measured
+      jitter.  If the buffer held more packets than needed for the
+      whole window, the oldest packet is dropped to reduce latency.
+
+    A client using DTX stops sending after a DTX (silence) packet, so
+    running dry after one is expected: it isn't counted as loss or as
+    an underrun, and doesn't grow the depth, but the buffer refills
+    before playing the next talkspurt.  Nor is the gap taken as
+    jitter.
+
+    Sequence numbers are 16-bit and wrap around.
+
+    """
+    def __init__(self, frame_duration, min_depth=1, max_depth=10,
+                 initial_depth=3, jitter_multiplier=3,
+                 adaptation_window=50, monotonic=time.monotonic):
+        self._frame_duration = frame_duration
+        self._min_depth = min_depth
+        self._max_depth = max_depth
+        self._depth = min(max(initial_depth, min_depth), max_depth)
+        self._jitter_multiplier = jitter_multiplier
+        self._adaptation_window = adaptation_window
+        self._monotonic = monotonic
+
+        # Packets keyed by their unwrapped sequence number
+        self._packets = {}
+        self._highest_seq_no = None
+        self._next_seq_no = None
+        self._playing = False
+        self._last_played_dtx = False
+
+        # Jitter estimate, in seconds
+        self._jitter = 0
+        self._last_transit = None
+        self._last_put_dtx = False
+        self.last_arrival = None
+
+        # Counts over the current adaptation window and in total
+        self._window_frames = 0
+        self._window_min_level = None
+        self._window = {"played": 0, "lost": 0, "late": 0}
+        self._totals = {"received": 0, "played": 0, "lost": 0, "late": 0,
+                        "underruns": 0}
+        self._loss_rate = 0
+        self._late_rate = 0
+
+    @property
+    def depth(self):
+        """The current target depth, in packets."""
+        return self._depth
+
+    def _unwrap(self, seq_no):
+        if self._highest_seq_no is None:
+            return seq_no
+        delta = (seq_no - self._highest_seq_no) % 2**16
+        if delta >= 2**15:
+            delta -= 2**16
+        return self._highest_seq_no + delta
+
+    def put_packet(self, seq_no, packet):
+        arrival = self._monotonic()
+        self.last_arrival = arrival
+        seq_no = self._unwrap(seq_no)
+        self._totals["received"] += 1
+
+        # Update the jitter estimate from the variation in transit
+        # time; the send time is implied by the sequence number.  The
+        # gap after a DTX packet is silence, not jitter.
+        transit = arrival - seq_no * self._frame_duration
+        if self._last_transit is not None and not self._last_put_dtx:
+            difference = abs(transit - self._last_transit)
+            self._jitter += (difference - self._jitter) / 16
+        self._last_transit = transit
+        self._last_put_dtx = is_dtx_packet(packet)
+
+        if self._highest_seq_no is None or seq_no > self._highest_seq_no:
+            self._highest_seq_no = seq_no
+
+        # Discard packets that arrive after their turn to be played
+        if self._next_seq_no is not None and seq_no < self._next_seq_no:
+            self._window["late"] += 1
+            self._totals["late"] += 1
+            return
+
+        self._packets[seq_no] = packet
+
+        # Don't hold more than the maximum depth
+        while len(self._packets) > self._max_depth + 1:
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        oldest = min(self._packets)
+        del self._packets[oldest]
+        if self._next_seq_no is not None:
+            self._next_seq_no = max(self._next_seq_no, oldest + 1)
+
+    def peek_packet(self, offset=0):
+        """Returns the packet offset places after the next, or None.
+
+        The packet remains in the buffer.
+
+        """
+        if self._next_seq_no is None:
+            return None
+        return self._packets.get(self._next_seq_no + offset)
+
+    def get_packet(self):
+        """Returns the packet to be played this frame.
+
+        Returns None if the packet is missing, or if the buffer is
+        (re)filling to its target depth.
+
+        """
+        packet = self._get_packet()
+        self._adapt()
+        return packet
+
+    def _get_packet(self):
+        if not self._playing:
+            if len(self._packets) < self._depth:
+                return None
+            # We've buffered enough; start playing from the oldest
+            self._playing = True
+            if self._next_seq_no is None or self._next_seq_no < min(self._packets):
+                self._next_seq_no = min(self._packets)
+
+        packet = self._packets.pop(self._next_seq_no, None)
+
+        if (packet is None and len(self._packets) == 0
+            and self._last_played_dtx):
+            # The client has stopped sending after a DTX packet, so
+            # wait for their next talkspurt
+            self._playing = False
+            return None
+
+        self._next_seq_no += 1
+        if packet is not None:
+            self._last_played_dtx = is_dtx_packet(packet)
+            self._window["played"] += 1
+            self._totals["played"] += 1
+        elif len(self._packets) > 0:
+            # The packet was lost, but later ones have arrived
+            self._window["lost"] += 1
+            self._totals["lost"] += 1
+        else:
+            # We've run dry; grow the buffer and refill it
+            self._totals["underruns"] += 1
+            self._window["lost"] += 1
+            self._totals["lost"] += 1
+            self._depth = min(self._depth + 1, self._max_depth)
+            self._playing = False
+
+        return packet
+
+    def _adapt(self):
+        """Adjusts the depth once per adaptation window."""
+        level = len(self._packets)
+        if self._window_min_level is None or level < self._window_min_level:
+            self._window_min_level = level
+        self._window_frames += 1
+        if self._window_frames < self._adaptation_window:
+            return
+
+        # Rates over the window that has just finished
+        expected = sum(self._window.values())
+        if expected > 0:
+            self._loss_rate = self._window["lost"] / expected
+            self._late_rate = self._window["late"] / expected
+
+        # Set the depth to cover the measured jitter
+        target = math.ceil(
+            self._jitter_multiplier * self._jitter / self._frame_duration
+        ) + 1
+        self._depth = min(max(target, self._min_depth), self._max_depth)
+
+        # If we held more than needed all window, reduce the latency
+        if self._playing and self._window_min_level > self._depth:
+            self._drop_oldest()
+
+        self._window_frames = 0
+        self._window_min_level = None
+        self._window = {"played": 0, "lost": 0, "late": 0}
+
+    @property
+    def loss_rate(self):
+        """Proportion of packets lost over the last window."""
+        return self._loss_rate
+
+    @property
+    def late_rate(self):
+        """Proportion of packets that arrived too late, last window."""
+        return self._late_rate
+
+    def get_statistics(self):
+        statistics = {
+            "depth": self._depth,
+            "level": len(self._packets),
+            "jitter_ms": self._jitter * 1000,
+            "loss_rate": self._loss_rate,
+            "late_rate": self._late_rate
+        }
+        statistics.update(self._totals)
+        return statistics
@@ -0,0 +1,272 @@
+"""A media worker process, run by MediaWorkerPool.
+
+The worker runs a UDPServer on its own port.  It takes commands from
+the control-plane process as JSON lines on stdin and sends events back
+as JSON lines on file descriptor 3, leaving stdout and stderr free for
+output and logging.
+
+"""
+import argparse
+import json
+import sys
+
+from twisted.internet import reactor
+from twisted.internet import stdio
+from twisted.protocols import basic
+from twisted.logger import Logger, LogLevel, LogLevelFilterPredicate, \
+    textFileLogObserver, FilteringLogObserver, globalLogBeginner
+
+from .audio_format import AudioFormat
+from .server_udp import UDPServer
+
+# Start a logger with a namespace for a particular subsystem of our application.
+log = Logger("media_worker")
+
+
+class ControlProtocol(basic.LineReceiver):
+    """Receives commands from, and sends events to, the control plane."""
+    delimiter = b"\n"
+    MAX_LENGTH = 2**20
+
+    def __init__(self):
+        self.udp_server = None
+        self.tcp_server = None
+        self._commands = {}
+        self._register_commands()
+
+    def _register_commands(self):
+        self.register_command("play_audio", self._command_play_audio)
+        self.register_command("stop_audio", self._command_stop_audio)
+        self.register_command("assign_room", self._command_assign_room)
+        self.register_command("remove_client", self._command_remove_client)
+        self.register_command("start_recording", self._command_start_recording)
+        self.register_command("stop_recording", self._command_stop_recording)
+        self.register_command("set_audio_format", self._command_set_audio_format)
+        self.register_command("set_monitor_gains", self._command_set_monitor_gains)
+        self.register_command("get_levels", self._command_get_levels)
+        self.register_command(
+            "get_audio_statistics",
+            self._command_get_audio_statistics
+        )
+
+    def register_command(self, command, function):
+        self._commands[command] = function
+
+    def send_event(self, event, **data):
+        data["event"] = event
+        self.sendLine(json.dumps(data).encode("utf-8"))
+
+    def reply(self, json_data, result=None, error=None):
+        """Replies to a command that carried a request id."""
+        if error is not None:
+            self.send_event(
+                "reply",
+                request_id=json_data["request_id"],
+                error=str(error)
+            )
+        else:
+            self.send_event(
+                "reply",
+                request_id=json_data["request_id"],
+                result=result
+            )
+
+    def lineReceived(self, line):
+        try:
+            json_data = json.loads(line)
+            function = self._commands[json_data["command"]]
+            function(json_data)
+        except Exception:
+            log.failure(f"Failed to process command ({line})")
+
+    def connectionLost(self, reason):
+        # The control plane has gone away, so there's nothing more for
+        # us to do
+        log.info("Lost connection to the control plane; stopping")
+        if reactor.running:
+            reactor.stop()
+
+    def _command_play_audio(self, json_data):
+        try:
+            self.udp_server.play_audio(
+                json_data["filenames"],
+                json_data["gains"],
+                room=json_data["room"]
+            )
+        except Exception as e:
+            self.reply(json_data, error=e)
+            return
+        self.reply(json_data)
+
+    def _command_stop_audio(self, json_data):
+        try:
+            self.udp_server.stop_audio(room=json_data["room"])
+        except Exception as e:
+            self.reply(json_data, error=e)
+            return
+        self.reply(json_data)
+
+    def _command_assign_room(self, json_data):
+        # The control plane assigns rooms to clients connected over TCP
+        self.tcp_server.add_client(json_data["client_id"])
+        self.udp_server.assign_room(json_data["client_id"], json_data["room"])
+
+    def _command_remove_client(self, json_data):
+        self.tcp_server.remove_client(json_data["client_id"])
+        self.udp_server.remove_client(
+            json_data["client_id"],
+            leave=json_data.get("leave", True)
+        )
+
+    def _command_start_recording(self, json_data):
+        try:
+            self.udp_server.start_recording(
+                json_data["mix_filename"],
+                json_data["participant_filename"],
+                room=json_data["room"]
+            )
+        except Exception as e:
+            self.reply(json_data, error=e)
+            return
+        self.reply(json_data)
+
+    def _command_stop_recording(self, json_data):
+        try:
+            d = self.udp_server.stop_recording(room=json_data["room"])
+        except Exception as e:
+            self.reply(json_data, error=e)
+            return
+
+        def on_success(filenames):
+            filenames = {
+                str(source): str(filename)
+                for source, filename in filenames.items()
+            }
+            self.reply(json_data, result=filenames)
+        def on_error(failure):
+            self.reply(json_data, error=failure.value)
+        d.addCallbacks(on_success, on_error)
+
+    def _command_set_audio_format(self, json_data):
+        try:
+            self.udp_server.set_audio_format(
+                AudioFormat.from_dict(json_data["audio_format"]),
+                room=json_data["room"]
+            )
+        except Exception as e:
+            self.reply(json_data, error=e)
+            return
+        self.reply(json_data)
+
+    def _command_set_monitor_gains(self, json_data):
+        try:
+            self.udp_server.set_monitor_gains(
+                json_data["client_id"],
+                json_data["gains"]
+            )
+        except Exception as e:
+            self.reply(json_data, error=e)
+            return
+        self.reply(json_data)
+
+    def _command_get_levels(self, json_data):
+        self.reply(json_data, result=self.udp_server.get_levels())
+
+    def _command_get_audio_statistics(self, json_data):
+        self.reply(json_data, result=self.udp_server.get_audio_statistics())
+
+
+class ParticipantsProxy:
+    """Passes UDPServer's calls to Participants on to the control plane."""
+    def __init__(self, control_protocol):
+        self._control_protocol = control_protocol
+
+    def join_udp(self, client_id):
+        self._control_protocol.send_event("join_udp", client_id=client_id)
+        return False
+
+    def leave(self, client_id):
+        self._control_protocol.send_event("leave", client_id=client_id)
+
+
+class TCPServerProxy:
+    """Stands in for the control plane's TCP server factory.
+
+    The clients that the control plane has assigned to this worker's
+    rooms are those connected over TCP.  UDPServer keeps their
+    connections when they fall silent, and asks them to announce
+    themselves again; that request is passed on to the control plane.
+
+    """
+    def __init__(self, control_protocol):
+        self._control_protocol = control_protocol
+        self._client_ids = set()
+
+    def add_client(self, client_id):
+        self._client_ids.add(client_id)
+
+    def remove_client(self, client_id):
+        self._client_ids.discard(client_id)
+
+    def get_protocol(self, client_id):
+        if client_id not in self._client_ids:
+            return None
+        return TCPProtocolProxy(self._control_protocol, client_id)
+
+
+class TCPProtocolProxy:
+    """Passes UDPServer's requests to a client on to the control plane."""
+    def __init__(self, control_protocol, client_id):
+        self._control_protocol = control_protocol
+        self._client_id = client_id
+
+    def send_reannounce_request(self):
+        self._control_protocol.send_event(
+            "reannounce",
+            client_id=self._client_id
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Singt media worker")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--codec-workers", type=int, default=1)
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--frame-duration", type=int, default=20)
+    args = parser.parse_args()
+
+    # Log to stderr, which the control plane passes to its own log
+    globalLogBeginner.beginLoggingTo([
+        FilteringLogObserver(
+            textFileLogObserver(sys.stderr),
+            predicates=[LogLevelFilterPredicate(LogLevel.info)]
+        )
+    ])
+
+    control_protocol = ControlProtocol()
+    control_protocol.tcp_server = TCPServerProxy(control_protocol)
+    context = {
+        "reactor": reactor,
+        "participants": ParticipantsProxy(control_protocol),
+        "tcp_server_factory": control_protocol.tcp_server
+    }
+    audio_format = AudioFormat(
+        samples_per_second=args.sample_rate,
+        frame_duration_ms=args.frame_duration
+    )
+    udp_server = UDPServer(
+        context,
+        audio_format=audio_format,
+        codec_workers=args.codec_workers
+    )
+    control_protocol.udp_server = udp_server
+
+    stdio.StandardIO(control_protocol, stdin=0, stdout=3)
+    reactor.listenUDP(args.port, udp_server)
+    log.info(f"Media worker listening on UDP port {args.port}")
+
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+import itertools
+import json
+import os
+import sys
+import zlib
+
+from twisted.internet import defer
+from twisted.internet import protocol
+
+from .audio_format import AudioFormat
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("media_workers")
+
+
+class MediaWorkerProtocol(protocol.ProcessProtocol):
+    """The control plane's end of the channel to a media worker.
+
+    Commands are written to the worker's stdin, and events are read
+    from its file descriptor 3, as JSON lines.  Anything the worker
+    writes to stdout or stderr is logged.
+
+    """
+    def __init__(self, pool, index):
+        self._pool = pool
+        self._index = index
+        self._buffers = {}
+        self.ended = defer.Deferred()
+
+    def send(self, message):
+        line = json.dumps(message) + "\n"
+        self.transport.write(line.encode("utf-8"))
+
+    def childDataReceived(self, child_fd, data):
+        # Split the data into lines, keeping any partial line
+        data = self._buffers.get(child_fd, b"") + data
+        *lines, self._buffers[child_fd] = data.split(b"\n")
+
+        for line in lines:
+            if child_fd == 3:
+                try:
+                    self._pool._process_event(self._index, json.loads(line))
+                except Exception:
+                    log.failure(
+                        f"Failed to process event from media worker "+
+                        f"{self._index} ({line})"
+                    )
+            else:
+                log.info(
+                    f"[worker {self._index}] "+
+                    line.decode("utf-8", errors="replace")
+                )
+
+    def processEnded(self, reason):
+        log.info(f"Media worker {self._index} ended: {reason.value}")
+        self._pool._worker_ended(self._index)
+        self.ended.callback(None)
+
+
+class MediaWorkerPool:
+    """Runs the audio work in several media worker processes.
+
+    Each worker is a separate Python process (see media_worker.py)
+    running a UDPServer on its own port, so mixing is spread across
+    every core rather than sharing one GIL.  Rooms are sharded across
+    the workers: the default room is always handled by the first
+    worker, on base_port, and other rooms by a worker chosen from a
+    hash of the room's name, on base_port plus the worker's index.
+
+    The pool has the same methods as UDPServer, so it may be used in
+    its place by the rest of the server, with two differences:
+    assign_room() returns the UDP port that the client should send to,
+    and every other method that asks a worker to do something returns
+    a deferred, which fails if the worker does.  Calls that the
+    workers make to Participants are made in this process; a client
+    moving between workers doesn't leave and rejoin.
+
+    A worker that ends while the pool is running has crashed, so it's
+    restarted after restart_delay seconds, its clients are put back
+    in their rooms, and they're asked over TCP to announce themselves
+    to it again.
+
+    """
+    def __init__(self, context, workers, base_port=12345, codec_workers=1,
+                 audio_format=None, restart_delay=1, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._context = context
+        self._participants = context["participants"]
+        self._workers = workers
+        self._base_port = base_port
+        self._codec_workers = codec_workers
+
+        if audio_format is None:
+            audio_format = AudioFormat()
+        self.audio_format = audio_format
+        self._room_formats = {}
+
+        self._restart_delay = restart_delay
+        self._stopping = False
+
+        # The protocol of each worker, or None while it's restarting
+        self._protocols = []
+        self._worker_by_client_id = {}
+        self._room_by_client_id = {}
+        self._request_ids = itertools.count()
+        self._pending_requests = {}
+
+        # The clients that the workers have reported joining over UDP
+        self._udp_client_ids = set()
+
+    def start(self):
+        """Starts the worker processes."""
+        for index in range(self._workers):
+            self._protocols.append(self._spawn_worker(index))
+
+        self._reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def _spawn_worker(self, index):
+        port = self._base_port + index
+        worker_protocol = MediaWorkerProtocol(self, index)
+        self._reactor.spawnProcess(
+            worker_protocol,
+            sys.executable,
+            [sys.executable, "-m", "singtserver.media_worker",
+             "--port", str(port),
+             "--codec-workers", str(self._codec_workers),
+             "--sample-rate", str(self.audio_format.samples_per_second),
+             "--frame-duration", str(self.audio_format.frame_duration_ms)],
+            env=os.environ,
+            childFDs={0: "w", 1: "r", 2: "r", 3: "r"}
+        )
+        log.info(f"Started media worker {index} on UDP port {port}")
+        return worker_protocol
+
+    def stop(self):
+        """Stops the workers, returning a deferred that fires once
+        they have all ended."""
+        self._stopping = True
+        ds = []
+        for worker_protocol in self._protocols:
+            if worker_protocol is None:
+                continue
+            if worker_protocol.transport is not None:
+                # Closing its stdin tells the worker to stop
+                worker_protocol.transport.closeStdin()
+            ds.append(worker_protocol.ended)
+        self._protocols = []
+        return defer.gatherResults(ds)
+
+    def _worker_index(self, room):
+        if room == "default" or self._workers == 1:
+            return 0
+        return zlib.crc32(room.encode("utf-8")) % self._workers
+
+    def get_udp_port(self, room):
+        """Returns the UDP port of the worker that handles the room."""
+        return self._base_port + self._worker_index(room)
+
+    def _send(self, index, message):
+        try:
+            worker_protocol = self._protocols[index]
+        except IndexError:
+            worker_protocol = None
+        if worker_protocol is None:
+            raise Exception(
+                f"Media worker {index} is not running; failed to send "+
+                f"'{message['command']}' command"
+            )
+        worker_protocol.send(message)
+
+    def _running_workers(self):
+        """Returns the indices of the workers that aren't restarting."""
+        return [
+            index
+            for index, worker_protocol in enumerate(self._protocols)
+            if worker_protocol is not None
+        ]
+
+    def _broadcast(self, message):
+        for index in self._running_workers():
+            self._send(index, message)
+
+    def play_audio(self, filenames, gains=None, room="default"):
+        """Returns a deferred that fires once the room's worker has
+        started playing."""
+        if gains is None:
+            gains = [1 / len(filenames)] * len(filenames)
+        return self._request(self._worker_index(room), {
+            "command": "play_audio",
+            "filenames": [str(filename) for filename in filenames],
+            "gains": gains,
+            "room": room
+        })
+
+    def stop_audio(self, room="default"):
+        """Returns a deferred that fires once the room's worker has
+        stopped playing."""
+        return self._request(self._worker_index(room), {
+            "command": "stop_audio",
+            "room": room
+        })
+
+    def assign_room(self, client_id, room):
+        """Places the client in the room on the room's worker.
+
+        Returns the UDP port that the client should send its audio to.
+
+        """
+        index = self._worker_index(room)
+
+        # If the client has moved to a room on another worker, remove
+        # them from the old one, without them leaving the
+        # participants.  Clients that haven't been assigned a room
+        # send to the first worker.
+        old_index = self._worker_by_client_id.get(client_id, 0)
+        if old_index != index:
+            self._send(old_index, {
+                "command": "remove_client",
+                "client_id": client_id,
+                "leave": False
+            })
+
+        self._worker_by_client_id[client_id] = index
+        self._room_by_client_id[client_id] = room
+        self._send(index, {
+            "command": "assign_room",
+            "client_id": client_id,
+            "room": room
+        })
+        return self.get_udp_port(room)
+
+    def remove_client(self, client_id):
+        # The client may have announced to a worker before being
+        # assigned a room, so tell every worker.  Whichever worker has
+        # their connection may not be the one they joined through, so
+        # their leaving is reported here.
+        self._worker_by_client_id.pop(client_id, None)
+        self._room_by_client_id.pop(client_id, None)
+        self._broadcast({
+            "command": "remove_client",
+            "client_id": client_id,
+            "leave": False
+        })
+        if client_id in self._udp_client_ids:
+            self._udp_client_ids.discard(client_id)
+            self._participants.leave(client_id)
+
+    def _request(self, index, message):
+        """Sends a command that the worker replies to.
+
+        Returns a deferred that fires with the worker's result.
+
+        """
+        request_id = next(self._request_ids)
+        d = defer.Deferred()
+        self._pending_requests[request_id] = (index, d)
+        message["request_id"] = request_id
+        try:
+            self._send(index, message)
+        except Exception as e:
+            del self._pending_requests[request_id]
+            return defer.fail(e)
+        return d
+
+    def start_recording(self, mix_filename, participant_filename=None,
+                        room="default"):
+        """Returns a deferred that fires once the room's worker has
+        started recording."""
+        return self._request(self._worker_index(room), {
+            "command": "start_recording",
+            "mix_filename": str(mix_filename),
+            "participant_filename": participant_filename,
+            "room": room
+        })
+
+    def stop_recording(self, room="default"):
+        """Returns a deferred that fires with the filenames written."""
+        return self._request(self._worker_index(room), {
+            "command": "stop_recording",
+            "room": room
+        })
+
+    def set_monitor_gains(self, client_id, gains=None):
+        """Sets the balance of what a client hears on their worker.
+
+        Returns a deferred that fires once the worker has set it.
+
+        """
+        return self._request(self._worker_by_client_id.get(client_id, 0), {
+            "command": "set_monitor_gains",
+            "client_id": client_id,
+            "gains": gains
+        })
+
+    def get_audio_format(self, room="default"):
+        """Returns the audio format of the named room."""
+        return self._room_formats.get(room, self.audio_format)
+
+    def set_audio_format(self, audio_format, room="default"):
+        """Sets the audio format of the named room on its worker.
+
+        Returns a deferred that fires once the worker has changed the
+        format.
+
+        """
+        d = self._request(self._worker_index(room), {
+            "command": "set_audio_format",
+            "audio_format": audio_format.to_dict(),
+            "room": room
+        })
+        def on_success(result):
+            self._room_formats[room] = audio_format
+            return result
+        d.addCallback(on_success)
+        return d
+
+    def has_clients(self):
+        """Returns True if any client has been assigned a room."""
+        return len(self._worker_by_client_id) > 0
+
+    def get_levels(self):
+        """Returns a deferred that fires with every room's levels."""
+        ds = [
+            self._request(index, {"command": "get_levels"})
+            for index in self._running_workers()
+        ]
+
+        d = defer.gatherResults(ds)
+        def on_success(worker_levels):
+            # Each room is on just one worker
+            levels = {}
+            for room_levels in worker_levels:
+                levels.update(room_levels)
+            return levels
+        d.addCallback(on_success)
+        return d
+
+    def get_audio_statistics(self):
+        """Returns a deferred that fires with every worker's statistics."""
+        ds = []
+        for index in self._running_workers():
+            d = self._request(index, {"command": "get_audio_statistics"})
+            def add_port(statistics, index=index):
+                statistics["udp_port"] = self._base_port + index
+                return statistics
+            d.addCallback(add_port)
+            ds.append(d)
+
+        d = defer.gatherResults(ds)
+        def on_success(statistics):
+            return {"workers": statistics}
+        d.addCallback(on_success)
+        return d
+
+    def _process_event(self, index, json_data):
+        event = json_data["event"]
+        if event == "join_udp":
+            # A client who has already joined is announcing themselves
+            # to the worker of their new room, or to a restarted worker
+            client_id = json_data["client_id"]
+            if client_id in self._udp_client_ids:
+                return
+            self._udp_client_ids.add(client_id)
+            self._participants.join_udp(client_id)
+        elif event == "leave":
+            self._udp_client_ids.discard(json_data["client_id"])
+            self._participants.leave(json_data["client_id"])
+        elif event == "reannounce":
+            # A worker is keeping a silent client's connection, but
+            # wants to know they're still at the same address
+            self._send_reannounce_requests([json_data["client_id"]])
+        elif event == "reply":
+            _, d = self._pending_requests.pop(json_data["request_id"])
+            try:
+                error = json_data["error"]
+                d.errback(Exception(
+                    f"Media worker {index} failed: {error}"
+                ))
+            except KeyError:
+                d.callback(json_data["result"])
+        else:
+            log.warn(f"Unknown event '{event}' from media worker {index}")
+
+    def _worker_ended(self, index):
+        # Fail any requests that the worker will never answer
+        for request_id, (worker, d) in list(self._pending_requests.items()):
+            if worker == index:
+                del self._pending_requests[request_id]
+                d.errback(Exception(f"Media worker {index} ended"))
+
+        if self._stopping:
+            return
+
+        # The worker has crashed, taking its rooms with it
+        log.error(
+            f"Media worker {index} ended unexpectedly; restarting it in "+
+            f"{self._restart_delay} seconds"
+        )
+        self._protocols[index] = None
+        self._reactor.callLater(self._restart_delay, self._restart_worker,
+                                index)
+
+    def _restart_worker(self, index):
+        if self._stopping:
+            return
+        self._protocols[index] = self._spawn_worker(index)
+
+        # Restore the formats of the worker's rooms, and put its
+        # clients back in their rooms
+        for room, audio_format in self._room_formats.items():
+            if self._worker_index(room) == index:
+                d = self._request(index, {
+                    "command": "set_audio_format",
+                    "audio_format": audio_format.to_dict(),
+                    "room": room
+                })
+                def on_error(failure, room=room):
+                    log.error(
+                        f"Failed to restore the audio format of room "+
+                        f"'{room}': {failure.getErrorMessage()}"
+                    )
+                d.addErrback(on_error)
+        client_ids = [
+            client_id
+            for client_id, worker in self._worker_by_client_id.items()
+            if worker == index
+        ]
+        for client_id in client_ids:
+            self._send(index, {
+                "command": "assign_room",
+                "client_id": client_id,
+                "room": self._room_by_client_id[client_id]
+            })
+
+        # Ask the clients to announce themselves to the new worker
+        self._send_reannounce_requests(client_ids)
+
+    def _send_reannounce_requests(self, client_ids):
+        tcp_server_factory = self._context.get("tcp_server_factory")
+        if tcp_server_factory is None:
+            return
+        for client_id in client_ids:
+            tcp_protocol = tcp_server_factory.get_protocol(client_id)
+            if tcp_protocol is not None:
+                tcp_protocol.send_reannounce_request()
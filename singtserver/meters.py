@@ -0,0 +1,71 @@
+import numpy
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("meters")
+
+
+class LevelMeters:
+    """Measures the RMS and peak levels of many signals at once.
+
+    Each row of the matrices passed to measure() is a separate signal
+    (such as a source in the mixer).  The sum of squares and the peak
+    of every row are accumulated, in a couple of numpy operations,
+    until read() returns the levels since it was last called and
+    starts afresh.  So measuring every frame costs little, however
+    rarely the levels are read.
+
+    """
+    def __init__(self, capacity):
+        self._sum_squares = numpy.zeros(0)
+        self._peaks = numpy.zeros(0, dtype=numpy.float32)
+        self._samples = 0
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        """Grows the meters to the given number of signals."""
+        sum_squares = numpy.zeros(capacity)
+        peaks = numpy.zeros(capacity, dtype=numpy.float32)
+        sum_squares[:len(self._sum_squares)] = self._sum_squares
+        peaks[:len(self._peaks)] = self._peaks
+        self._sum_squares = sum_squares
+        self._peaks = peaks
+
+    def reset(self, row):
+        """Clears the levels of a new signal."""
+        self._sum_squares[row] = 0
+        self._peaks[row] = 0
+
+    def measure(self, signals):
+        """Accumulates the levels of a (signals x samples) matrix."""
+        rows = signals.shape[0]
+        self._sum_squares[:rows] += numpy.einsum("ij,ij->i", signals, signals)
+        numpy.maximum(
+            self._peaks[:rows],
+            signals.max(axis=1),
+            out=self._peaks[:rows]
+        )
+        numpy.maximum(
+            self._peaks[:rows],
+            -signals.min(axis=1),
+            out=self._peaks[:rows]
+        )
+        self._samples += signals.shape[1]
+
+    def read(self, rows):
+        """Returns the RMS and peak levels of the first rows signals.
+
+        The levels are those since the last call, and are returned as
+        a tuple of two arrays.  The meters are then cleared.
+
+        """
+        if self._samples == 0:
+            rms = numpy.zeros(rows)
+        else:
+            rms = numpy.sqrt(self._sum_squares[:rows] / self._samples)
+        peaks = self._peaks[:rows].copy()
+
+        self._sum_squares[:] = 0
+        self._peaks[:] = 0
+        self._samples = 0
+        return rms, peaks
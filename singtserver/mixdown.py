@@ -0,0 +1,155 @@
+import concurrent.futures
+import os
+
+import numpy
+import pyogg
+from twisted.internet import defer
+from twisted.internet import reactor
+
+from .playback import PlaybackMixer
+from .playback import PlaybackStream
+from .recorder import _create_writer
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("mixdown")
+
+
+def render_mixdown(filenames, gains, output_filename,
+                   samples_per_frame=960):
+    """Mixes Opus files into a single mono Opus file.
+
+    The files are mixed as they are for playback (see PlaybackMixer)
+    and written at 48 kHz.  The mix is written to a temporary file
+    that's renamed once complete, so a partly-written mixdown is never
+    served.  This runs in a process of the renderer's pool.
+
+    """
+    streams = [
+        PlaybackStream(pyogg.OpusFileStream(str(filename)), samples_per_frame)
+        for filename in filenames
+    ]
+    mixer = PlaybackMixer(streams, samples_per_frame, gains)
+
+    partial_filename = str(output_filename) + ".partial"
+    writer = _create_writer(partial_filename, 48000, 1)
+    try:
+        while True:
+            frame = mixer.read_frame()
+            if frame is None:
+                break
+            pcm_int16 = numpy.clip(frame, -1, 1) * (2**15-1)
+            writer.encode(pcm_int16.astype(numpy.int16).tobytes())
+            mixer.refill()
+    finally:
+        writer.close()
+
+    os.replace(partial_filename, output_filename)
+    return str(output_filename)
+
+
+class MixdownRenderer:
+    """Renders combinations of a track and takes into single files.
+
+    Rather than clients downloading a combination's track and each of
+    its takes, and mixing them themselves, the combination is mixed
+    down once, into the file of the combination's audio id, by a pool
+    of background processes.  As a combination's audio never changes,
+    the mixdown is reused by every later take that's recorded over the
+    same combination.
+
+    Requests to render a mixdown that's already being rendered share
+    the one render.
+
+    """
+    def __init__(self, session_files, processes=2, executor=None,
+                 call_from_thread=reactor.callFromThread):
+        self._session_files = session_files
+        self._processes = processes
+        self._executor = executor
+        self._call_from_thread = call_from_thread
+
+        # Deferreds waiting on the renders in progress, keyed by
+        # audio id
+        self._rendering = {}
+
+    def get_path(self, audio_id):
+        return self._session_files.get_audio_path(audio_id)
+
+    def has_mixdown(self, audio_id):
+        """Returns True if the audio id's mixdown has been rendered."""
+        return self.get_path(audio_id).exists()
+
+    def render(self, audio_id, filenames, gains=None):
+        """Renders the mix of the given files for the audio id.
+
+        If gains aren't given, each file is mixed at an equal share,
+        as they are for playback.  Returns a deferred that resolves to
+        the path of the mixdown, immediately if it has already been
+        rendered.
+
+        """
+        path = self.get_path(audio_id)
+        if path.exists():
+            return defer.succeed(path)
+
+        d = defer.Deferred()
+        try:
+            self._rendering[audio_id].append(d)
+            return d
+        except KeyError:
+            self._rendering[audio_id] = [d]
+
+        if gains is None:
+            gains = [1 / len(filenames)] * len(filenames)
+
+        log.info(f"Rendering mixdown of {len(filenames)} files to {path}")
+        try:
+            future = self._get_executor().submit(
+                render_mixdown,
+                [str(filename) for filename in filenames],
+                gains,
+                str(path)
+            )
+        except Exception as e:
+            self._finish(audio_id, error=e)
+            return d
+
+        def on_done(future):
+            # This is called on one of the executor's threads
+            self._call_from_thread(self._on_rendered, audio_id, path, future)
+        future.add_done_callback(on_done)
+
+        return d
+
+    def stop(self):
+        """Shuts down the pool of processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _get_executor(self):
+        # The processes are started only when they're first needed
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._processes
+            )
+            reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+        return self._executor
+
+    def _on_rendered(self, audio_id, path, future):
+        try:
+            future.result()
+        except Exception as e:
+            log.error(f"Failed to render mixdown to {path}: {e}")
+            self._finish(audio_id, error=e)
+            return
+        log.info(f"Rendered mixdown to {path}")
+        self._finish(audio_id, path=path)
+
+    def _finish(self, audio_id, path=None, error=None):
+        for d in self._rendering.pop(audio_id, []):
+            if error is None:
+                d.callback(path)
+            else:
+                d.errback(error)
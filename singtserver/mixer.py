@@ -0,0 +1,326 @@
+import heapq
+
+import numpy
+
+from .dynamics import MixBusDynamics
+from .meters import LevelMeters
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("mixer")
+
+
+class Mixer:
+    """Mixes the decoded frames of every source in a few operations.
+
+    Each source (typically a connected participant) is given a row
+    of a preallocated (sources x samples) float32 matrix.  Every tick
+    the decoded frames are written into their rows, and mix() then
+    computes the full mix along with every listener's mix-minus (the
+    full mix without their own signal) without looping over the
+    sources in Python.
+
+    Each source is also a listener, and a listener may be given their
+    own monitor mix with set_gains(): the gain at which they hear each
+    source, and the extra audio.  The gains form a (listeners x
+    sources) matrix, which by default is all ones except for a zero
+    diagonal, giving every listener their mix-minus.  While any
+    listener has gains of their own, every listener's mix is computed
+    as a single matrix product of the gain matrix and the frames.
+
+    If dynamics is True, the sources are levelled, and the mixes
+    limited and softly clipped, by a MixBusDynamics stage.  Otherwise
+    the sources are simply summed.
+
+    The levels of the sources, as they arrive, and of the combined
+    mix, as it's heard, are metered every mix(); see read_levels().
+
+    """
+    def __init__(self, samples_per_frame, capacity=64, dynamics=True):
+        self._samples_per_frame = samples_per_frame
+
+        if dynamics:
+            self._dynamics = MixBusDynamics(samples_per_frame, capacity)
+        else:
+            self._dynamics = None
+
+        self._source_meters = LevelMeters(capacity)
+        self._mix_meter = LevelMeters(1)
+
+        # Slots that have been released are reused, lowest first, so
+        # that the used rows stay packed at the top of the matrix.
+        self._free_slots = []
+        self._rows = 0
+
+        self._frames = None
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        """Allocates (or grows) the matrices to the given capacity."""
+        frames = numpy.zeros(
+            (capacity, self._samples_per_frame),
+            dtype=numpy.float32
+        )
+        in_use = numpy.zeros(capacity, dtype=bool)
+        has_signal = numpy.zeros(capacity, dtype=bool)
+        if self._frames is not None:
+            frames[:self._capacity] = self._frames
+            in_use[:self._capacity] = self._in_use
+            has_signal[:self._capacity] = self._has_signal
+
+        # The monitor mix gains, where row i gives the gain of each
+        # source, and of the extra audio, heard by the listener in
+        # slot i
+        gains = numpy.ones((capacity, capacity), dtype=numpy.float32)
+        numpy.fill_diagonal(gains, 0)
+        extra_gains = numpy.ones(capacity, dtype=numpy.float32)
+        custom_gains = numpy.zeros(capacity, dtype=bool)
+        if self._frames is not None:
+            gains[:self._capacity, :self._capacity] = self._gains
+            extra_gains[:self._capacity] = self._extra_gains
+            custom_gains[:self._capacity] = self._custom_gains
+
+        self._frames = frames
+        self._in_use = in_use
+        self._has_signal = has_signal
+        self._gains = gains
+        self._extra_gains = extra_gains
+        self._custom_gains = custom_gains
+        self._mix_groups = numpy.zeros(0, dtype=int)
+
+        # The mixes share a matrix, so that they can be processed
+        # together: row 0 is the combined mix, and row i+1 is the
+        # mix-minus of the source in slot i
+        self._outputs = numpy.zeros(
+            (capacity+1, self._samples_per_frame),
+            dtype=numpy.float32
+        )
+        self._capacity = capacity
+
+        if self._dynamics is not None:
+            self._dynamics.resize(capacity)
+        self._source_meters.resize(capacity)
+
+    @property
+    def rows(self):
+        """The number of rows currently mixed each tick."""
+        return self._rows
+
+    def add_source(self):
+        """Allocates a row for a new source and returns its slot."""
+        if len(self._free_slots) > 0:
+            slot = heapq.heappop(self._free_slots)
+        else:
+            if self._rows == self._capacity:
+                log.info(
+                    f"Growing mixer from {self._capacity} to "+
+                    f"{self._capacity*2} sources"
+                )
+                self._allocate(self._capacity * 2)
+            slot = self._rows
+            self._rows += 1
+
+        self._in_use[slot] = True
+        self._has_signal[slot] = False
+        self._frames[slot] = 0
+
+        # Everyone hears the new source, and the new listener hears
+        # the default mix
+        self._gains[:, slot] = 1
+        self.reset_gains(slot)
+        self._source_meters.reset(slot)
+
+        if self._dynamics is not None:
+            self._dynamics.reset_source(slot)
+            self._dynamics.reset_output(slot+1)
+        return slot
+
+    def remove_source(self, slot):
+        """Releases the row of a source that has left."""
+        self._in_use[slot] = False
+        self._has_signal[slot] = False
+        self._frames[slot] = 0
+
+        if slot == self._rows - 1:
+            # Trim any unused rows from the bottom of the matrix
+            while self._rows > 0 and not self._in_use[self._rows - 1]:
+                self._rows -= 1
+            self._free_slots = [s for s in self._free_slots
+                                if s < self._rows]
+            heapq.heapify(self._free_slots)
+        else:
+            heapq.heappush(self._free_slots, slot)
+
+    @property
+    def has_custom_gains(self):
+        """True if any listener has their own monitor mix."""
+        return bool(numpy.any(self._custom_gains[:self._rows]))
+
+    def set_gains(self, listener_slot, source_gains, extra_gain=1):
+        """Gives a listener their own monitor mix.
+
+        source_gains is a dictionary of the gain at which the listener
+        hears each source, keyed by the source's slot; sources that
+        aren't given are heard at unity gain, except the listener's own
+        signal, which isn't heard unless it's given.  extra_gain is the
+        gain of the extra audio passed to mix().
+
+        """
+        row = self._gains[listener_slot]
+        row[:] = 1
+        row[listener_slot] = 0
+        for source_slot, gain in source_gains.items():
+            row[source_slot] = gain
+        self._extra_gains[listener_slot] = extra_gain
+        self._custom_gains[listener_slot] = True
+
+    def reset_gains(self, listener_slot):
+        """Returns a listener to hearing their mix-minus."""
+        self._gains[listener_slot] = 1
+        self._gains[listener_slot, listener_slot] = 0
+        self._extra_gains[listener_slot] = 1
+        self._custom_gains[listener_slot] = False
+
+    @property
+    def mix_groups(self):
+        """Groups the listeners by what they heard in the last mix().
+
+        Returns an array giving, for each slot, -1 if that listener
+        heard exactly the combined mix, or otherwise a group number
+        that's shared by every listener who heard an identical mix.
+        Listeners in the same group need only have their mix encoded
+        once.
+
+        """
+        return self._mix_groups
+
+    def _group_listeners(self):
+        active = self._has_signal[:self._rows]
+        if not self.has_custom_gains:
+            # Everyone hears their mix-minus, so only those with a
+            # signal hear anything other than the combined mix
+            return numpy.where(active, numpy.arange(self._rows), -1)
+
+        # A listener's mix depends only on their gains for the sources
+        # with a signal, and for the extra audio
+        heard = numpy.concatenate(
+            (self._gains[:self._rows, :self._rows][:, active],
+             self._extra_gains[:self._rows, numpy.newaxis]),
+            axis=1
+        )
+        # Number the distinct rows.  (A dictionary of the rows' bytes
+        # is far quicker than numpy.unique() with an axis.)
+        numbers = {}
+        groups = numpy.empty(self._rows, dtype=int)
+        for slot, row in enumerate(heard):
+            groups[slot] = numbers.setdefault(row.tobytes(), len(numbers))
+        groups[numpy.all(heard == 1, axis=1)] = -1
+        return groups
+
+    def get_frame(self, slot):
+        """Returns the row into which the source's frame is written.
+
+        The row is a view into the mixer's matrix, so writing to it
+        (for example with numpy.copyto()) does not allocate.  The
+        source is taken to have a signal this tick.
+
+        """
+        self._has_signal[slot] = True
+        return self._frames[slot]
+
+    def read_frame(self, slot):
+        """Returns the source's frame for this tick, to be read only.
+
+        Unlike get_frame(), this doesn't mark the source as having a
+        signal.  A silent source's frame is all zeros.
+
+        """
+        return self._frames[slot]
+
+    def clear_frame(self, slot):
+        """Marks the source as silent for this tick."""
+        self._has_signal[slot] = False
+        self._frames[slot] = 0
+
+    def has_signal(self, slot):
+        """True if the source's frame was written this tick.
+
+        A listener whose own source has no signal hears exactly the
+        combined mix.
+
+        """
+        return self._has_signal[slot]
+
+    def mix(self, extra=None):
+        """Mixes the current frames.
+
+        extra, if given, is a frame of samples (such as the backing
+        track) that is added to everyone's mix.
+
+        Returns a tuple of the combined mix, a one-dimensional array,
+        and the matrix of the listeners' mixes, where row i is what the
+        listener in slot i should hear (by default, their mix-minus).
+        Both are views into buffers owned by the mixer and are
+        overwritten by the next call.  See also mix_groups.
+
+        """
+        frames = self._frames[:self._rows]
+        outputs = self._outputs[:self._rows+1]
+        combined = outputs[0]
+        mixes = outputs[1:]
+        custom_gains = self.has_custom_gains
+
+        # Meter the sources before they're levelled
+        self._source_meters.measure(frames)
+
+        # Level the sources
+        if self._dynamics is not None:
+            self._dynamics.process_sources(
+                frames,
+                self._has_signal[:self._rows]
+            )
+
+        # Sum all the sources for the combined mix
+        numpy.sum(frames, axis=0, out=combined)
+        if custom_gains:
+            # Compute every listener's mix as one matrix product
+            numpy.matmul(
+                self._gains[:self._rows, :self._rows],
+                frames,
+                out=mixes
+            )
+        else:
+            # Remove each listener's own signal from the sum
+            numpy.subtract(combined, frames, out=mixes)
+
+        # Mix in the additional audio
+        if extra is not None:
+            combined += extra
+            if custom_gains:
+                mixes += (
+                    self._extra_gains[:self._rows, numpy.newaxis] * extra
+                )
+            else:
+                mixes += extra
+
+        self._mix_groups = self._group_listeners()
+
+        # Keep every mix within range
+        if self._dynamics is not None:
+            self._dynamics.process_outputs(outputs)
+
+        self._mix_meter.measure(outputs[:1])
+
+        return combined, mixes
+
+    def read_levels(self):
+        """Returns the levels metered since the last call.
+
+        Returns a tuple of the sources' RMS levels and peaks, arrays
+        indexed by slot, and the combined mix's RMS level and peak.
+        The meters are then cleared.
+
+        """
+        source_rms, source_peaks = self._source_meters.read(self._rows)
+        mix_rms, mix_peaks = self._mix_meter.read(1)
+        return source_rms, source_peaks, mix_rms[0], mix_peaks[0]
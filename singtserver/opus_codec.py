@@ -0,0 +1,253 @@
+import ctypes
+
+import numpy
+from pyogg import opus
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("opus_codec")
+
+
+# Opus' application codes, keyed by the names used by PyOgg
+_applications = {
+    "voip": opus.OPUS_APPLICATION_VOIP,
+    "audio": opus.OPUS_APPLICATION_AUDIO,
+    "restricted_lowdelay": opus.OPUS_APPLICATION_RESTRICTED_LOWDELAY
+}
+
+# The largest packet Opus will produce for a single frame
+_max_bytes_per_packet = 1275
+
+
+class FloatOpusDecoder:
+    """Decodes Opus packets directly into a reusable float32 buffer.
+
+    Unlike PyOgg's OpusDecoder, which returns a fresh buffer of int16
+    samples for every packet, this calls libopus' float decoder and
+    writes into memory that is allocated once, when the decoder is
+    created.
+
+    """
+    def __init__(self, samples_per_second, channels, samples_per_frame):
+        self._channels = channels
+        self._samples_per_frame = samples_per_frame
+
+        # Create the decoder
+        error = ctypes.c_int()
+        self._decoder = opus.opus_decoder_create(
+            samples_per_second,
+            channels,
+            ctypes.pointer(error)
+        )
+        if error.value != opus.OPUS_OK:
+            raise Exception(
+                "Failed to create Opus decoder.  "+
+                f"Opus error number {error.value}."
+            )
+
+        # Create the buffer that is reused for every decoded frame,
+        # along with a pointer to it for libopus
+        self.pcm = numpy.zeros(
+            samples_per_frame * channels,
+            dtype=numpy.float32
+        )
+        self._pcm_pointer = self.pcm.ctypes.data_as(
+            ctypes.POINTER(ctypes.c_float)
+        )
+
+    def __del__(self):
+        try:
+            opus.opus_decoder_destroy(self._decoder)
+        except AttributeError:
+            pass
+
+    def _decode(self, packet, length, decode_fec):
+        result = opus.opus_decode_float(
+            self._decoder,
+            packet,
+            length,
+            self._pcm_pointer,
+            self._samples_per_frame,
+            decode_fec
+        )
+        if result < 0:
+            raise Exception(
+                "Failed to decode Opus packet.  "+
+                f"Opus error number {result}."
+            )
+        return self.pcm
+
+    def decode(self, packet):
+        """Decodes packet into the reusable buffer.
+
+        Returns the buffer, which is overwritten by the next call.
+
+        """
+        packet_pointer = ctypes.cast(
+            packet,
+            ctypes.POINTER(ctypes.c_ubyte)
+        )
+        return self._decode(packet_pointer, len(packet), 0)
+
+    def decode_missing_packet(self):
+        """Conceals a lost frame, writing into the reusable buffer."""
+        return self._decode(None, 0, 0)
+
+    def decode_fec(self, next_packet):
+        """Recovers a lost frame from the packet that follows it.
+
+        If the next packet was encoded with in-band forward error
+        correction, it carries a low-bitrate copy of the lost frame,
+        which is decoded into the reusable buffer.  Otherwise libopus
+        falls back to concealment.
+
+        """
+        packet_pointer = ctypes.cast(
+            next_packet,
+            ctypes.POINTER(ctypes.c_ubyte)
+        )
+        return self._decode(packet_pointer, len(next_packet), 1)
+
+
+class FloatOpusEncoder:
+    """Encodes float32 frames with libopus' float encoder.
+
+    The frame is clipped into a staging buffer before it is encoded,
+    so out-of-range samples saturate rather than wrapping around as
+    they did when being cast to int16.
+
+    """
+    def __init__(self, samples_per_second, channels, samples_per_frame,
+                 application="audio"):
+        self._samples_per_frame = samples_per_frame
+
+        # Create the encoder
+        error = ctypes.c_int()
+        self._encoder = opus.opus_encoder_create(
+            samples_per_second,
+            channels,
+            _applications[application],
+            ctypes.pointer(error)
+        )
+        if error.value != opus.OPUS_OK:
+            raise Exception(
+                "Failed to create Opus encoder.  "+
+                f"Opus error number {error.value}."
+            )
+
+        # Create the buffers that are reused for every frame
+        self._pcm = numpy.zeros(
+            samples_per_frame * channels,
+            dtype=numpy.float32
+        )
+        self._pcm_pointer = self._pcm.ctypes.data_as(
+            ctypes.POINTER(ctypes.c_float)
+        )
+        self._packet = (ctypes.c_ubyte * _max_bytes_per_packet)()
+
+        # The bitrate and complexity last set, so that unchanged
+        # settings aren't passed to libopus again
+        self._bitrate = None
+        self._complexity = None
+
+    def __del__(self):
+        try:
+            opus.opus_encoder_destroy(self._encoder)
+        except AttributeError:
+            pass
+
+    def _ctl(self, request, value):
+        result = opus.opus_encoder_ctl(
+            self._encoder,
+            request,
+            ctypes.c_int(value)
+        )
+        if result != opus.OPUS_OK:
+            raise Exception(
+                f"Failed to set Opus encoder option ({request}).  "+
+                f"Opus error number {result}."
+            )
+
+    def set_inband_fec(self, enabled, expected_packet_loss_percent=10):
+        """Enables or disables in-band forward error correction.
+
+        Opus only adds the redundant data when it expects loss, so the
+        expected packet loss (as a percentage) is set too.
+
+        """
+        self._ctl(opus.OPUS_SET_INBAND_FEC_REQUEST, int(enabled))
+        self._ctl(
+            opus.OPUS_SET_PACKET_LOSS_PERC_REQUEST,
+            expected_packet_loss_percent if enabled else 0
+        )
+
+    def set_bitrate(self, bits_per_second):
+        """Sets the target bitrate, in bits per second."""
+        if bits_per_second == self._bitrate:
+            return
+        self._ctl(opus.OPUS_SET_BITRATE_REQUEST, bits_per_second)
+        self._bitrate = bits_per_second
+
+    def set_complexity(self, complexity):
+        """Sets the complexity, from 0 (cheapest) to 10 (best)."""
+        if complexity == self._complexity:
+            return
+        self._ctl(opus.OPUS_SET_COMPLEXITY_REQUEST, complexity)
+        self._complexity = complexity
+
+    def set_dtx(self, enabled):
+        """Enables or disables discontinuous transmission.
+
+        With DTX, frames of silence are encoded as packets of at most
+        two bytes, which need not be sent; see is_dtx_packet().
+
+        """
+        self._ctl(opus.OPUS_SET_DTX_REQUEST, int(enabled))
+
+    def reset_state(self):
+        """Resets the encoder as if it had just been created.
+
+        The settings (bitrate, complexity, FEC and DTX) are kept, but
+        the next packet starts a fresh stream, with nothing predicted
+        from the audio encoded before.
+
+        """
+        result = opus.opus_encoder_ctl(self._encoder, opus.OPUS_RESET_STATE)
+        if result != opus.OPUS_OK:
+            raise Exception(
+                "Failed to reset Opus encoder.  "+
+                f"Opus error number {result}."
+            )
+
+    def encode(self, pcm):
+        """Encodes a frame of float samples.
+
+        Returns the encoded packet as bytes.
+
+        """
+        # Clip the samples into the staging buffer
+        numpy.clip(pcm, -1, 1, out=self._pcm)
+
+        result = opus.opus_encode_float(
+            self._encoder,
+            self._pcm_pointer,
+            self._samples_per_frame,
+            self._packet,
+            _max_bytes_per_packet
+        )
+        if result < 0:
+            raise Exception(
+                "Failed to encode Opus packet.  "+
+                f"Opus error number {result}."
+            )
+        return ctypes.string_at(self._packet, result)
+
+
+def is_dtx_packet(packet):
+    """True if the packet is a DTX (silence) packet.
+
+    libopus produces packets of two bytes or fewer when there is
+    nothing that needs to be transmitted.
+
+    """
+    return len(packet) <= 2
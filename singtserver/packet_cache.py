@@ -0,0 +1,123 @@
+from collections import OrderedDict
+
+from twisted.internet import threads
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("packet_cache")
+
+
+def encode_playback(playback, opus_encoder):
+    """Encodes the whole of a playback mix into a list of packets.
+
+    playback is anything with the read_frame() and refill() methods of
+    a PlaybackMixer.  One packet is produced per frame, including any
+    DTX packets, so that the list stays in time with the audio.
+
+    """
+    packets = []
+    while True:
+        frame = playback.read_frame()
+        if frame is None:
+            return packets
+        packets.append(opus_encoder.encode(frame))
+        playback.refill()
+
+
+class PlaybackPacketCache:
+    """A least-recently-used cache of pre-encoded playback audio.
+
+    Entries are lists of Opus packets, one per frame, keyed by
+    whatever identifies the playback (for example, its filenames and
+    gains).  Entries are built by calling encode (which must not touch
+    any shared state) on a thread, so that the reactor isn't blocked.
+    When more than max_entries are cached, the entry used least
+    recently is discarded.
+
+    """
+    def __init__(self, encode, max_entries=8,
+                 defer_to_thread=threads.deferToThread):
+        self._encode = encode
+        self._max_entries = max_entries
+        self._defer_to_thread = defer_to_thread
+        self._entries = OrderedDict()
+        self._building = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the cached packets for key, or None."""
+        try:
+            packets = self._entries[key]
+        except KeyError:
+            return None
+        self._entries.move_to_end(key)
+        return packets
+
+    def build(self, key, *args):
+        """Encodes and caches an entry, passing args to encode.
+
+        Returns a deferred that fires with the list of packets.  If the
+        entry is already being built, the same deferred is returned.
+
+        """
+        try:
+            return self._building[key]
+        except KeyError:
+            pass
+
+        log.info(f"Pre-encoding playback for {key}")
+        d = self._defer_to_thread(self._encode, *args)
+
+        def on_success(packets):
+            del self._building[key]
+            self._entries[key] = packets
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            log.info(f"Cached {len(packets)} packets of playback for {key}")
+            return packets
+
+        def on_error(failure):
+            del self._building[key]
+            log.error(
+                f"Failed to pre-encode playback for {key}: "+
+                str(failure.value)
+            )
+            return failure
+
+        self._building[key] = d
+        d.addCallbacks(on_success, on_error)
+        return d
+
+
+class CachedPlayback:
+    """Plays back a list of pre-encoded packets, one per frame.
+
+    Packets are only decoded when their audio needs to be mixed with
+    something else; otherwise they can be sent as they are.  The
+    decoder's state is therefore not continuous, but Opus decoders
+    converge again within a couple of frames.
+
+    """
+    def __init__(self, packets, opus_decoder):
+        self._packets = packets
+        self._opus_decoder = opus_decoder
+        self._index = 0
+
+    @property
+    def finished(self):
+        return self._index >= len(self._packets)
+
+    def read_packet(self):
+        """Returns the next frame's packet, or None at the end."""
+        if self.finished:
+            return None
+        packet = self._packets[self._index]
+        self._index += 1
+        return packet
+
+    def decode(self, packet):
+        """Decodes a packet into the decoder's reusable buffer."""
+        return self._opus_decoder.decode(packet)
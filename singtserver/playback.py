@@ -0,0 +1,256 @@
+import numpy
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("playback")
+
+
+class PlaybackStream:
+    """Streams decoded audio through a fixed-size ring buffer.
+
+    The stream (typically a pyogg.OpusFileStream) is read in bulk by
+    refill(), which converts the samples to mono float32 as they are
+    written into the ring buffer.  read_frame() then hands out exactly
+    one frame at a time as a view into the ring buffer, so the
+    realtime loop neither copies nor converts samples.
+
+    The ring buffer's capacity is a whole number of frames and frames
+    are always read from frame-aligned positions, so a frame never
+    wraps around the end of the buffer.
+
+    If decimation is greater than one, the stream's sample rate is
+    reduced by that factor (for example, from the 48 kHz of Opus files
+    to 16 kHz with a decimation of 3) by averaging each group of
+    samples.
+
+    """
+    def __init__(self, stream, samples_per_frame, frames_to_buffer=50,
+                 gain=1.0, decimation=1):
+        self._stream = stream
+        self._samples_per_frame = samples_per_frame
+        self._gain = gain
+        self._decimation = decimation
+
+        # Samples left over from the last buffer that didn't make a
+        # whole group for decimation
+        self._undecimated = numpy.zeros(0, dtype=numpy.float32)
+
+        # The ring buffer of preconverted samples
+        self._capacity = samples_per_frame * frames_to_buffer
+        self._ring = numpy.zeros(self._capacity, dtype=numpy.float32)
+        self._read_position = 0
+        self._write_position = 0
+        self._available = 0
+
+        # Samples read from the stream that did not yet fit into the
+        # ring buffer
+        self._pending = None
+
+        # True once the stream has been completely read
+        self._end_of_stream = False
+
+        # True from when the ring buffer falls below its low-water mark
+        # until it has been filled again
+        self._refilling = False
+
+        self.refill()
+
+    @property
+    def finished(self):
+        """True once every frame of the stream has been read."""
+        return self._end_of_stream and self._available == 0
+
+    def refill(self, low_water_mark=0.5, max_frames=None):
+        """Tops up the ring buffer from the stream.
+
+        Nothing is read unless the ring buffer is less than
+        low_water_mark full; if it is, it is filled completely.  This
+        should be called after the frame's audio has been sent, so
+        that decoding happens outside the time-critical part of the
+        tick.
+
+        If max_frames is given, reading stops once that many frames
+        have been read, and the filling carries on at the next call,
+        so that the decoding is spread over several ticks.
+
+        """
+        if self._available < self._capacity * low_water_mark:
+            self._refilling = True
+        if not self._refilling:
+            return
+
+        if max_frames is None:
+            limit = self._capacity
+        else:
+            limit = self._available + max_frames * self._samples_per_frame
+        while self._available < min(limit, self._capacity):
+            if self._pending is None:
+                if self._end_of_stream:
+                    break
+                self._pending = self._read_from_stream()
+                if self._pending is None:
+                    break
+
+            # Copy as much of the pending samples as fits
+            written = self._write(self._pending)
+            if written == len(self._pending):
+                self._pending = None
+            else:
+                self._pending = self._pending[written:]
+
+        if (self._available == self._capacity
+            or (self._end_of_stream and self._pending is None)):
+            self._refilling = False
+
+    def _read_from_stream(self):
+        """Reads the next buffer from the stream as mono float32.
+
+        At the end of the stream, returns the silence needed to pad
+        the final frame, or None if no padding is needed.
+
+        """
+        buffer_ = self._stream.get_buffer_as_array()
+
+        if buffer_ is None:
+            # We've come to the end; pad the final frame with zeros
+            self._end_of_stream = True
+            partial = self._available % self._samples_per_frame
+            if partial == 0:
+                return None
+            return numpy.zeros(
+                self._samples_per_frame - partial,
+                dtype=numpy.float32
+            )
+
+        # Convert the int16 data to mono float
+        pcm = numpy.mean(buffer_, axis=1, dtype=numpy.float32)
+        pcm *= self._gain / 2**15
+
+        if self._decimation > 1:
+            pcm = self._decimate(pcm)
+        return pcm
+
+    def _decimate(self, pcm):
+        """Reduces the sample rate by averaging groups of samples."""
+        pcm = numpy.concatenate((self._undecimated, pcm))
+        whole = len(pcm) - len(pcm) % self._decimation
+        self._undecimated = pcm[whole:]
+        return pcm[:whole].reshape(-1, self._decimation).mean(axis=1)
+
+    def _write(self, pcm):
+        """Writes samples into the ring buffer, wrapping as needed.
+
+        Returns the number of samples written.
+
+        """
+        count = min(len(pcm), self._capacity - self._available)
+        start = self._write_position
+        first = min(count, self._capacity - start)
+        self._ring[start:start+first] = pcm[:first]
+        self._ring[:count-first] = pcm[first:count]
+
+        self._write_position = (start + count) % self._capacity
+        self._available += count
+        return count
+
+    def read_frame(self):
+        """Returns the next frame, or None at the end of the stream.
+
+        The frame is a view into the ring buffer; it remains valid
+        only until the next call to refill().
+
+        """
+        if self._available < self._samples_per_frame:
+            # We've run dry; read synchronously rather than skip
+            self.refill(low_water_mark=1)
+            if self._available < self._samples_per_frame:
+                return None
+
+        start = self._read_position
+        frame = self._ring[start:start+self._samples_per_frame]
+        self._read_position = (
+            (start + self._samples_per_frame) % self._capacity
+        )
+        self._available -= self._samples_per_frame
+        return frame
+
+
+class PlaybackMixer:
+    """Plays several streams at once, mixing them with per-stream gain.
+
+    Every tick, one frame is read from each stream in lockstep into a
+    shared (streams x samples) block, which is then reduced to a
+    single frame with one matrix-vector product against the gains.
+    Streams of different lengths are supported; a stream that has
+    finished contributes silence until every stream has finished.
+
+    The streams are read in lockstep, so they all run low on the same
+    tick.  Rather than each then decoding half its ring buffer in that
+    one tick, each stream reads at most frames_per_refill frames per
+    refill(), which keeps the decoding done every tick to a bounded
+    multiple of what's played.
+
+    """
+    def __init__(self, streams, samples_per_frame, gains=None,
+                 frames_per_refill=2):
+        self._streams = list(streams)
+        self._frames_per_refill = frames_per_refill
+        count = len(self._streams)
+
+        if gains is None:
+            gains = [1.0] * count
+        if len(gains) != count:
+            raise Exception(
+                f"Expected {count} gains, one for each stream, "+
+                f"but was given {len(gains)}"
+            )
+        self._gains = numpy.array(gains, dtype=numpy.float32)
+
+        self._block = numpy.zeros(
+            (count, samples_per_frame),
+            dtype=numpy.float32
+        )
+        self._mix = numpy.zeros(samples_per_frame, dtype=numpy.float32)
+        self._playing = [True] * count
+
+    @property
+    def finished(self):
+        """True once every stream has finished."""
+        return not any(self._playing)
+
+    def set_gain(self, index, gain):
+        """Sets the gain of the stream at the given index."""
+        self._gains[index] = gain
+
+    def refill(self):
+        """Tops up the ring buffer of every stream still playing."""
+        for stream, playing in zip(self._streams, self._playing):
+            if playing:
+                stream.refill(max_frames=self._frames_per_refill)
+
+    def read_frame(self):
+        """Returns the next mixed frame, or None once all have finished.
+
+        The frame is a buffer owned by the mixer and is overwritten by
+        the next call.
+
+        """
+        if self.finished:
+            return None
+
+        for index, stream in enumerate(self._streams):
+            if not self._playing[index]:
+                continue
+            frame = stream.read_frame()
+            if frame is None:
+                # This stream has finished; it now contributes silence
+                self._playing[index] = False
+                self._block[index] = 0
+            else:
+                self._block[index] = frame
+
+        if self.finished:
+            return None
+
+        numpy.dot(self._gains, self._block, out=self._mix)
+        return self._mix
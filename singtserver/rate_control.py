@@ -0,0 +1,87 @@
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("rate_control")
+
+
+class BitrateController:
+    """Chooses the bitrate of a connection's audio from its packet loss.
+
+    update() is given the proportion of the client's packets that were
+    lost, and that arrived too late to be played, as measured by their
+    jitter buffer.  When more than congested_rate of packets are
+    missing, the link is taken to be congested and the bitrate is cut
+    by the factor decrease; when fewer than clear_rate are missing, the
+    bitrate rises by step.  In between, it's held.  This additive
+    increase and multiplicative decrease backs off quickly and probes
+    back up gently, within [min_bitrate, max_bitrate].
+
+    """
+    def __init__(self, min_bitrate=16000, max_bitrate=96000,
+                 initial_bitrate=64000, step=8000, decrease=0.75,
+                 congested_rate=0.05, clear_rate=0.01):
+        self._min_bitrate = min_bitrate
+        self._max_bitrate = max_bitrate
+        self._step = step
+        self._decrease = decrease
+        self._congested_rate = congested_rate
+        self._clear_rate = clear_rate
+        self._bitrate = min(max(initial_bitrate, min_bitrate), max_bitrate)
+
+    @property
+    def bitrate(self):
+        """The current bitrate in bits per second."""
+        return self._bitrate
+
+    def update(self, loss_rate, late_rate):
+        """Updates and returns the bitrate."""
+        missing_rate = loss_rate + late_rate
+        if missing_rate > self._congested_rate:
+            bitrate = int(self._bitrate * self._decrease)
+        elif missing_rate < self._clear_rate:
+            bitrate = self._bitrate + self._step
+        else:
+            bitrate = self._bitrate
+        self._bitrate = min(max(bitrate, self._min_bitrate), self._max_bitrate)
+        return self._bitrate
+
+
+class ComplexityController:
+    """Chooses the encoders' complexity from the host's CPU headroom.
+
+    Headroom is the fraction of the host's time that isn't spent
+    processing audio frames (see UDPServer.get_cpu_headroom()).  When
+    it falls below low_headroom, the encoders' complexity is reduced
+    by one, shedding CPU; once it rises above high_headroom, the
+    complexity is raised by one, back towards full quality.  Complexity
+    is Opus' 0 to 10 scale.
+
+    """
+    def __init__(self, min_complexity=2, max_complexity=10,
+                 low_headroom=0.25, high_headroom=0.5):
+        self._min_complexity = min_complexity
+        self._max_complexity = max_complexity
+        self._low_headroom = low_headroom
+        self._high_headroom = high_headroom
+        self._complexity = max_complexity
+
+    @property
+    def complexity(self):
+        return self._complexity
+
+    def update(self, headroom):
+        """Updates and returns the complexity."""
+        if headroom < self._low_headroom:
+            complexity = self._complexity - 1
+        elif headroom > self._high_headroom:
+            complexity = self._complexity + 1
+        else:
+            complexity = self._complexity
+        complexity = min(max(complexity, self._min_complexity),
+                         self._max_complexity)
+        if complexity != self._complexity:
+            log.info(
+                f"CPU headroom is {round(headroom*100)}%; changing "+
+                f"encoder complexity from {self._complexity} to {complexity}"
+            )
+        self._complexity = complexity
+        return self._complexity
@@ -0,0 +1,161 @@
+import queue
+import threading
+
+import numpy
+from pyogg import OggOpusWriter
+from twisted.internet import defer
+from twisted.internet import reactor
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("recorder")
+
+
+def _create_writer(filename, samples_per_second, channels):
+    ogg_opus_writer = OggOpusWriter(str(filename))
+    ogg_opus_writer.set_application("audio")
+    ogg_opus_writer.set_sampling_frequency(samples_per_second)
+    ogg_opus_writer.set_channels(channels)
+    return ogg_opus_writer
+
+
+class Recorder:
+    """Records frames of audio to Ogg Opus files on a writer thread.
+
+    record() is called on the realtime thread once per frame for each
+    source being recorded, and next_frame() once every source's frame
+    has been recorded.  record() copies the frame into a bounded queue
+    without ever waiting: if the writer has fallen so far behind that
+    the queue is full, the frame is dropped and counted instead.  The
+    writer thread takes frames from the queue, encodes them, and writes
+    them to the file for their source, which is given by
+    get_filename(source) and opened when the source's first frame
+    arrives.
+
+    Every file starts at the start of the recording: a source's audio
+    is preceded by silence up to its first frame, and frames that it
+    missed (or that were dropped) are filled with silence, so that the
+    files line up with one another.
+
+    """
+    def __init__(self, get_filename, samples_per_second, channels,
+                 queue_size=500, create_writer=_create_writer):
+        self._get_filename = get_filename
+        self._samples_per_second = samples_per_second
+        self._channels = channels
+        self._create_writer = create_writer
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writers = {}
+        self._frame_index = 0
+        self._frames_recorded = 0
+        self._frames_dropped = 0
+        self._stop_requested = threading.Event()
+        self._stopped = defer.Deferred()
+
+        self._thread = threading.Thread(
+            target=self._write,
+            name="recorder",
+            daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def frames_dropped(self):
+        return self._frames_dropped
+
+    def record(self, source, pcm):
+        """Queues a frame of float samples for the source's file."""
+        try:
+            self._queue.put_nowait((source, self._frame_index, pcm.copy()))
+            self._frames_recorded += 1
+        except queue.Full:
+            self._frames_dropped += 1
+            if self._frames_dropped == 1:
+                log.warn("Recorder's queue is full; dropping frames")
+
+    def next_frame(self):
+        """Moves on to the next frame of the recording."""
+        self._frame_index += 1
+
+    def stop(self):
+        """Stops recording once the queued frames have been written.
+
+        Returns a deferred that fires with a dictionary of the
+        filenames written, keyed by source, once the files have been
+        closed.  Like record(), this never waits.
+
+        """
+        # Wake the writer if it's waiting for frames.  If the queue is
+        # full, the writer will see the request once it's emptied it.
+        self._stop_requested.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        return self._stopped
+
+    def _write(self):
+        """The writer thread's loop."""
+        filenames = {}
+        next_frame_indices = {}
+        error = None
+        while True:
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop_requested.is_set():
+                    break
+                continue
+            if item is None:
+                break
+            if error is not None:
+                # Keep emptying the queue until we're stopped
+                continue
+            source, frame_index, pcm = item
+            try:
+                try:
+                    writer = self._writers[source]
+                except KeyError:
+                    filename = self._get_filename(source)
+                    log.info(f"Recording '{source}' to {filename}")
+                    writer = self._create_writer(
+                        filename,
+                        self._samples_per_second,
+                        self._channels
+                    )
+                    self._writers[source] = writer
+                    filenames[source] = filename
+                    next_frame_indices[source] = 0
+
+                # Fill any frames that the source is missing with
+                # silence
+                if next_frame_indices[source] < frame_index:
+                    silence = numpy.zeros(len(pcm), numpy.int16).tobytes()
+                    for _ in range(frame_index - next_frame_indices[source]):
+                        writer.encode(silence)
+                next_frame_indices[source] = frame_index + 1
+
+                pcm_int16 = numpy.clip(pcm, -1, 1) * (2**15-1)
+                writer.encode(pcm_int16.astype(numpy.int16).tobytes())
+            except Exception as e:
+                error = e
+
+        for writer in self._writers.values():
+            try:
+                writer.close()
+            except Exception as e:
+                if error is None:
+                    error = e
+
+        if error is not None:
+            reactor.callFromThread(
+                self._stopped.errback,
+                Exception(f"Failed to write recording: {error}")
+            )
+        else:
+            log.info(
+                f"Finished recording {self._frames_recorded} frames "+
+                f"({self._frames_dropped} dropped)"
+            )
+            reactor.callFromThread(self._stopped.callback, filenames)
@@ -0,0 +1,673 @@
+import numpy
+from twisted.internet import reactor
+from twisted.logger import Logger
+
+from .audio_clock import AudioClock
+from .forwarding import PLAYBACK_SOURCE_ID
+from .forwarding import SpeakerSelector
+from .forwarding import pack_bundle
+from .mixer import Mixer
+from .opus_codec import is_dtx_packet
+from .packet_cache import CachedPlayback
+from .recorder import Recorder
+
+# Start a logger with a namespace for a particular subsystem of our application.
+log = Logger("room")
+
+
+class Room:
+    """A group of participants who hear one another.
+
+    Each room has its own connections, mixer, playback and audio
+    clock, so the work done every frame grows with the size of the
+    room rather than with the number of people on the server.  The
+    room uses the server's codec workers, packet cache and audio
+    format.
+
+    overload_policy decides what happens to frames that were missed
+    because the server fell behind.  With "skip", their input is
+    discarded so that everything stays in time.  With "conceal", their
+    input is still decoded, keeping the decoders' state continuous, but
+    nothing is mixed or sent; clients conceal the gap.
+
+    Incoming DTX packets, the gaps that follow them, and connections
+    that have sent nothing for more than concealment_limit frames, are
+    treated as silence without being decoded.  Other missing packets
+    are recovered from the next packet's FEC data if it has arrived,
+    or concealed.
+
+    With mode "mix", the room decodes and mixes everyone's audio.
+    With mode "forward", it acts as a selective forwarding unit: each
+    frame, the forward_speakers most active speakers are chosen from
+    their packet sizes, and their packets are relayed unchanged, along
+    with the encoded playback audio, in a single bundle (see
+    forwarding.pack_bundle()) to each listener, who does the final mix.
+
+    In mix mode, the room's combined mix (and optionally each
+    participant's decoded audio) can be recorded; see
+    start_recording().
+
+    In mix mode, each listener may be given their own monitor mix; see
+    set_monitor_gains().
+
+    Listeners who hear the combined mix share one encoder, while a
+    singer's mix is encoded with their own.  Singers pause between
+    phrases, so a listener who stops singing keeps their own encoder
+    for encoder_hold frames before moving to the shared one; this
+    keeps the encoder behind their stream (and so its prediction
+    state) from changing with every breath.  An encoder that takes
+    over a listener's stream is reset first.
+
+    The room's audio is in the given AudioFormat, which its clock,
+    mixer, codecs, playback and recordings all follow.  Connections
+    must be in the same format before they're added.
+
+    """
+    def __init__(self, name, udp_server, audio_format,
+                 overload_policy="skip", mode="mix", forward_speakers=3,
+                 concealment_limit=5, encoder_hold=50):
+        self.name = name
+        self.audio_format = audio_format
+        self._udp_server = udp_server
+        self._samples_per_frame = audio_format.samples_per_frame
+        self._codec_workers = udp_server.codec_workers
+        self._packet_cache = udp_server.packet_cache
+        self._concealment_limit = concealment_limit
+        self._encoder_hold = encoder_hold
+
+        self._connections = {}
+        self._mixer = Mixer(self._samples_per_frame)
+
+        self._stream = None
+        self._cached_stream = None
+        self._recorder = None
+        self._record_participants = False
+
+        # Listeners who aren't singing all hear the combined mix, so
+        # it is encoded just once for all of them
+        self._shared_encoder = udp_server.create_encoder(audio_format)
+
+        # A decoder for when pre-encoded playback needs to be mixed
+        self._playback_decoder = udp_server.create_decoder(audio_format)
+
+        # Whether we mix everyone's audio or forward the packets of
+        # the most active speakers
+        if mode not in ["mix", "forward"]:
+            raise Exception(f"Unknown mode '{mode}'")
+        self._mode = mode
+        self._speaker_selector = SpeakerSelector(forward_speakers)
+
+        # The clock that drives the processing of audio frames
+        if overload_policy not in ["skip", "conceal"]:
+            raise Exception(f"Unknown overload policy '{overload_policy}'")
+        self._overload_policy = overload_policy
+        self._audio_clock = AudioClock(
+            reactor,
+            audio_format.frame_duration,
+            self.process_audio_frame,
+            self._process_missed_audio_frames,
+            is_idle=self.is_idle
+        )
+
+    def add_connection(self, connection):
+        """Adds a connection to the room, allocating it a mixer row."""
+        client_id = connection["client_id"]
+        log.info(f"Client id {client_id} joined room '{self.name}'")
+        connection["mixer_slot"] = self._mixer.add_source()
+        connection["room"] = self
+        self._connections[client_id] = connection
+
+        # The connection starts by hearing the combined mix, from the
+        # shared encoder
+        connection["encoder_hold"] = 0
+        connection["encoder_active"] = False
+
+        # Ensure audio is being processed
+        self._audio_clock.wake()
+
+    def remove_connection(self, client_id):
+        """Removes a connection from the room, releasing its mixer row."""
+        log.info(f"Client id {client_id} left room '{self.name}'")
+        connection = self._connections.pop(client_id)
+        self._mixer.remove_source(connection["mixer_slot"])
+        self._speaker_selector.remove(client_id)
+        connection["mixer_slot"] = None
+        connection["room"] = None
+        return connection
+
+    def set_monitor_gains(self, client_id, gains=None):
+        """Sets the balance of what a listener hears.
+
+        gains is a dictionary of the gain at which the listener hears
+        each participant, keyed by client id, and optionally the gain
+        of the playback audio, keyed by "playback".  Participants who
+        aren't given are heard at unity gain, except the listener
+        themselves.  If gains is None, the listener goes back to
+        hearing everyone else equally.
+
+        """
+        if self._mode != "mix":
+            raise Exception(
+                f"Monitor mixes require mode 'mix', but room "+
+                f"'{self.name}' is in mode '{self._mode}'"
+            )
+        try:
+            listener_slot = self._connections[client_id]["mixer_slot"]
+        except KeyError:
+            raise Exception(
+                f"Client id {client_id} is not in room '{self.name}'"
+            )
+
+        if gains is None:
+            log.info(f"Resetting monitor mix of client id {client_id}")
+            self._mixer.reset_gains(listener_slot)
+            return
+
+        gains = dict(gains)
+        playback_gain = gains.pop("playback", 1)
+        source_gains = {}
+        for source_client_id, gain in gains.items():
+            try:
+                connection = self._connections[int(source_client_id)]
+            except KeyError:
+                raise Exception(
+                    f"Client id {source_client_id} is not in room "+
+                    f"'{self.name}'"
+                )
+            source_gains[connection["mixer_slot"]] = float(gain)
+        log.info(f"Setting monitor mix of client id {client_id}: {gains}")
+        self._mixer.set_gains(
+            listener_slot,
+            source_gains,
+            extra_gain=float(playback_gain)
+        )
+
+    def play_audio(self, filenames, gains=None):
+        """Plays the given Opus files simultaneously to the room.
+
+        gains optionally gives the gain of each file.  By default the
+        files share the full volume; the mixer's limiter keeps the
+        mix within range.
+
+        """
+        # TODO: Check that we're not currently playing anything else
+        log.info(
+            f"Playing these filenames in room '{self.name}': "+
+            str(filenames)
+        )
+        if len(filenames) == 0:
+            raise Exception("At least one filename is required for playback")
+
+        if gains is None:
+            gains = [1 / len(filenames)] * len(filenames)
+
+        # If we've already encoded this playback in our format, send
+        # the cached packets
+        key = (tuple(str(filename) for filename in filenames),
+               tuple(gains),
+               self.audio_format)
+        packets = self._packet_cache.get(key)
+        if packets is not None:
+            log.info("Playing pre-encoded packets from the cache")
+            self._stream = None
+            self._cached_stream = CachedPlayback(
+                packets,
+                self._playback_decoder
+            )
+        else:
+            # Play the files directly, while encoding them in the
+            # background for next time
+            self._stream = self._udp_server.open_playback(
+                filenames,
+                gains,
+                self.audio_format
+            )
+            self._cached_stream = None
+            self._packet_cache.build(key, filenames, gains, self.audio_format)
+
+        # Ensure audio is being processed
+        self._audio_clock.wake()
+
+    def stop_audio(self):
+        # TODO: It would be much nicer if this faded out
+        self._stream = None
+        self._cached_stream = None
+
+    def start_recording(self, mix_filename, participant_filename=None):
+        """Starts recording what the room hears.
+
+        The combined mix is written to mix_filename.  If
+        participant_filename is given, each participant's decoded audio
+        (as it arrived, before it was levelled for the mix) is also
+        written to participant_filename formatted with their
+        client_id.  Every file starts when the recording does.  The
+        files are written by a Recorder, off the realtime thread.
+
+        """
+        if self._mode != "mix":
+            raise Exception(
+                f"Recording requires mode 'mix', but room '{self.name}' "+
+                f"is in mode '{self._mode}'"
+            )
+        if self._recorder is not None:
+            raise Exception(f"Room '{self.name}' is already recording")
+
+        def get_filename(source):
+            if source == "mix":
+                return mix_filename
+            return participant_filename.format(client_id=source)
+
+        log.info(f"Starting to record room '{self.name}'")
+        self._recorder = Recorder(
+            get_filename,
+            self.audio_format.samples_per_second,
+            self.audio_format.channels
+        )
+        self._record_participants = participant_filename is not None
+
+    def stop_recording(self):
+        """Stops recording.
+
+        Returns a deferred that fires with the filenames written, keyed
+        by "mix" or client id, once they've been closed.
+
+        """
+        if self._recorder is None:
+            raise Exception(f"Room '{self.name}' is not recording")
+        log.info(f"Stopping recording of room '{self.name}'")
+        recorder = self._recorder
+        self._recorder = None
+        return recorder.stop()
+
+    def process_audio_frame(self):
+        connections = list(self._connections.values())
+
+        # For each jitter buffer, get the next packet
+        self._get_packets(connections)
+
+        if self._mode == "forward":
+            self._forward_audio_frame(connections)
+            return
+
+        # Decode the packets into the mixer, in parallel
+        self._codec_workers.run(self._decode, connections)
+
+        # Get the next frame of playback audio.  If it's been
+        # pre-encoded and no one is singing (and we're not recording,
+        # and no one has their own monitor mix), it doesn't need
+        # decoding.
+        singing = any(
+            self._mixer.has_signal(connection["mixer_slot"])
+            for connection in connections
+        )
+        recording = self._recorder is not None
+        custom_gains = self._mixer.has_custom_gains
+        pcm_float, playback_packet = self._read_playback(
+            decode=singing or recording or custom_gains
+        )
+
+        # Hand the participants' audio to the recorder, which never
+        # blocks, before the mixer levels it
+        if recording and self._record_participants:
+            for connection in connections:
+                self._recorder.record(
+                    connection["client_id"],
+                    self._mixer.read_frame(connection["mixer_slot"])
+                )
+
+        # Mix all the participants together with the playback audio,
+        # obtaining each listener's mix
+        combined_pcm, mixes = self._mixer.mix(pcm_float)
+
+        # ...and what the room heard
+        if recording:
+            self._recorder.record("mix", combined_pcm)
+            self._recorder.next_frame()
+
+        # Group the listeners by what they hear, as decided by the
+        # mixer: usually everyone who isn't singing hears the combined
+        # mix, while each singer hears their own mix-minus, but
+        # listeners with the same monitor mix also share a group.
+        # Someone who has just stopped singing is kept in a group of
+        # their own for encoder_hold frames, in case they start again.
+        shared_group = {
+            "opus_encoder": self._shared_encoder,
+            "reset_encoder": False,
+            "pcm": combined_pcm,
+            "connections": []
+        }
+        groups = [shared_group]
+        groups_by_key = {}
+        mix_groups = self._mixer.mix_groups
+        for connection in connections:
+            mixer_slot = connection["mixer_slot"]
+            group_number = mix_groups[mixer_slot]
+            if group_number >= 0:
+                connection["encoder_hold"] = self._encoder_hold
+                key = group_number
+            elif connection["encoder_hold"] > 0:
+                connection["encoder_hold"] -= 1
+                key = ("held", mixer_slot)
+            else:
+                shared_group["connections"].append(connection)
+                connection["encoder_active"] = False
+                continue
+            try:
+                groups_by_key[key]["connections"].append(connection)
+            except KeyError:
+                group = {
+                    "pcm": mixes[mixer_slot],
+                    "connections": [connection]
+                }
+                groups_by_key[key] = group
+                groups.append(group)
+        if len(shared_group["connections"]) == 0:
+            groups.pop(0)
+
+        # Every other group's mix is encoded with one of its
+        # listeners' encoders, preferably one that encoded that
+        # listener's previous frame, so the encoders stay with their
+        # streams.  An encoder that didn't is reset.
+        for group in groups_by_key.values():
+            owner = group["connections"][0]
+            for connection in group["connections"]:
+                if connection["encoder_active"]:
+                    owner = connection
+                    break
+            group["opus_encoder"] = owner["opus_encoder"]
+            group["reset_encoder"] = not owner["encoder_active"]
+            for connection in group["connections"]:
+                connection["encoder_active"] = connection is owner
+
+        # Encode each group's mix just once, in parallel.  If the
+        # only thing anyone can hear is pre-encoded playback, send its
+        # packet as it is.
+        if not singing and not custom_gains and playback_packet is not None:
+            for group in groups:
+                group["encoded_packet"] = playback_packet
+            for connection in connections:
+                connection["encoder_active"] = False
+        else:
+            self._codec_workers.run(self._encode, groups)
+
+        # Send each group's encoded packet to all its listeners.  DTX
+        # packets aren't sent; clients conceal the silence.
+        for group in groups:
+            encoded_packet = group["encoded_packet"]
+            if encoded_packet is None or is_dtx_packet(encoded_packet):
+                continue
+            for connection in group["connections"]:
+                connection["udp_packetizer"].write(encoded_packet)
+
+        # Now that the frame has been sent, read ahead in the
+        # playback stream
+        if self._stream is not None:
+            self._stream.refill()
+
+    def _forward_audio_frame(self, connections):
+        """Relays the most active speakers' packets to every listener.
+
+        Each listener is sent one bundle holding the playback audio and
+        the selected speakers' packets, excluding their own.  Everyone
+        who wasn't selected receives the same bundle.
+
+        """
+        # Choose which speakers to forward
+        selected = self._speaker_selector.select([
+            (connection["client_id"], connection["encoded_packet"])
+            for connection in connections
+        ])
+
+        # Encode the playback audio just once, unless it's already
+        # been encoded
+        pcm_float, encoded_packet = self._read_playback(decode=False)
+        if pcm_float is not None:
+            encoded_packet = self._shared_encoder.encode(pcm_float)
+        if encoded_packet is not None and not is_dtx_packet(encoded_packet):
+            selected.insert(0, (PLAYBACK_SOURCE_ID, encoded_packet))
+
+        if len(selected) > 0:
+            shared_bundle = pack_bundle(selected)
+            speakers = set(source_id for source_id, _ in selected)
+            for connection in connections:
+                client_id = connection["client_id"]
+                if client_id in speakers:
+                    others = [
+                        (source_id, packet)
+                        for source_id, packet in selected
+                        if source_id != client_id
+                    ]
+                    if len(others) == 0:
+                        # There's nothing for them to hear
+                        continue
+                    bundle = pack_bundle(others)
+                else:
+                    bundle = shared_bundle
+                connection["udp_packetizer"].write(bundle)
+
+        # Now that the frame has been sent, read ahead in the
+        # playback stream
+        if self._stream is not None:
+            self._stream.refill()
+
+    def _process_missed_audio_frames(self, count):
+        """Applies the overload policy to frames that were missed."""
+        connections = list(self._connections.values())
+
+        for _ in range(count):
+            # Take the missed frame's packet from each jitter buffer
+            self._get_packets(connections)
+
+            if self._overload_policy == "conceal" and self._mode == "mix":
+                # Keep the decoders' state continuous
+                self._codec_workers.run(self._decode, connections)
+
+            # Keep the playback in time
+            self._read_playback(decode=False)
+
+            # ...and the recording, which fills the gap with silence
+            if self._recorder is not None:
+                self._recorder.next_frame()
+
+    def _get_packets(self, connections):
+        """Takes this frame's packet from each jitter buffer.
+
+        If the packet is missing, the packet that follows it (if it
+        has arrived) is kept for its FEC data.
+
+        """
+        for connection in connections:
+            jitter_buffer = connection["jitter_buffer"]
+            encoded_packet = jitter_buffer.get_packet()
+            connection["encoded_packet"] = encoded_packet
+            if encoded_packet is None:
+                connection["fec_packet"] = jitter_buffer.peek_packet()
+            else:
+                connection["fec_packet"] = None
+
+    def _read_playback(self, decode=True):
+        """Returns the next frame of playback audio.
+
+        Returns a tuple of the frame's samples and its pre-encoded
+        packet.  The packet is None unless the playback was cached, in
+        which case the samples are None unless decode is True.  Both
+        are None if nothing is playing.
+
+        """
+        if self._cached_stream is not None:
+            packet = self._cached_stream.read_packet()
+            if packet is None:
+                # We've come to the end
+                self._cached_stream = None
+                return None, None
+            if decode:
+                return self._cached_stream.decode(packet), packet
+            return None, packet
+
+        if self._stream is None:
+            return None, None
+        pcm_float = self._stream.read_frame()
+        if pcm_float is None:
+            # We've come to the end
+            self._stream = None
+        return pcm_float, None
+
+    def is_idle(self):
+        """True if there is no one to send audio to, nothing to play
+        and nothing being recorded."""
+        return (len(self._connections) == 0
+                and self._stream is None
+                and self._cached_stream is None
+                and self._recorder is None)
+
+    def stop(self):
+        """Stops the room's audio clock."""
+        self._audio_clock.stop()
+
+    def get_levels(self):
+        """Returns the levels metered since the last call.
+
+        Returns a dictionary of the RMS level and peak, as a list of
+        two floats, of the combined mix (keyed by "mix") and of each
+        participant's audio (keyed by "participants" and then client
+        id, as a string).  Rooms in forward mode don't decode the
+        audio, so return None.
+
+        """
+        if self._mode != "mix":
+            return None
+        source_rms, source_peaks, mix_rms, mix_peak = \
+            self._mixer.read_levels()
+        return {
+            "mix": [round(float(mix_rms), 4), round(float(mix_peak), 4)],
+            "participants": {
+                str(client_id): [
+                    round(float(source_rms[connection["mixer_slot"]]), 4),
+                    round(float(source_peaks[connection["mixer_slot"]]), 4)
+                ]
+                for client_id, connection in self._connections.items()
+            }
+        }
+
+    def get_load(self):
+        """The fraction of the host's time spent on the room's frames."""
+        return self._audio_clock.load
+
+    def control_rates(self, complexity):
+        """Adapts the room's encoders to their listeners' links.
+
+        Each connection's bitrate is updated from the loss and
+        lateness of the packets in its jitter buffer (see
+        BitrateController), and every encoder is given the complexity.
+        The shared encoder is heard by everyone who isn't singing, so
+        it uses the lowest of their bitrates.
+
+        """
+        bitrates = []
+        for connection in self._connections.values():
+            jitter_buffer = connection["jitter_buffer"]
+            bitrate = connection["bitrate_controller"].update(
+                jitter_buffer.loss_rate,
+                jitter_buffer.late_rate
+            )
+            bitrates.append(bitrate)
+            opus_encoder = connection["opus_encoder"]
+            opus_encoder.set_bitrate(bitrate)
+            opus_encoder.set_complexity(complexity)
+
+        if len(bitrates) > 0:
+            self._shared_encoder.set_bitrate(min(bitrates))
+        self._shared_encoder.set_complexity(complexity)
+
+    def get_statistics(self):
+        """Returns the room's audio clock's lateness statistics.
+
+        Also includes the state of each connection's jitter buffer,
+        keyed by client id (as a string, as Javascript cannot handle
+        64-bit ints).
+
+        """
+        statistics = self._audio_clock.get_statistics()
+        statistics["mode"] = self._mode
+        statistics["audio_format"] = self.audio_format.to_dict()
+        statistics["recording"] = self._recorder is not None
+        if self._recorder is not None:
+            statistics["recorder_frames_dropped"] = \
+                self._recorder.frames_dropped
+        statistics["connections"] = len(self._connections)
+        statistics["load"] = self.get_load()
+        statistics["jitter_buffers"] = {
+            str(client_id): connection["jitter_buffer"].get_statistics()
+            for client_id, connection in self._connections.items()
+        }
+        statistics["bitrates"] = {
+            str(client_id): connection["bitrate_controller"].bitrate
+            for client_id, connection in self._connections.items()
+        }
+        return statistics
+
+    def _encode(self, group):
+        """Encodes the mix heard by a group of listeners.
+
+        This may be called from one of the codec worker threads.
+
+        """
+        opus_encoder = group["opus_encoder"]
+        if group["reset_encoder"]:
+            # The encoder is taking over a stream, so mustn't predict
+            # from whatever it encoded before
+            opus_encoder.reset_state()
+        group["encoded_packet"] = opus_encoder.encode(group["pcm"])
+
+    def _decode(self, connection):
+        """Decodes the connection's packet into its row of the mixer.
+
+        This may be called from one of the codec worker threads.  It
+        touches only the given connection and its row of the mixer.
+
+        """
+        encoded_packet = connection["encoded_packet"]
+        mixer_slot = connection["mixer_slot"]
+        opus_decoder = connection["opus_decoder"]
+
+        # Decode encoded packet to PCM
+        if encoded_packet is None:
+            connection["missing_packets"] += 1
+            fec_packet = connection["fec_packet"]
+            if not connection["started"]:
+                # We haven't started yet, so ignore this connection
+                pcm = None
+            elif connection["dtx"]:
+                # The client stopped sending after a DTX packet, so
+                # they're silent rather than lost
+                pcm = None
+            elif connection["missing_packets"] > self._concealment_limit:
+                # The client has stopped sending (most likely because
+                # it's using DTX), so treat it as silent
+                pcm = None
+            elif fec_packet is not None and not is_dtx_packet(fec_packet):
+                # We've lost a packet, but the next one has arrived;
+                # recover the lost frame from its FEC data
+                pcm = opus_decoder.decode_fec(fec_packet)
+            else:
+                # We've lost a packet, so conceal it
+                pcm = opus_decoder.decode_missing_packet()
+        elif is_dtx_packet(encoded_packet):
+            # The client is silent; there's nothing worth decoding
+            connection["missing_packets"] = 0
+            connection["started"] = True
+            connection["dtx"] = True
+            pcm = None
+        else:
+            # We've got a valid packet, decode it
+            pcm = opus_decoder.decode(encoded_packet)
+            connection["missing_packets"] = 0
+            connection["started"] = True
+            connection["dtx"] = False
+
+        # Copy the decoded PCM into the mixer
+        if pcm is None:
+            self._mixer.clear_frame(mixer_slot)
+        else:
+            frame = self._mixer.get_frame(mixer_slot)
+            numpy.copyto(frame, pcm)
@@ -14,11 +14,13 @@ from twisted.web import server, resource
 
 from .command import Command
 from .database import Database
+from .media_workers import MediaWorkerPool
 from .server_file import FileTransportServerFactory
 from .server_tcp import TCPServerFactory
 from .server_udp import UDPServer
 from .server_web import WebServer
 from .session_files import SessionFiles
+from .take_tracker import TakeTracker
 from .participants import Participants
 
 # Setup logging
@@ -53,7 +55,16 @@ def start_logging(session_files):
     # Direct the Twisted Logger to log to both of our observers.
     globalLogBeginner.beginLoggingTo(logtargets)
 
-def start():
+def start(media_workers=0, audio_format=None):
+    """Starts the server.
+
+    If media_workers is greater than zero, the audio is handled by
+    that many media worker processes rather than in this process.
+
+    audio_format, an AudioFormat, is the default format of every
+    room's audio.
+
+    """
     # Create empty context
     context = {}
     context["reactor"] = reactor
@@ -77,8 +88,17 @@ def start():
     participants = Participants(context)
     context["participants"] = participants
     
-    # Create UDP server
-    udp_server = UDPServer(context)
+    # Create UDP server, or the pool of processes that run them
+    udp_port = 12345
+    if media_workers > 0:
+        udp_server = MediaWorkerPool(
+            context,
+            media_workers,
+            udp_port,
+            audio_format=audio_format
+        )
+    else:
+        udp_server = UDPServer(context, audio_format=audio_format)
     context["udp_server"] = udp_server
 
     # Create a Command instance
@@ -90,6 +110,10 @@ def start():
     command.set_web_server(web_server)
     context["web_server"] = web_server
 
+    # Create a tracker of the recordings that make up each take
+    take_tracker = TakeTracker(database, web_server.eventsource_resource)
+    context["take_tracker"] = take_tracker
+
     # Create TCP server factory
     tcp_server_factory = TCPServerFactory(context)
     command.set_tcp_server_factory(tcp_server_factory)
@@ -101,7 +125,10 @@ def start():
     
     endpoints.serverFromString(reactor, "tcp:2000").listen(file_transport_server_factory)
     endpoints.serverFromString(reactor, "tcp:1234").listen(tcp_server_factory)
-    reactor.listenUDP(12345, udp_server)
+    if media_workers > 0:
+        udp_server.start()
+    else:
+        reactor.listenUDP(udp_port, udp_server)
     www_port = 8080
     reactor.listenTCP(www_port, web_server.site)
     web_server.set_www_port(www_port)
@@ -27,15 +27,33 @@ class FileTransportServer(protocol.Protocol):
     """
     def __init__(self, context):
         self._started = False
+        self._finished = False
+        self._audio_id = None
+        self._tracked = False
         self._context = context
         self._session_files = context["session_files"]
 
+        # Uploaded recordings are reported to the take tracker, if
+        # there is one (there isn't when this module is run alone) and
+        # it's tracking the audio id
+        self._take_tracker = context.get("take_tracker")
+
     def connectionMade(self):
         log.info("Connection made to server")
         self._packetizer = TCPPacketizer(self.transport)
         
     def connectionLost(self, reason):
-        pass
+        if self._started and not self._finished:
+            log.warn(
+                f"Connection lost during upload of audio id "+
+                f"{self._audio_id}: {reason}"
+            )
+            self._f.close()
+            if self._tracked:
+                self._take_tracker.upload_failed(
+                    self._audio_id,
+                    "Connection lost during upload"
+                )
         
     def dataReceived(self, data):
         #print("data received:", data)
@@ -61,6 +79,13 @@ class FileTransportServer(protocol.Protocol):
             self._f = open(self._audio_path, "wb")
             self._started = True
             print("Starting...")
+            # Only uploads of the recordings of a take are tracked
+            self._tracked = (
+                self._take_tracker is not None
+                and self._take_tracker.is_tracked(self._audio_id)
+            )
+            if self._tracked:
+                self._take_tracker.upload_started(self._audio_id)
         elif command == "send":
             raise NotImplementedError("'Send' command not yet implemented")
         else:
@@ -82,16 +107,25 @@ class FileTransportServer(protocol.Protocol):
             print("Received data")
             data = tail(packet, data_header)
             self._f.write(data)
+            if self._tracked:
+                self._take_tracker.upload_progress(self._audio_id, len(data))
         elif head(packet, abort_header):
             print("Aborted")
+            self._finished = True
             self._f.close()
             self.transport.loseConnection()
+            if self._tracked:
+                self._take_tracker.upload_failed(
+                    self._audio_id,
+                    "Upload aborted by client"
+                )
         elif head(packet, end_header):
             print("Finished")
+            self._finished = True
             self._f.close()
             self.transport.loseConnection()
-            d = self.factory.anticipate_audio_id(self._audio_id)
-            d.callback(self._audio_id)
+            if self._tracked:
+                self._take_tracker.upload_finished(self._audio_id)
         else:
             raise Exception("Error; unexpected packet contents.  First 10 bytes: ",packet[0:10])
         
@@ -99,7 +133,6 @@ class FileTransportServer(protocol.Protocol):
 class FileTransportServerFactory(protocol.Factory):
     def __init__(self, context):
         self._context = context
-        self._anticipated_audio_ids = {}
         
     def buildProtocol(self, addr):
         print("Building a protocol")
@@ -110,17 +143,6 @@ class FileTransportServerFactory(protocol.Factory):
     def startFactory(self):
         log.info("FileTransportServerFactory started")
 
-    def anticipate_audio_id(self, audio_id):
-        # Check if audio_id is already anticipated
-        if audio_id in self._anticipated_audio_ids:
-            # Audio id already anticipated
-            return self._anticipated_audio_ids[audio_id]
-        else:
-            # Add audio id to anticipated list
-            d = defer.Deferred()
-            self._anticipated_audio_ids[audio_id] = d
-            return d
-        
 
 if __name__ == "__main__":
     # Create empty context
@@ -6,6 +6,9 @@ from twisted.internet import protocol
 
 from singtcommon import TCPPacketizer
 
+from .download_coordinator import DownloadCoordinator
+from .download_coordinator import gather_downloads
+
 # Start a logger with a namespace for a particular subsystem of our application.
 from twisted.logger import Logger
 log = Logger("server_tcp")
@@ -21,18 +24,29 @@ class TCPServer(protocol.Protocol):
         self.username = None
         self.client_id = None
 
+        # The client's manifest of the audio it has cached: hashes
+        # of the audio's contents keyed by audio id
+        self.cached_audio = {}
+
+        # Hashes of the audio the client has been asked to download,
+        # keyed by audio id
+        self._requested_hashes = {}
+
         self._commands = {}
         self._register_commands()
         
     def _register_commands(self):
         self.register_command("announce", self._command_announce)
         self.register_command("update_downloaded", self._command_update_downloaded)
+        self.register_command("update_download_progress", self._command_update_download_progress)
+        self.register_command("update_cached_audio", self._command_update_cached_audio)
 
     def register_command(self, command, function):
         self._commands[command] = function
         
     def connectionMade(self):
         self._tcp_packetizer = TCPPacketizer(self.transport)
+        self._shared_context.connected_protocols.add(self)
         
     def send_file(self, filename):
         f = open(filename, "rb")
@@ -102,20 +116,76 @@ class TCPServer(protocol.Protocol):
             
     def connectionLost(self, reason):
         log.info(f"Connection lost to user '{self.username}': {reason}")
+        self._shared_context.connected_protocols.discard(self)
+
+        # If the client has already reconnected, their new connection
+        # has taken over, so leave them be
+        if (self.client_id is not None
+            and not self._shared_context.unregister_protocol(self)):
+            return
+
         self._shared_context.participants.leave(self.client_id)
 
+        # Stop mixing the client's audio, and stop waiting on their
+        # downloads
+        if self.client_id is not None:
+            self._shared_context.udp_server.remove_client(self.client_id)
+            self._shared_context.download_coordinator.cancel_client(
+                self.client_id,
+                "Connection lost"
+            )
+
     def send_message(self, msg):
         msg_as_bytes = msg.encode("utf-8")
         len_as_short = struct.pack("H", len(msg))
         encoded_msg = len_as_short + msg_as_bytes
         self.transport.write(encoded_msg)
 
-    def send_download_request(self, audio_id, partial_url):
+    def send_udp_port(self, port):
+        command = {
+            "command": "udp_port",
+            "port": port
+        }
+        command_json = json.dumps(command)
+        self.send_message(command_json)
+
+    def send_reannounce_request(self):
+        """Asks the client to announce itself again over UDP."""
+        command = {
+            "command": "reannounce"
+        }
+        command_json = json.dumps(command)
+        self.send_message(command_json)
+
+    def send_audio_format(self, audio_format):
+        command = {
+            "command": "audio_format",
+            "audio_format": audio_format.to_dict()
+        }
+        command_json = json.dumps(command)
+        self.send_message(command_json)
+
+    def has_cached(self, audio_id, content_hash):
+        """Returns True if the client has cached the given audio.
+
+        The audio must match the hash of its contents; if the hash
+        isn't known the audio is assumed not to be cached.
+
+        """
+        if content_hash is None:
+            return False
+        return self.cached_audio.get(audio_id) == content_hash
+
+    def send_download_request(self, audio_id, partial_url,
+                              content_hash=None):
         command = {
             "command": "download",
             "audio_id": audio_id,
             "partial_url": str(partial_url)
         }
+        if content_hash is not None:
+            command["hash"] = content_hash
+            self._requested_hashes[audio_id] = content_hash
         command_json = json.dumps(command)
         self.send_message(command_json)
 
@@ -134,6 +204,15 @@ class TCPServer(protocol.Protocol):
         Announces username, which is then stored in the shared context
         along with the client's ID.  
 
+        The client may also give the name of the room they wish to
+        join; otherwise they join the default room.  They may also
+        give a manifest of the audio they've cached, as a dict of the
+        hashes of the audio's contents keyed by audio id, so that
+        they aren't asked to download that audio again.  The client is
+        told the audio format (sample rate, channels and frame
+        duration) of their room, which they must use for their UDP
+        audio.
+
         Also causes the current invitation to be sent to the client.
 
         """
@@ -142,6 +221,15 @@ class TCPServer(protocol.Protocol):
         print("json_data:",json_data)
         self.username = json_data["username"]
         self.client_id = int(json_data["client_id"])
+        try:
+            room = json_data["room"]
+        except KeyError:
+            room = "default"
+        self._set_cached_audio(json_data.get("cached_audio", {}))
+
+        # Register the connection under the client's id, so that
+        # messages can be sent to them
+        self._shared_context.register_protocol(self)
 
         # Store and announce the client
         self._shared_context.participants.join(
@@ -149,6 +237,19 @@ class TCPServer(protocol.Protocol):
             self.username
         )
 
+        # Place the client's audio in their room.  If the room is
+        # handled by a media worker process, tell the client which UDP
+        # port to send to.
+        udp_port = self._shared_context.udp_server.assign_room(
+            self.client_id,
+            room
+        )
+        if udp_port is not None:
+            self.send_udp_port(udp_port)
+        self.send_audio_format(
+            self._shared_context.udp_server.get_audio_format(room)
+        )
+
         # Send the client the current invitation from the shared
         # context
         # TODO
@@ -160,27 +261,49 @@ class TCPServer(protocol.Protocol):
         audio_id = json_data["audio_id"]
         result = json_data["result"]
 
-        # Get the deferred that's waiting on this update
-        d = self._shared_context._download_results_collector.get_deferred(
-            client_id,
-            audio_id
-        )
-
-        # Call the appropriate callback
+        # Resolve the download that's waiting on this update
+        download_coordinator = self._shared_context.download_coordinator
+        content_hash = self._requested_hashes.pop(audio_id, None)
         if result=="success":
-            print("Calling success callback")
-            d.callback((client_id, audio_id))
+            # The client now has the audio cached
+            content_hash = json_data.get("hash", content_hash)
+            if content_hash is not None:
+                self.cached_audio[audio_id] = content_hash
+            download_coordinator.complete(client_id, audio_id)
         else:
-            print("Calling error callback")
-            d.errback((client_id, audio_id, json_data["error"]))
+            download_coordinator.fail(
+                client_id,
+                audio_id,
+                json_data.get("error", "Download failed")
+            )
 
-        # Remove the deferred from the collector
-        self._shared_context._download_results_collector.remove_deferred(
-            client_id,
-            audio_id
-        )
+    def _command_update_cached_audio(self, json_data):
+        """Replaces the client's manifest of the audio it has cached.
 
-        return d
+        Clients send this when they remove audio from their cache.
+
+        """
+        self._set_cached_audio(json_data["cached_audio"])
+
+    def _set_cached_audio(self, cached_audio):
+        # Audio ids are the keys of a JSON object, so arrive as strings
+        self.cached_audio = {
+            int(audio_id): content_hash
+            for audio_id, content_hash in cached_audio.items()
+        }
+
+    def _command_update_download_progress(self, json_data):
+        """Records the progress of a download.
+
+        The client gives the audio id and the fraction of the audio
+        that it has downloaded.
+
+        """
+        self._shared_context.download_coordinator.update_progress(
+            self.client_id,
+            json_data["audio_id"],
+            float(json_data["progress"])
+        )
             
  
 class TCPServerFactory(protocol.Factory):
@@ -188,16 +311,49 @@ class TCPServerFactory(protocol.Factory):
         def __init__(self, context):
             self.eventsource = context["web_server"].eventsource_resource
             self.participants = Participants(context)
-            self._download_results_collector = DownloadResultsCollector()
+            self.udp_server = context["udp_server"]
+            self.download_coordinator = DownloadCoordinator(self.eventsource)
             self.current_invitation = None
-            
+
+            # The protocols of the live connections, and of those
+            # that have announced themselves, keyed by client id
+            self.connected_protocols = set()
+            self.protocols_by_client_id = {}
+
+        def register_protocol(self, protocol):
+            """Registers an announced protocol under its client id.
+
+            If the client was already registered (because they've
+            reconnected before their old connection was found to be
+            lost) the new protocol replaces the old one.
+
+            """
+            client_id = protocol.client_id
+            old_protocol = self.protocols_by_client_id.get(client_id)
+            if old_protocol is not None and old_protocol is not protocol:
+                log.info(
+                    f"Client id {client_id} has reconnected; replacing "+
+                    f"their previous connection"
+                )
+            self.protocols_by_client_id[client_id] = protocol
+
+        def unregister_protocol(self, protocol):
+            """Unregisters a protocol whose connection was lost.
+
+            Returns True if the protocol was registered under its
+            client id, or False if it had been replaced (or never
+            registered).
+
+            """
+            client_id = protocol.client_id
+            if self.protocols_by_client_id.get(client_id) is not protocol:
+                return False
+            del self.protocols_by_client_id[client_id]
+            return True
+
     def __init__(self, context):
         self._context = context
         web_server = self._context["web_server"]
-        
-        # Create a list of protocol instances, used for broadcasting
-        # to all clients
-        self._protocols = []
 
         # TODO: Is this really the best way to implement this?
         backing_track_resource = web_server.backing_track_resource
@@ -208,27 +364,71 @@ class TCPServerFactory(protocol.Factory):
     
     def buildProtocol(self, addr):
         protocol = TCPServer(self._shared_context)
-        self._protocols.append(protocol)
         return protocol
 
     def startFactory(self):
         log.info("TCPServerFactory started")
 
-    def broadcast_download_request(self, audio_id, partial_url, participants):
-        deferreds = []
-        for protocol in self._protocols:
-            if protocol.client_id in participants:
-                protocol.send_download_request(audio_id, partial_url)
-                d = self._shared_context._download_results_collector.make_deferred(protocol.client_id, audio_id)
-                deferreds.append(d)
-                
-        d = defer.gatherResults(deferreds)
-            
-        return d
+    def get_protocol(self, client_id):
+        """Returns the protocol of the connected client, or None."""
+        return self._shared_context.protocols_by_client_id.get(client_id)
+
+    def _get_participant_protocols(self, participants):
+        """Yields the client id and protocol of each participant.
+
+        Participants who aren't connected are skipped.
+
+        """
+        for client_id in set(participants):
+            protocol = self.get_protocol(client_id)
+            if protocol is None:
+                log.warn(
+                    f"Client id {client_id} is not connected; skipping them"
+                )
+                continue
+            yield client_id, protocol
+
+    def broadcast_download_request(self, audio_id, partial_url, participants,
+                                   content_hash=None):
+        """Requests participants download audio.
+
+        Participants who have already cached audio matching the given
+        hash of its contents aren't asked to download it again.
+
+        Returns a deferred that resolves, once every participant has
+        downloaded the audio or failed to, with a dict listing the
+        client ids of those that are ready and the reasons why the
+        others failed; see gather_downloads().  Participants who
+        aren't connected have failed.
 
-    def broadcast_record_request(self, backing_audio_ids, recording_audio_ids, participants):
+        """
+        download_coordinator = self._shared_context.download_coordinator
+        deferreds_by_client_id = {}
+        for client_id in set(participants):
+            if self.get_protocol(client_id) is None:
+                deferreds_by_client_id[client_id] = defer.fail(
+                    Exception("Not connected")
+                )
+        for client_id, protocol in self._get_participant_protocols(participants):
+            if protocol.has_cached(audio_id, content_hash):
+                d = download_coordinator.skip(client_id, audio_id)
+            else:
+                d = download_coordinator.request(client_id, audio_id)
+                protocol.send_download_request(
+                    audio_id,
+                    partial_url,
+                    content_hash
+                )
+            deferreds_by_client_id[client_id] = d
+
+        return gather_downloads(deferreds_by_client_id)
+
+    def broadcast_record_request(self, take_id, backing_audio_ids,
+                                 recording_audio_ids, participants):
         """Request clients start recording.
 
+        take_id is the take being recorded.
+
         backing_audio_ids is a list of audio ids that specify the
         audio that should be played as the backing audio.  This may be
         a combination of audio ids for tracks and takes.
@@ -240,19 +440,28 @@ class TCPServerFactory(protocol.Factory):
         participants is a list of client_ids; it specifies which
         clients will be asked to record.
 
-        The method returns a deferred once all clients have finished
-        sending their recordings, or an error has occurred.
+        The method returns a deferred that resolves once every
+        client's recording has been uploaded, or has failed; see
+        TakeTracker.track_take().  Participants who aren't connected
+        have failed.
 
         """
-        deferreds = []
-        for protocol in self._protocols:
-            if protocol.client_id in participants:
-                recording_audio_id = recording_audio_ids[protocol.client_id]
-                protocol.send_record_request(backing_audio_ids, recording_audio_id)
-                #d = self._shared_context._download_results_collector.make_deferred(protocol.client_id, audio_id)
-                #deferreds.append(d)
-                
-        d = defer.gatherResults(deferreds)
+        take_tracker = self._context["take_tracker"]
+        d = take_tracker.track_take(
+            take_id,
+            {client_id: recording_audio_ids[client_id]
+             for client_id in set(participants)}
+        )
+        for client_id in set(participants):
+            if self.get_protocol(client_id) is None:
+                take_tracker.upload_failed(
+                    recording_audio_ids[client_id],
+                    "Not connected"
+                )
+        for client_id, protocol in self._get_participant_protocols(participants):
+            recording_audio_id = recording_audio_ids[client_id]
+            protocol.send_record_request(backing_audio_ids, recording_audio_id)
+
         return d
     
 
@@ -319,46 +528,3 @@ class Participants:
             "update_participants",
             connected_list
         )
-
-
-
-class DownloadResultsCollector:
-    def __init__(self):
-        # A dict of dicts.  This is referenced by client_id.  The
-        # resulting dict is referenced by audio_id.
-        self._deferreds_by_client_id = {}
-        
-    def make_deferred(self, client_id, audio_id):
-        """Makes a deferred if it doesn't already exist."""
-        # Get dict of deferreds for the given client id
-        try:
-            deferreds_by_audio_id = self._deferreds_by_client_id[client_id]
-        except KeyError:
-            # Client ID doesn't yet have any deferreds, create a dict
-            deferreds_by_audio_id = {}
-            self._deferreds_by_client_id[client_id] = deferreds_by_audio_id
-
-        # Get deferred for the given audio_id
-        try:
-            deferred = deferreds_by_audio_id[audio_id]
-        except KeyError:
-            deferred = defer.Deferred()
-            deferreds_by_audio_id[audio_id] = deferred
-
-        return deferred
-
-    def get_deferred(self, client_id, audio_id):
-        """Gets a deferred."""
-        deferreds_by_audio_id = self._deferreds_by_client_id[client_id]
-        print("deferreds_by_audio_id:", deferreds_by_audio_id)
-        deferred = deferreds_by_audio_id[audio_id]
-        return deferred
-        
-    def remove_deferred(self, client_id, audio_id):
-        """Removes a deferred."""
-        deferreds_by_audio_id = self._deferreds_by_client_id[client_id]
-        del deferreds_by_audio_id[audio_id]
-
-        if len(deferreds_by_audio_id) == 0:
-            del self._deferreds_by_client_id[client_id]
-    
@@ -1,38 +1,221 @@
+import os
 import random
 import struct
 import time
 import wave
 
-import numpy
 import pyogg
-from pyogg import OpusDecoder
-from pyogg import OpusEncoder
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.internet.protocol import DatagramProtocol
-from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
 
-from singtcommon import JitterBuffer
 from singtcommon import UDPPacketizer
-from singtcommon import AutomaticGainControl
+
+from .audio_format import AudioFormat
+from .codec_workers import CodecWorkerPool
+from .jitter_buffer import AdaptiveJitterBuffer
+from .opus_codec import FloatOpusDecoder
+from .opus_codec import FloatOpusEncoder
+from .packet_cache import PlaybackPacketCache
+from .packet_cache import encode_playback
+from .playback import PlaybackMixer
+from .playback import PlaybackStream
+from .rate_control import BitrateController
+from .rate_control import ComplexityController
+from .room import Room
 
 # Start a logger with a namespace for a particular subsystem of our application.
 log = Logger("server_udp")
 
 
 class UDPServer(DatagramProtocol):
-    def __init__(self, context):
+    """Receives the participants' audio and sends them their mixes.
+
+    Participants are divided into rooms (see Room), each of which is
+    mixed independently.  A client is placed in the room given by
+    assign_room(), which may be called before or after their UDP
+    announcement; until then they are in the default room.  Rooms are
+    created when first used, and rooms other than the default are
+    discarded once they are empty and silent.  The room_settings
+    (overload_policy, mode, forward_speakers, concealment_limit and
+    encoder_hold) are passed to each room.
+
+    Rooms use the server's audio_format (by default, 48 kHz mono in
+    20 ms frames) unless they've been given their own with
+    set_audio_format().  A connection's jitter buffer and codecs are
+    made for the format of the room it's in.
+
+    Each connection's jitter buffer adapts its depth, in packets,
+    within the bounds given by jitter_buffer_depths.
+
+    The server's encoders use in-band forward error correction (FEC)
+    and discontinuous transmission (DTX).  When an incoming packet is
+    lost but the following one has arrived, the lost frame is
+    recovered from the following packet's FEC data.
+
+    Once a second, each connection's encoder bitrate is adapted to the
+    packet loss seen on its link (see BitrateController), and every
+    encoder's complexity to the host's CPU headroom (see
+    ComplexityController and get_cpu_headroom()), so that congested
+    links and a saturated host degrade gracefully.
+
+    A connection that has sent nothing for connection_timeout seconds
+    is removed, as is a client's connection when their TCP session is
+    lost.  However, a client that's still connected over TCP may just
+    be silent (DTX stops them sending), so their connection is kept
+    and they're asked, over TCP, to announce themselves again.  If a
+    known client announces from a new address (for example, because
+    their NAT mapping changed) their connection is moved to that
+    address.
+
+    Playback audio is pre-encoded, in the background, the first time
+    it is played, and kept in a cache of packet_cache_size entries
+    shared by all the rooms.  When it is played again, and nobody is
+    singing, its packets are sent as they are; they are only decoded
+    when they need to be mixed with someone's voice.
+
+    """
+    default_room = "default"
+
+    def __init__(self, context, audio_format=None, codec_workers=None,
+                 jitter_buffer_depths=(1, 10), connection_timeout=10,
+                 packet_cache_size=8, monotonic=time.monotonic,
+                 **room_settings):
         self._context = context
+        self._monotonic = monotonic
         self._participants = context["participants"]
-        
-        self._stream = None
-        self._stream_buffer = None
 
-        reactor.callWhenRunning(self._start_audio_processing_loop, 20/1000)
+        if audio_format is None:
+            audio_format = AudioFormat()
+        self.audio_format = audio_format
+        log.info(f"Default audio format: {audio_format}")
+        self._jitter_buffer_depths = jitter_buffer_depths
+
+        # Encoders start at the complexity that the host can currently
+        # afford
+        self._complexity_controller = ComplexityController()
+
+        # Playback audio is pre-encoded and cached
+        self.packet_cache = PlaybackPacketCache(
+            self._encode_playback,
+            max_entries=packet_cache_size
+        )
+
+        # Opus decoding and encoding is sharded across a pool of
+        # threads, by default one per core
+        if codec_workers is None:
+            codec_workers = os.cpu_count() or 1
+        self.codec_workers = CodecWorkerPool(codec_workers)
+        reactor.addSystemEventTrigger(
+            "before", "shutdown",
+            self.codec_workers.stop
+        )
+
+        # The rooms, keyed by name, and the room each client has been
+        # assigned to
+        self._room_settings = room_settings
+        self._room_formats = {}
+        self._rooms = {}
+        self._room_by_client_id = {}
+        self.get_room(UDPServer.default_room)
 
         self._connections_by_address = {}
         self._address_by_client_id = {}
 
+        # Connections are checked for inactivity once a second
+        self._connection_timeout = connection_timeout
+        self._reaper = task.LoopingCall(self._reap_stale_connections)
+        self._removed_connections = 0
+
+        # Encoders are adapted to the links and the host once a second
+        self._rate_controller = task.LoopingCall(self._control_rates)
+
+    def startProtocol(self):
+        self._reaper.start(1, now=False)
+        self._rate_controller.start(1, now=False)
+
+    def stopProtocol(self):
+        if self._reaper.running:
+            self._reaper.stop()
+        if self._rate_controller.running:
+            self._rate_controller.stop()
+        for room in self._rooms.values():
+            room.stop()
+
+    def get_room(self, name):
+        """Returns the named room, creating it if need be."""
+        try:
+            return self._rooms[name]
+        except KeyError:
+            pass
+        audio_format = self.get_audio_format(name)
+        log.info(f"Creating room '{name}' ({audio_format})")
+        room = Room(name, self, audio_format, **self._room_settings)
+        self._rooms[name] = room
+        return room
+
+    def get_audio_format(self, room=default_room):
+        """Returns the audio format of the named room."""
+        return self._room_formats.get(room, self.audio_format)
+
+    def set_audio_format(self, audio_format, room=default_room):
+        """Sets the audio format of the named room.
+
+        The format can only be changed while no one is in the room and
+        nothing is playing; clients are told the format of their room
+        when they announce themselves.
+
+        """
+        existing_room = self._rooms.get(room)
+        if (existing_room is not None
+            and existing_room.audio_format != audio_format):
+            if not existing_room.is_idle():
+                raise Exception(
+                    f"Cannot change the audio format of room '{room}' "+
+                    f"while it is in use"
+                )
+            existing_room.stop()
+            del self._rooms[room]
+        log.info(f"Setting audio format of room '{room}' to {audio_format}")
+        self._room_formats[room] = audio_format
+        if room == UDPServer.default_room:
+            # The default room always exists
+            self.get_room(room)
+
+    def _discard_room_if_empty(self, room):
+        if room.name == UDPServer.default_room or not room.is_idle():
+            return
+        log.info(f"Discarding empty room '{room.name}'")
+        room.stop()
+        del self._rooms[room.name]
+
+    def assign_room(self, client_id, name):
+        """Places the client in the named room.
+
+        If the client already has a UDP connection, it's moved to the
+        room.  Otherwise it joins the room when it announces itself.
+
+        Returns None, as the client's UDP port doesn't change (see
+        MediaWorkerPool.assign_room()).
+
+        """
+        self._room_by_client_id[client_id] = name
+        try:
+            addr = self._address_by_client_id[client_id]
+        except KeyError:
+            return
+        connection = self._connections_by_address[addr]
+        old_room = connection["room"]
+        if old_room.name == name:
+            return
+        old_room.remove_connection(client_id)
+        self._discard_room_if_empty(old_room)
+        room = self.get_room(name)
+        if connection["audio_format"] != room.audio_format:
+            self._set_connection_format(connection, room.audio_format)
+        room.add_connection(connection)
+
     def datagramReceived(self, data, addr):
         # If we don't know this address, check if it's an announcement
         # packet.
@@ -74,20 +257,60 @@ class UDPServer(DatagramProtocol):
         # Create UDPPacketizer for this address
         udp_packetizer = UDPPacketizer(self.transport, addr)
 
-        # Create a JitterBuffer for this address
-        packets_to_buffer = 3
-        jitter_buffer = JitterBuffer(packets_to_buffer)
+        # If we already know this client, they've announced from a new
+        # address, so move their connection to it
+        if client_id in self._address_by_client_id:
+            self._rebind_connection(client_id, addr, udp_packetizer)
+            return
 
         # Store connection details
-        self._connections_by_address[addr] = {
+        connection = {
+            "client_id": client_id,
             "udp_packetizer": udp_packetizer,
-            "jitter_buffer": jitter_buffer
+            "started": False,
+            "missing_packets": 0,
+            "dtx": False,
+            "announced": self._monotonic(),
+            "reannounce_requested": None,
+            "bitrate_controller": BitrateController()
         }
+        self._connections_by_address[addr] = connection
         self._address_by_client_id[client_id] = addr
-        
+
+        # Add the connection to its room, in the room's format, which
+        # allocates it a row in the room's mixer and ensures audio is
+        # being processed
+        name = self._room_by_client_id.get(client_id, UDPServer.default_room)
+        room = self.get_room(name)
+        self._set_connection_format(connection, room.audio_format)
+        room.add_connection(connection)
+
         # Announce to Participants
         self._participants.join_udp(client_id)
 
+    def _set_connection_format(self, connection, audio_format):
+        """Gives the connection a jitter buffer and codecs for the format.
+
+        Any existing jitter buffer and codecs are replaced.
+
+        """
+        # Create a jitter buffer for this address, which adapts its
+        # depth to the connection
+        min_depth, max_depth = self._jitter_buffer_depths
+        connection["jitter_buffer"] = AdaptiveJitterBuffer(
+            audio_format.frame_duration,
+            min_depth=min_depth,
+            max_depth=max_depth,
+            monotonic=self._monotonic
+        )
+
+        # Create the Opus decoder and encoder for this address.  Both
+        # work with float samples in buffers that are reused every
+        # frame.
+        connection["opus_decoder"] = self.create_decoder(audio_format)
+        connection["opus_encoder"] = self.create_encoder(audio_format)
+        connection["audio_format"] = audio_format
+
     def _process_audio(self, data, addr):
         connection = self._connections_by_address[addr]
         udp_packetizer = connection["udp_packetizer"]
@@ -97,224 +320,277 @@ class UDPServer(DatagramProtocol):
         # and encoded frame (remainder)
         timestamp, seq_no, encoded_packet = udp_packetizer.decode(data)
 
+        # A client that's asked to announce itself again, but hasn't
+        # moved, announces from the address we already know
+        if seq_no == -1:
+            log.info(
+                f"Client id {connection['client_id']} has announced "+
+                f"itself again from address {addr}."
+            )
+            connection["announced"] = self._monotonic()
+            return
+
         jitter_buffer.put_packet(seq_no, encoded_packet)
 
+    def _rebind_connection(self, client_id, addr, udp_packetizer):
+        """Moves a client's connection to a new address."""
+        old_addr = self._address_by_client_id[client_id]
+        log.info(
+            f"Client id {client_id} has moved from address {old_addr} "+
+            f"to {addr}; rebinding its UDP connection."
+        )
+        connection = self._connections_by_address.pop(old_addr)
+        connection["udp_packetizer"] = udp_packetizer
+        connection["announced"] = self._monotonic()
+        self._connections_by_address[addr] = connection
+        self._address_by_client_id[client_id] = addr
 
-    def play_audio(self, filenames):
-        # Assumes filename points to Opus-encoded audio.
-        # TODO: Check that we're not currently playing anything else
+    def remove_client(self, client_id, leave=True):
+        """Removes the client's UDP connection and room assignment.
 
-        # TODO: Deal with more than one filename
-        log.info("Playing these filenames: "+str(filenames))
-        filename = filenames[0]
-        
-        # Open file as stream
+        If leave is False, Participants isn't told that the client has
+        left (as when they're moving to another media worker).
+
+        """
+        self._room_by_client_id.pop(client_id, None)
         try:
-            self._stream = pyogg.OpusFileStream(str(filename))
-        except Exception as e:
-            raise Exception(f"Failed to open OpusFileStream (with filename '{filename}': "+
-                            str(e))
-        self._stream_buffer = None
-
-    def stop_audio(self):
-        # TODO: It would be much nicer if this faded out
-        self._stream = None
-        self._stream_buffer = None
-
-
-    def process_audio_frame(self, count):
-        start_time = time.time()
-        if count != 1:
-            print(f"WARNING in process_audio_frame(), catching up on {count} missed cycles")
-
-        # Repeat count times
-        for _ in range(count):
-            pcms = {}
-            
-            # For each jitter buffer, get the next packet and send it on.
-            for address, connection in self._connections_by_address.items():
-                jitter_buffer = connection["jitter_buffer"]
-                encoded_packet = jitter_buffer.get_packet()
-
-                # Get decoder
-                try:
-                    opus_decoder = connection["opus_decoder"]
-                    started = connection["started"]
-                except KeyError:
-                    opus_decoder = OpusDecoder()
-                    opus_decoder.set_sampling_frequency(48000) # FIXME
-                    opus_decoder.set_channels(1) # FIXME
-                    started = False
-                    connection["opus_decoder"] = opus_decoder
-                    connection["started"] = started
-                    
-                # Decode encoded packet to PCM
-                if encoded_packet is None:
-                    duration_ms = 20 # ms FIXME
-                    if not started:
-                        # We haven't started yet, so ignore this connection
-                        pcm = None
-                    else:
-                        # We have started, so this means we've lost a packet
-                        pcm = opus_decoder.decode_missing_packet(duration_ms)
-                else:
-                    # We've got a valid packet, decode it
-                    pcm = opus_decoder.decode(encoded_packet)
-
-                # Convert the PCM to floating point
-                if pcm is not None:
-                    pcm_int16 = numpy.frombuffer(
-                        pcm,
-                        dtype = numpy.int16
-                    )
-
-                    pcm_float = pcm_int16.astype(numpy.float32)
-                    pcm_float /= 2**15
-                    pcm_float = numpy.reshape(pcm_float, (len(pcm_float), 1))
-                    pcm = pcm_float
-
-                    # # Apply automatic gain control to the PCM
-                    # try:
-                    #     agc = connection["automatic_gain_control"]
-                    # except KeyError:
-                    #     agc = AutomaticGainControl()
-                    #     connection["automatic_gain_control"] = agc
-                    # agc.apply(pcm)
-                    # print("gain:", agc.gain)
-                    
-                # Store the PCM
-                pcms[address] = pcm
-
-            # The number of people who may simultaneously speak
-            # without the volume decreasing
-            simultaneous_voices = 2 # FIXME
-
-            # Loop through all the pcms and mix them together
-            combined_pcm = None
-            for address, pcm in pcms.items():
-                if pcm is None:
-                    continue
-
-                pcm /= simultaneous_voices
-                pcms[address] = pcm
-                
-                if combined_pcm is None:
-                    combined_pcm = pcm.copy()
-                else:
-                    combined_pcm += pcm
-
-            # Mix in playback audio
-            if (self._stream is not None
-                or self._stream_buffer is not None):
-                # Read the next part of the stream until either we
-                # come to the end or we've got sufficient for a full
-                # frame.
-                samples_per_second = 48000 # FIXME
-                duration_ms = 20 # FIXME
-                samples_per_frame = samples_per_second // 1000 * duration_ms # FIXME
-                while (self._stream_buffer is None
-                       or len(self._stream_buffer) < samples_per_frame):
-                    next_ = self._stream.get_buffer_as_array()
-                    if next_ is None:
-                        # We've come to the end
-                        self._stream = None
-                        break
-                    # Join what we just read to what we've read so far
-                    if self._stream_buffer is None:
-                        self._stream_buffer = numpy.copy(next_)
-                    else:
-                        self._stream_buffer = numpy.concatenate(
-                            (self._stream_buffer, next_)
-                        )
-
-                # Obtain the PCM
-                if len(self._stream_buffer) >= samples_per_frame:
-                    # Take what we need to fill a frame and leave the rest
-                    pcm = self._stream_buffer[:samples_per_frame]
-                    self._stream_buffer = self._stream_buffer[samples_per_frame:]
-                else:
-                    # Take whatever's left
-                    pcm = self._stream_buffer
-                    self._stream_buffer = None
-
-                # Convert the int16 data to float
-                pcm_float = pcm.astype(numpy.float32)
-                pcm_float /= 2**15
-
-                # Convert it to mono if it's in stereo
-                pcm_float = numpy.mean(pcm_float, axis=1)
-                pcm_float = pcm_float.reshape((len(pcm_float),1))
-
-                # Fill with zeros if it's not long enough
-                if len(pcm_float) < samples_per_frame:
-                    pcm_float = numpy.concatenate(
-                        (pcm_float, numpy.zeros(
-                            (samples_per_frame - len(pcm_float), 1)
-                        ))
-                    )
-
-                # Halve the volume
-                pcm_float /= 2
-
-                # Add it into the combined pcm
-                if combined_pcm is None:
-                    combined_pcm = pcm_float
-                else:
-                    combined_pcm += pcm_float
-                    
-
-            # Prepare each individual client's PCM
-            if combined_pcm is not None:
-                # Send the encoded packet to all the clients
-                for address, connection in self._connections.items():
-                    client_signal = pcms[address]
-                    if client_signal is None:
-                        continue
-                    
-                    # Remove their signal from the audio
-                    client_pcm = combined_pcm #- client_signal
-
-                    # Convert from float32 to int16
-                    pcm_int16 = client_pcm * (2**15-1)
-                    pcm_int16 = pcm_int16.astype(numpy.int16)
-
-                    # Obtain encoder
-                    try:
-                        opus_encoder = connection["opus_encoder"]
-                    except KeyError:
-                        opus_encoder = OpusEncoder()
-                        opus_encoder.set_application("audio")
-                        opus_encoder.set_sampling_frequency(48000)
-                        opus_encoder.set_channels(1)
-                        connection["opus_encoder"] = opus_encoder
-                    
-                    # Encode the PCM
-                    encoded_packet = opus_encoder.encode(pcm_int16.tobytes())
-                    
-                    # Send encoded packet
-                    udp_packetizer = connection["udp_packetizer"]
-                    if encoded_packet is not None:
-                        udp_packetizer.write(encoded_packet)
-
-        end_time = time.time()
-        duration_ms = (end_time-start_time)*1000
-        if duration_ms > 5:
-            print(f"process_audio_frame() duration: {round(duration_ms)} ms")
-        
-    def _start_audio_processing_loop(self, interval):
-        looping_call = LoopingCall.withCount(self.process_audio_frame)
+            addr = self._address_by_client_id[client_id]
+        except KeyError:
+            return
+        self._remove_connection(addr, leave=leave)
 
-        d = looping_call.start(interval)
+    def _remove_connection(self, addr, leave=True):
+        connection = self._connections_by_address.pop(addr)
+        client_id = connection["client_id"]
+        log.info(
+            f"Removing UDP connection to client id {client_id} "+
+            f"with address {addr}."
+        )
+        del self._address_by_client_id[client_id]
 
-        def on_stop(data):
-            print("The audio processing loop was stopped")
-            
-        def on_error(data):
-            print("ERROR: An error occurred during the audio processing loop:", data)
-            raise Exception("An error occurred during the audio processing loop:" + str(data))
+        # Remove the connection from its room, releasing its row in
+        # the room's mixer
+        room = connection["room"]
+        room.remove_connection(client_id)
+        self._discard_room_if_empty(room)
+        self._removed_connections += 1
 
-        d.addCallback(on_stop)
-        d.addErrback(on_error)
+        # Announce to Participants
+        if leave:
+            self._participants.leave(client_id)
+
+    def _get_tcp_protocol(self, client_id):
+        # The TCP server is created after this one, so is looked up
+        # when it's needed
+        tcp_server_factory = self._context.get("tcp_server_factory")
+        if tcp_server_factory is None:
+            return None
+        return tcp_server_factory.get_protocol(client_id)
+
+    def _reap_stale_connections(self):
+        """Removes connections that haven't sent anything recently.
+
+        A connection's last activity is when its most recent packet
+        arrived, or when it announced itself (or was last asked to) if
+        no packets have arrived since.
+
+        Connections of clients that are still connected over TCP are
+        kept, as they may just be silent, but the clients are asked to
+        announce themselves again, in case their address has changed.
+
+        """
+        now = self._monotonic()
+        stale_addresses = []
+        for addr, connection in self._connections_by_address.items():
+            last_activity = connection["announced"]
+            for time_ in [connection["jitter_buffer"].last_arrival,
+                          connection["reannounce_requested"]]:
+                if time_ is not None:
+                    last_activity = max(last_activity, time_)
+            if now - last_activity > self._connection_timeout:
+                stale_addresses.append(addr)
+
+        for addr in stale_addresses:
+            connection = self._connections_by_address[addr]
+            client_id = connection["client_id"]
+            tcp_protocol = self._get_tcp_protocol(client_id)
+            if tcp_protocol is not None:
+                log.info(
+                    f"No packets from {addr} for more than "+
+                    f"{self._connection_timeout} seconds, but client id "+
+                    f"{client_id} is still connected; asking them to "+
+                    f"announce themselves again"
+                )
+                connection["reannounce_requested"] = now
+                tcp_protocol.send_reannounce_request()
+                continue
+
+            log.info(
+                f"No packets from {addr} for more than "+
+                f"{self._connection_timeout} seconds"
+            )
+            self._remove_connection(addr)
 
-        return d
-        
+    def get_cpu_headroom(self):
+        """The fraction of the host's time not spent processing audio.
+
+        This is one less the sum of every room's load, as the rooms'
+        clocks share the reactor's thread.
+
+        """
+        load = sum(room.get_load() for room in self._rooms.values())
+        return max(0, 1 - load)
+
+    def _control_rates(self):
+        """Adapts every encoder's bitrate and complexity."""
+        complexity = self._complexity_controller.update(
+            self.get_cpu_headroom()
+        )
+        for room in self._rooms.values():
+            room.control_rates(complexity)
+
+    def create_encoder(self, audio_format):
+        """Creates an encoder with FEC and DTX enabled.
+
+        The encoder starts at the current complexity.
+
+        """
+        opus_encoder = FloatOpusEncoder(
+            audio_format.samples_per_second,
+            audio_format.channels,
+            audio_format.samples_per_frame,
+            application="audio"
+        )
+        opus_encoder.set_inband_fec(True)
+        opus_encoder.set_dtx(True)
+        opus_encoder.set_complexity(self._complexity_controller.complexity)
+        return opus_encoder
+
+    def create_decoder(self, audio_format):
+        """Creates a decoder for the given audio format."""
+        return FloatOpusDecoder(
+            audio_format.samples_per_second,
+            audio_format.channels,
+            audio_format.samples_per_frame
+        )
+
+    def play_audio(self, filenames, gains=None, room=default_room):
+        """Plays the given Opus files simultaneously to a room.
+
+        See Room.play_audio().
+
+        """
+        self.get_room(room).play_audio(filenames, gains)
+
+    def stop_audio(self, room=default_room):
+        self._get_existing_room(room).stop_audio()
+
+    def _get_existing_room(self, name):
+        try:
+            return self._rooms[name]
+        except KeyError:
+            raise Exception(f"There is no room named '{name}'")
+
+    def set_monitor_gains(self, client_id, gains=None):
+        """Sets the balance of what a client hears.
+
+        See Room.set_monitor_gains().
+
+        """
+        try:
+            addr = self._address_by_client_id[client_id]
+        except KeyError:
+            raise Exception(f"Client id {client_id} has no UDP connection")
+        connection = self._connections_by_address[addr]
+        connection["room"].set_monitor_gains(client_id, gains)
+
+    def start_recording(self, mix_filename, participant_filename=None,
+                        room=default_room):
+        """Starts recording a room.  See Room.start_recording()."""
+        self._get_existing_room(room).start_recording(
+            mix_filename,
+            participant_filename
+        )
+
+    def stop_recording(self, room=default_room):
+        """Stops recording a room.  See Room.stop_recording()."""
+        return self._get_existing_room(room).stop_recording()
+
+    def open_playback(self, filenames, gains, audio_format):
+        """Returns a PlaybackMixer of the given files.
+
+        Opus files always decode at 48 kHz, so for lower sample rates
+        the streams are decimated.
+
+        """
+        decimation = 48000 // audio_format.samples_per_second
+
+        # Open each file as a stream, reading it through a ring
+        # buffer of mono float samples
+        streams = []
+        for filename in filenames:
+            try:
+                opus_file_stream = pyogg.OpusFileStream(str(filename))
+            except Exception as e:
+                raise Exception(f"Failed to open OpusFileStream (with filename '{filename}': "+
+                                str(e))
+            streams.append(
+                PlaybackStream(
+                    opus_file_stream,
+                    audio_format.samples_per_frame,
+                    decimation=decimation
+                )
+            )
+
+        # Mix all the streams together
+        return PlaybackMixer(
+            streams,
+            audio_format.samples_per_frame,
+            gains
+        )
+
+    def _encode_playback(self, filenames, gains, audio_format):
+        """Encodes the given files' mix into a list of packets.
+
+        This is called on a thread by the packet cache, so it uses its
+        own streams and encoder.
+
+        """
+        playback = self.open_playback(filenames, gains, audio_format)
+        return encode_playback(playback, self.create_encoder(audio_format))
+
+    def has_clients(self):
+        """Returns True if any client is sending audio."""
+        return len(self._connections_by_address) > 0
+
+    def get_levels(self):
+        """Returns the levels of each room that mixes its audio.
+
+        See Room.get_levels().
+
+        """
+        levels = {}
+        for name, room in self._rooms.items():
+            room_levels = room.get_levels()
+            if room_levels is not None:
+                levels[name] = room_levels
+        return levels
+
+    def get_audio_statistics(self):
+        """Returns the statistics of the server and of each room.
+
+        See Room.get_statistics().
+
+        """
+        return {
+            "connections": len(self._connections_by_address),
+            "removed_connections": self._removed_connections,
+            "cached_playbacks": len(self.packet_cache),
+            "codec_workers": self.codec_workers.workers,
+            "cpu_headroom": self.get_cpu_headroom(),
+            "complexity": self._complexity_controller.complexity,
+            "rooms": {
+                name: room.get_statistics()
+                for name, room in self._rooms.items()
+            }
+        }
@@ -2,17 +2,34 @@ import json
 
 import pkg_resources
 from singtcommon import EventSource
+from twisted.internet import defer
 from twisted.web import resource
 from twisted.web import server
 from twisted.web.static import File
 
+from .audio_format import AudioFormat
 from .backing_track import BackingTrack
+from .eventsource_level_meters import EventSourceLevelMeters
 from .eventsource_participants_listener import EventSourceParticipantsListener
 
 # Start a logger with a namespace for a particular subsystem of our application.
 from twisted.logger import Logger
 log = Logger("server_web")
 
+class CountedEventSource(EventSource):
+    """An EventSource that counts the listeners connected to it."""
+    def __init__(self):
+        super().__init__()
+        self.listeners = 0
+
+    def render_GET(self, request):
+        self.listeners += 1
+        def on_finished(_):
+            self.listeners -= 1
+        request.notifyFinish().addBoth(on_finished)
+        return super().render_GET(request)
+
+
 class WebServer:
     def __init__(self, context):
         session_files = context["session_files"]
@@ -34,7 +51,7 @@ class WebServer:
         )
 
         # Event source
-        self.eventsource_resource = EventSource()
+        self.eventsource_resource = CountedEventSource()
         self.root.putChild(b"eventsource", self.eventsource_resource)
 
         # Add event source as a listener of participants
@@ -44,6 +61,13 @@ class WebServer:
                 self.eventsource_resource
             )
 
+        # Publish the participants' audio levels
+        self._eventsource_level_meters = EventSourceLevelMeters(
+            context["udp_server"],
+            self.eventsource_resource
+        )
+        self._eventsource_level_meters.start()
+
         # Backing tracks
         self.backing_track_resource = BackingTrack(
             session_files,
@@ -133,6 +157,11 @@ class WebCommand(resource.Resource):
         self.register_command("stop_for_everyone", self._command_stop_for_everyone)
         self.register_command("prepare_for_recording", self._command_prepare_for_recording)
         self.register_command("record", self._command_record)
+        self.register_command("get_audio_statistics", self._command_get_audio_statistics)
+        self.register_command("start_live_recording", self._command_start_live_recording)
+        self.register_command("stop_live_recording", self._command_stop_live_recording)
+        self.register_command("set_audio_format", self._command_set_audio_format)
+        self.register_command("set_monitor_mix", self._command_set_monitor_mix)
 
     def _command_play_for_everyone(self, content, request):
         try:
@@ -146,21 +175,34 @@ class WebCommand(resource.Resource):
             take_ids = []
 
         try:
-            self._command.play_for_everyone(track_id, take_ids)
+            room = content["room"]
+        except KeyError:
+            room = "default"
+
+        d = defer.maybeDeferred(
+            self._command.play_for_everyone,
+            track_id,
+            take_ids,
+            room
+        )
+        def on_success(_):
             self._success("Started playing for everyone", request)
-        except Exception as e:
-            self._failure(e, request, finish=False)
-            raise
+        d.addCallback(on_success)
+        d.addErrback(self._make_failure(request))
 
         return server.NOT_DONE_YET
             
     def _command_stop_for_everyone(self, content, request):
         try:
-            self._command.stop_for_everyone()
+            room = content["room"]
+        except KeyError:
+            room = "default"
+
+        d = defer.maybeDeferred(self._command.stop_for_everyone, room)
+        def on_success(_):
             self._success("Stopped playing for everyone", request)
-        except Exception as e:
-            self._failure(e, request, finish=False)
-            raise
+        d.addCallback(on_success)
+        d.addErrback(self._make_failure(request))
 
         return server.NOT_DONE_YET
 
@@ -235,7 +277,10 @@ class WebCommand(resource.Resource):
 
         print(f"Record combination id {combination_id} with participants {participants}")
 
-        d = self._command.record(
+        # This also returns a second deferred that resolves once the
+        # recordings have been uploaded; progress is published on the
+        # eventsource, so here we need only respond to the request.
+        d, _ = self._command.record(
             take_name,
             combination_id,
             participants
@@ -244,6 +289,113 @@ class WebCommand(resource.Resource):
         def on_success(_):
             self._success("Recording started", request)
         d.addCallback(on_success)
+        d.addErrback(self._make_failure(
+            request,
+            message="Failed to start recording"
+        ))
         
         return server.NOT_DONE_YET
-        
+
+    def _command_start_live_recording(self, content, request):
+        try:
+            room = content["room"]
+        except KeyError:
+            room = "default"
+
+        try:
+            participants = bool(content["participants"])
+        except KeyError:
+            participants = False
+
+        d = self._command.start_live_recording(room, participants)
+        d.addCallback(self._make_success(request))
+        d.addErrback(self._make_failure(
+            request,
+            message="Failed to start recording"
+        ))
+
+        return server.NOT_DONE_YET
+
+    def _command_stop_live_recording(self, content, request):
+        try:
+            room = content["room"]
+        except KeyError:
+            room = "default"
+
+        d = defer.maybeDeferred(self._command.stop_live_recording, room)
+        d.addCallback(self._make_success(request))
+        d.addErrback(self._make_failure(
+            request,
+            message="Failed to stop recording"
+        ))
+
+        return server.NOT_DONE_YET
+
+    def _command_set_monitor_mix(self, content, request):
+        """Sets a participant's monitor mix.
+
+        The content gives the listener's client_id and, optionally,
+        their gains: an object of gains keyed by client id, and by
+        "playback" for the playback audio.  Without gains, the
+        listener's mix is reset.
+
+        """
+        try:
+            client_id = int(content["client_id"])
+        except (KeyError, ValueError) as e:
+            self._failure(
+                f"A valid client_id is required ({e})",
+                request,
+                finish=True
+            )
+            return server.NOT_DONE_YET
+
+        try:
+            gains = content["gains"]
+        except KeyError:
+            gains = None
+
+        d = self._command.set_monitor_mix(client_id, gains)
+        d.addCallback(self._make_success(request))
+        d.addErrback(self._make_failure(request))
+
+        return server.NOT_DONE_YET
+
+    def _command_set_audio_format(self, content, request):
+        try:
+            room = content["room"]
+        except KeyError:
+            room = "default"
+
+        try:
+            audio_format = AudioFormat.from_dict(content)
+        except Exception as e:
+            self._failure(e, request, finish=True)
+            return server.NOT_DONE_YET
+
+        d = self._command.set_audio_format(audio_format, room)
+        d.addCallback(self._make_success(request))
+        d.addErrback(self._make_failure(request))
+
+        return server.NOT_DONE_YET
+
+    def _command_get_audio_statistics(self, content, request):
+        # The statistics may come from media worker processes, in
+        # which case they'll arrive later
+        d = defer.maybeDeferred(self._command.get_audio_statistics)
+
+        def on_success(statistics):
+            result = {
+                "result":"success",
+                "statistics":statistics
+            }
+            result_json = json.dumps(result).encode("utf-8")
+            request.write(result_json)
+            request.finish()
+        d.addCallback(on_success)
+        d.addErrback(self._make_failure(
+            request,
+            message="Failed to get audio statistics"
+        ))
+
+        return server.NOT_DONE_YET
@@ -22,6 +22,14 @@ class SessionFiles:
 
     def get_audio_path(self, audio_id):
         return self.audio_dir / f"{audio_id}.opus"
+
+    def get_audio_relpath(self, audio_id):
+        path = self.get_audio_path(audio_id)
+        return path.relative_to(self.session_dir)
+
+    def get_participant_audio_path(self, audio_id, client_id):
+        """Path of a participant's own audio within a recording."""
+        return self.audio_dir / f"{audio_id}_{client_id}.opus"
     
     def get_track_relpath(self, track_id):
         path = self.get_track_path(track_id)
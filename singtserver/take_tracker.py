@@ -0,0 +1,246 @@
+import json
+
+from twisted.internet import defer
+
+# Start a logger with a namespace for a particular subsystem of our application.
+from twisted.logger import Logger
+log = Logger("take_tracker")
+
+
+class TakeTracker:
+    """Tracks the recordings of each take until they're uploaded.
+
+    When a take is recorded, each participant records to their own
+    audio id, which identifies the file that they upload once they've
+    finished recording.  track_take() returns a deferred that resolves
+    once every recording of the take has either been uploaded or
+    failed, so that whatever processes the take next can start as
+    soon as the last upload lands.
+
+    As each upload finishes, its recording is marked complete in the
+    database, and once every recording is complete, so is the take.
+
+    A recording fails if its upload doesn't start within
+    recording_timeout seconds of the take being tracked (which must
+    cover the length of the take itself), if nothing is received for
+    upload_timeout seconds once it has started, or if the upload is
+    aborted.  Progress is published on the eventsource as
+    "take_progress" events, and the outcome of each take as a
+    "take_finished" event.
+
+    """
+    def __init__(self, database, eventsource, recording_timeout=3600,
+                 upload_timeout=60, progress_interval=256*1024,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._database = database
+        self._eventsource = eventsource
+        self._recording_timeout = recording_timeout
+        self._upload_timeout = upload_timeout
+        self._progress_interval = progress_interval
+
+        # Recordings yet to be uploaded, keyed by their audio id.
+        # Each is a dict of the take id, client id, the number of
+        # bytes received, and the delayed call of its deadline.
+        self._recordings = {}
+
+        # Takes with recordings yet to be uploaded, keyed by take id.
+        # Each is a dict of the take's deferred, the audio ids of its
+        # outstanding recordings, the client ids of those uploaded,
+        # and the reasons why others failed.
+        self._takes = {}
+
+    def track_take(self, take_id, recording_audio_ids):
+        """Starts tracking the recordings of a take.
+
+        recording_audio_ids is a dict of the audio id of each
+        participant's recording, keyed by client id.
+
+        Returns a deferred that always succeeds, once every recording
+        has been uploaded or has failed, with a dict: "take_id",
+        "uploaded", the list of client ids whose recordings were
+        uploaded, "failed", the reasons why the others failed, keyed
+        by client id, and "complete", True if the take is complete.
+
+        """
+        d = defer.Deferred()
+        self._takes[take_id] = {
+            "deferred": d,
+            "pending": set(recording_audio_ids.values()),
+            "uploaded": [],
+            "failed": {}
+        }
+        for client_id, audio_id in recording_audio_ids.items():
+            self._recordings[audio_id] = {
+                "take_id": take_id,
+                "client_id": client_id,
+                "bytes": 0,
+                "delayed_call": self._reactor.callLater(
+                    self._recording_timeout,
+                    self._on_timeout,
+                    audio_id
+                )
+            }
+            self._publish(audio_id, "recording")
+
+        if len(recording_audio_ids) == 0:
+            self._finish_take(take_id)
+        return d
+
+    def is_tracked(self, audio_id):
+        return audio_id in self._recordings
+
+    def upload_started(self, audio_id):
+        """Notes that a recording's upload has started."""
+        recording = self._get_recording(audio_id)
+        if recording is None:
+            return
+        self._reset_deadline(recording)
+        self._publish(audio_id, "uploading")
+
+    def upload_progress(self, audio_id, byte_count):
+        """Notes that more of a recording has been received."""
+        recording = self._get_recording(audio_id)
+        if recording is None:
+            return
+        self._reset_deadline(recording)
+
+        # Publish only every progress_interval bytes, rather than for
+        # every packet
+        previous_bytes = recording["bytes"]
+        recording["bytes"] += byte_count
+        if (recording["bytes"] // self._progress_interval
+            != previous_bytes // self._progress_interval):
+            self._publish(audio_id, "uploading")
+
+    def upload_finished(self, audio_id):
+        """Marks a recording complete once it has been uploaded.
+
+        Returns a deferred that resolves once the database has been
+        updated.
+
+        """
+        recording = self._get_recording(audio_id)
+        if recording is None or recording["delayed_call"] is None:
+            # The recording isn't tracked, or is already finishing
+            return defer.succeed(None)
+
+        # Stop the deadline while the database is updated
+        recording["delayed_call"].cancel()
+        recording["delayed_call"] = None
+
+        d = self._database.mark_recording_complete(audio_id)
+
+        def on_success(_):
+            self._resolve(audio_id, "uploaded")
+        def on_error(error):
+            self._resolve(
+                audio_id,
+                "failed",
+                f"Failed to mark recording complete: {error.getErrorMessage()}"
+            )
+        d.addCallbacks(on_success, on_error)
+
+        return d
+
+    def upload_failed(self, audio_id, reason):
+        """Fails a recording whose upload went wrong."""
+        if self._get_recording(audio_id) is None:
+            return
+        self._resolve(audio_id, "failed", reason)
+
+    def _get_recording(self, audio_id):
+        try:
+            return self._recordings[audio_id]
+        except KeyError:
+            log.debug(f"Audio id {audio_id} isn't a recording being tracked")
+            return None
+
+    def _reset_deadline(self, recording):
+        # Once the upload has finished, there's no deadline to reset
+        if recording["delayed_call"] is not None:
+            recording["delayed_call"].reset(self._upload_timeout)
+
+    def _on_timeout(self, audio_id):
+        # The delayed call has fired, so mustn't be cancelled
+        recording = self._recordings[audio_id]
+        recording["delayed_call"] = None
+        if recording["bytes"] == 0:
+            reason = "Timed out waiting for the upload"
+        else:
+            reason = (
+                f"Timed out after {self._upload_timeout} seconds "+
+                f"without receiving any of the upload"
+            )
+        self._resolve(audio_id, "failed", reason)
+
+    def _resolve(self, audio_id, state, reason=None):
+        try:
+            recording = self._recordings.pop(audio_id)
+        except KeyError:
+            # The recording has already been resolved
+            return
+        if recording["delayed_call"] is not None:
+            recording["delayed_call"].cancel()
+
+        take_id = recording["take_id"]
+        client_id = recording["client_id"]
+        take = self._takes[take_id]
+        take["pending"].discard(audio_id)
+        if state == "uploaded":
+            take["uploaded"].append(client_id)
+        else:
+            log.warn(
+                f"Recording by client id {client_id} for take id "+
+                f"{take_id} failed: {reason}"
+            )
+            take["failed"][client_id] = reason
+        self._publish(audio_id, state, recording=recording, error=reason)
+
+        if len(take["pending"]) == 0:
+            self._finish_take(take_id)
+
+    def _finish_take(self, take_id):
+        take = self._takes.pop(take_id)
+        result = {
+            "take_id": take_id,
+            "uploaded": take["uploaded"],
+            "failed": take["failed"],
+            "complete": len(take["failed"]) == 0
+        }
+
+        # Client ids are sent as strings, as Javascript's unable to
+        # handle ints larger than 53 bits
+        message = {
+            "take_id": take_id,
+            "uploaded": [str(id_) for id_ in take["uploaded"]],
+            "failed": {
+                str(id_): reason for id_, reason in take["failed"].items()
+            },
+            "complete": result["complete"]
+        }
+        self._eventsource.publish_to_all(
+            "take_finished",
+            json.dumps(message)
+        )
+
+        take["deferred"].callback(result)
+
+    def _publish(self, audio_id, state, recording=None, error=None):
+        if recording is None:
+            recording = self._recordings[audio_id]
+        message = {
+            "take_id": recording["take_id"],
+            "client_id": str(recording["client_id"]),
+            "audio_id": audio_id,
+            "state": state,
+            "bytes": recording["bytes"]
+        }
+        if error is not None:
+            message["error"] = error
+        self._eventsource.publish_to_all(
+            "take_progress",
+            json.dumps(message)
+        )
@@ -35,6 +35,10 @@ SINGT.wireup.eventsource = function(){
     eventSource.addEventListener("update_participants", SINGT.participants.update, false);
     eventSource.addEventListener("update_backing_tracks", SINGT.backing_tracks.update, false);
     eventSource.addEventListener("ready_to_record", SINGT.recording.ready_to_record, false);
+    eventSource.addEventListener("live_recording_ready", SINGT.recording.live_recording_ready, false);
+    eventSource.addEventListener("update_levels", SINGT.participants.update_levels, false);
+    eventSource.addEventListener("download_progress", SINGT.participants.update_download_progress, false);
+    eventSource.addEventListener("take_finished", SINGT.recording.take_finished, false);
     
     eventSource.onerror = function() {
         console.log("Eventsource error");
@@ -91,7 +95,8 @@ SINGT.wireup.page_playback = function(){
 
         // Form command
         command = {
-            "command": "play_for_everyone"
+            "command": "play_for_everyone",
+            "room": $("#playback_room").val()
         }
         if (combo_selection=="track_only" ||
             combo_selection=="mix") {
@@ -128,7 +133,8 @@ SINGT.wireup.page_playback = function(){
 
         // Form command
         command = {
-            "command": "stop_for_everyone"
+            "command": "stop_for_everyone",
+            "room": $("#playback_room").val()
         }
         json_command = JSON.stringify(command);
         
@@ -152,6 +158,73 @@ SINGT.wireup.page_playback = function(){
         return false; // Do not reload page
     });
 
+    SINGT.recording.send_live_recording_command = function(command_name) {
+        // Form command
+        command = {
+            "command": command_name,
+            "room": $("#playback_room").val()
+        }
+        json_command = JSON.stringify(command);
+
+        // Send command
+        console.log("command:", command);
+        $.ajax({
+            type: 'POST',
+            url: 'command',
+            data: json_command,
+            dataType: "json",
+            contentType: "application/json",
+            success: function(msg) {
+                console.log(msg);
+                let recording = (command_name == "start_live_recording");
+                $("#live_recording_button_start").prop("disabled", recording);
+                $("#live_recording_button_stop").prop("disabled", !recording);
+            },
+            error: function(jqXHR, st, error) {
+                alert("FAILED to send command '"+command_name+"'");
+            }
+        });
+    };
+
+    $("#audio_format_button_set").click(function() {
+        console.log("Set audio format button clicked");
+        command = {
+            "command": "set_audio_format",
+            "room": $("#playback_room").val(),
+            "frame_duration_ms": parseInt($("#audio_format_frame_duration").val())
+        }
+        json_command = JSON.stringify(command);
+
+        // Send command
+        console.log("command:", command);
+        $.ajax({
+            type: 'POST',
+            url: 'command',
+            data: json_command,
+            dataType: "json",
+            contentType: "application/json",
+            success: function(msg) {
+                console.log(msg);
+            },
+            error: function(jqXHR, st, error) {
+                alert("FAILED to set the frame size; is the room empty?");
+            }
+        });
+        return false; // Do not reload page
+    });
+
+    $("#live_recording_button_start").click(function() {
+        console.log("Record room button clicked");
+        SINGT.recording.send_live_recording_command("start_live_recording");
+        return false; // Do not reload page
+    });
+
+    $("#live_recording_button_stop").click(function() {
+        console.log("Stop recording button clicked");
+        SINGT.recording.send_live_recording_command("stop_live_recording");
+        return false; // Do not reload page
+    });
+
     disable_inputs = function() {
         $("#playback_select_tracks").prop("disabled",true);
         $("#playback_combos").children("label").addClass("disabled");
@@ -175,6 +248,9 @@ SINGT.wireup.page_playback = function(){
     $("#recording_button_prepare").click(function() {
         console.log("'Prepare for Recording' button clicked");
 
+        // Forget who was ready last time
+        SINGT.recording.ready_participants = undefined;
+
         // Get state of combo selection
         var combo_selection = undefined
         if ($("#playback_combo_track_only").is(":checked")) {
@@ -270,16 +346,20 @@ SINGT.wireup.page_playback = function(){
         // Get combination ID
         combination_id = SINGT.recording.combination_id;
         
-        // Get participants
-        participants =
-            $("#participants")
-            .find("input")
-            .map(function(i, v) {
-                if ($(v).prop("checked")) {
-                    return $(v).val();
-                }
-            })
-            .get(); // get the array
+        // Get participants: those that are ready, if not everyone
+        // managed to prepare
+        participants = SINGT.recording.ready_participants;
+        if (participants === undefined) {
+            participants =
+                $("#participants")
+                .find("input")
+                .map(function(i, v) {
+                    if ($(v).prop("checked")) {
+                        return $(v).val();
+                    }
+                })
+                .get(); // get the array
+        }
 
         // Form command
         command = {
@@ -328,6 +408,9 @@ SINGT.wireup.forms = function() {
 }
 
 SINGT.participants = {};
+// Names of the participants, keyed by client id
+SINGT.participants.names = {};
+
 SINGT.participants.update = function() {
     console.log(event);
     let participants = JSON.parse(event.data);
@@ -347,13 +430,58 @@ SINGT.participants.update = function() {
         let participantsHtml = '';
         for (participant of participants) {
             console.log(participant.name)
-            participantsHtml += '<li class="list-group-item"><img src="./icons/person-badge.svg" alt="" width="32" height="32" title="Person" class="mr-2">' + participant.name + '<div class="form-check float-right"><input class="form-check-input position-static" type="checkbox" checked="checked" id="blankCheckbox" value="'+participant.id+'" aria-label="Include '+participant.name+'"></div></li>';
+            participantsHtml += '<li class="list-group-item"><img src="./icons/person-badge.svg" alt="" width="32" height="32" title="Person" class="mr-2">' + participant.name + '<div class="form-check float-right"><input class="form-check-input position-static" type="checkbox" checked="checked" id="blankCheckbox" value="'+participant.id+'" aria-label="Include '+participant.name+'"></div><div class="progress level-meter mt-2"><div class="progress-bar" role="progressbar" id="level_'+participant.id+'"></div></div><div class="progress download-progress mt-1 d-none"><div class="progress-bar bg-info" role="progressbar" id="download_'+participant.id+'"></div></div></li>';
+            SINGT.participants.names[participant.id] = participant.name;
         }
         $("#participants").html(participantsHtml).removeClass('d-none');
         $('#nav-participants').text(participants.length).removeClass('d-none');
     }
 };
 
+// Converts a level to the width of a meter, as a percentage, on a
+// decibel scale from -60 dBFS to 0 dBFS
+SINGT.participants.level_to_percent = function(level) {
+    if (level <= 0) {
+        return 0;
+    }
+    let decibels = 20 * Math.log10(level);
+    return Math.min(100, Math.max(0, (decibels + 60) / 60 * 100));
+};
+
+SINGT.participants.update_levels = function(event) {
+    let rooms = JSON.parse(event.data);
+
+    for (const room in rooms) {
+        let participants = rooms[room]["participants"];
+        for (const id in participants) {
+            let rms = participants[id][0];
+            let peak = participants[id][1];
+            let meter = $("#level_"+id);
+            meter.css("width", SINGT.participants.level_to_percent(rms)+"%");
+            meter.toggleClass("bg-danger", peak >= 0.99);
+        }
+    }
+};
+
+SINGT.participants.update_download_progress = function(event) {
+    let download = JSON.parse(event.data);
+    let bar = $("#download_"+download["client_id"]);
+    bar.parent().removeClass("d-none");
+
+    let state = download["state"];
+    if (state == "failed") {
+        bar.css("width", "100%");
+        bar.removeClass("bg-info bg-success").addClass("bg-danger");
+        bar.attr("title", download["error"]);
+    } else {
+        bar.css("width", (download["progress"] * 100)+"%");
+        let ready = (state == "downloaded" || state == "cached");
+        bar.removeClass("bg-danger").toggleClass("bg-success", ready);
+        bar.toggleClass("bg-info", !ready);
+        bar.attr("title", "");
+    }
+};
+
 SINGT.participants.server_disconnected = function() {
     $("#participants_server_disconnection").removeClass('d-none');
     $("#no_participants").addClass('d-none');
@@ -464,11 +592,25 @@ SINGT.recording.ready_to_record = function() {
 
     combination_id = parsed_data["combination_id"]
     result = parsed_data["result"]
+    SINGT.recording.ready_participants = parsed_data["ready"];
 
     if (result == "success") {
         // Enable 'Record' button
         $("#recording_button_record").prop("disabled",false);
         $("#recording_response").html("<p>Selected clients are prepared for recording.  Press 'Record' to begin.</p>");
+    } else if (result == "partial") {
+        // Enable 'Record' button, to record without those that failed
+        $("#recording_button_record").prop("disabled",false);
+        let failed = $("<ul></ul>");
+        for (const id in parsed_data["failed"]) {
+            let name = SINGT.participants.names[id] || id;
+            failed.append($("<li></li>").text(
+                name+": "+parsed_data["failed"][id]
+            ));
+        }
+        $("#recording_response")
+            .html("<p>Some clients failed to prepare for recording.  Press 'Record' to begin without them:</p>")
+            .append(failed);
     } else {
         // Alert user that the preparation process went wrong.
         $("#recording_response").html("<p>Bugger.  Something went wrong.  The selected clients are not prepared for recording.  Maybe try again?</p>");
@@ -476,6 +618,39 @@ SINGT.recording.ready_to_record = function() {
     
 };
 
+SINGT.recording.take_finished = function(event) {
+    console.log("Received take-finished update via EventSource")
+    let parsed_data = JSON.parse(event.data);
+    console.log("parsed_data:", parsed_data);
+
+    let message = $("<p></p>").text(
+        "Take "+parsed_data["take_id"]+": received "+
+        parsed_data["uploaded"].length+" recording(s)."
+    );
+    let failed = $("<ul></ul>");
+    for (const id in parsed_data["failed"]) {
+        let name = SINGT.participants.names[id] || id;
+        failed.append($("<li></li>").text(
+            name+": "+parsed_data["failed"][id]
+        ));
+    }
+    $("#recording_response").append(message).append(failed);
+};
+
+SINGT.recording.live_recording_ready = function(event) {
+    console.log("Received live-recording-ready update via EventSource")
+    let parsed_data = JSON.parse(event.data);
+    console.log("parsed_data:", parsed_data);
+
+    // Add a player so the recording can be reviewed straight away
+    let item = $("<div class='mb-2'></div>");
+    item.append($("<p class='mb-1'></p>").text(
+        "Recording of room '"+parsed_data["room"]+"'"
+    ));
+    item.append($("<audio controls></audio>").attr("src", parsed_data["url"]));
+    $("#live_recordings").append(item);
+};
+
 
 $(document).ready(function(){
     SINGT.wireup();
@@ -0,0 +1,25 @@
+# Helpers shared by the tests.
+
+import json
+
+
+class FakeEventSource:
+    """Records the events published, with their JSON data decoded."""
+    def __init__(self):
+        self.events = []
+        self.initialisers = []
+        self.listeners = 1
+
+    def add_initialiser(self, initialiser):
+        self.initialisers.append(initialiser)
+
+    def publish_to_all(self, event, data):
+        self.events.append((event, json.loads(data)))
+
+
+def get_result(d):
+    """Returns the result (or failure) of a deferred that has fired."""
+    results = []
+    d.addBoth(results.append)
+    assert len(results) == 1
+    return results[0]
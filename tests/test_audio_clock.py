@@ -0,0 +1,84 @@
+from twisted.internet import task
+
+from singtserver.audio_clock import AudioClock
+
+def create_audio_clock(frames, missed, idle=lambda: False):
+    reactor = task.Clock()
+    audio_clock = AudioClock(
+        reactor,
+        0.02,
+        lambda: frames.append(reactor.seconds()),
+        missed.append,
+        is_idle=idle,
+        monotonic=reactor.seconds
+    )
+    return reactor, audio_clock
+
+def test_frames_follow_the_deadline():
+    frames = []
+    missed = []
+    reactor, audio_clock = create_audio_clock(frames, missed)
+    audio_clock.wake()
+    reactor.advance(0)
+    reactor.pump([0.02] * 5)
+
+    assert len(frames) == 6
+    assert missed == []
+    assert audio_clock.get_statistics()["max_lateness_ms"] < 1e-6
+
+def test_missed_frames_are_not_processed_in_a_burst():
+    frames = []
+    missed = []
+    reactor, audio_clock = create_audio_clock(frames, missed)
+    audio_clock.wake()
+    reactor.advance(0)
+
+    # Stall for three and a half frames
+    reactor.advance(0.07)
+
+    assert len(frames) == 2
+    assert missed == [2]
+    statistics = audio_clock.get_statistics()
+    assert statistics["missed_frames"] == 2
+    assert round(statistics["max_lateness_ms"]) == 10
+
+def test_clock_goes_idle():
+    frames = []
+    missed = []
+    idle = [False]
+    reactor, audio_clock = create_audio_clock(frames, missed, lambda: idle[0])
+    audio_clock.wake()
+    reactor.advance(0)
+    assert audio_clock.running
+
+    idle[0] = True
+    reactor.advance(0.02)
+    assert not audio_clock.running
+    assert len(reactor.getDelayedCalls()) == 0
+
+    audio_clock.wake()
+    assert audio_clock.running
+
+def test_load_is_the_fraction_of_each_interval_spent_processing():
+    reactor = task.Clock()
+    offset = [0]
+    def on_frame():
+        # Each frame takes half an interval
+        offset[0] += 0.01
+    audio_clock = AudioClock(
+        reactor,
+        0.02,
+        on_frame,
+        lambda missed: None,
+        monotonic=lambda: reactor.seconds() + offset[0],
+        smoothing=0.5
+    )
+    assert audio_clock.load == 0
+
+    audio_clock.wake()
+    reactor.advance(0)
+    reactor.pump([0.01] * 40)
+
+    assert abs(audio_clock.load - 0.5) < 0.01
+    audio_clock.stop()
+    assert audio_clock.load == 0
@@ -0,0 +1,24 @@
+from singtserver.audio_format import AudioFormat
+
+def test_default_format():
+    audio_format = AudioFormat()
+    assert audio_format.samples_per_frame == 960
+    assert audio_format.frame_duration == 0.02
+
+def test_low_latency_format():
+    audio_format = AudioFormat(frame_duration_ms=5)
+    assert audio_format.samples_per_frame == 240
+
+def test_formats_compare_by_value():
+    audio_format = AudioFormat(16000, 1, 10)
+    assert AudioFormat.from_dict(audio_format.to_dict()) == audio_format
+    assert hash(AudioFormat(16000, 1, 10)) == hash(audio_format)
+    assert AudioFormat() != audio_format
+
+def test_unsupported_frame_duration_fails():
+    try:
+        AudioFormat(frame_duration_ms=15)
+    except Exception as e:
+        assert "frame duration" in str(e)
+    else:
+        raise AssertionError("Expected an exception")
@@ -0,0 +1,40 @@
+import threading
+
+import pytest
+
+from singtserver.codec_workers import CodecWorkerPool
+
+def test_every_item_is_processed_once():
+    pool = CodecWorkerPool(4)
+    items = [{"value": i} for i in range(10)]
+
+    def double(item):
+        item["value"] *= 2
+        item["thread"] = threading.current_thread().name
+    pool.run(double, items)
+    pool.stop()
+
+    assert [item["value"] for item in items] == list(range(0, 20, 2))
+
+    # Items are partitioned across the workers
+    assert items[0]["thread"] == items[4]["thread"]
+    assert items[0]["thread"] != items[1]["thread"]
+
+def test_single_worker_runs_inline():
+    pool = CodecWorkerPool(1)
+    threads = []
+    pool.run(lambda item: threads.append(threading.current_thread()), [1, 2])
+    assert threads == [threading.current_thread()] * 2
+
+def test_exceptions_are_reraised():
+    pool = CodecWorkerPool(2)
+
+    def fail(item):
+        if item == 3:
+            raise ValueError("item 3")
+    with pytest.raises(ValueError):
+        pool.run(fail, [1, 2, 3, 4])
+
+    # The pool is still usable afterwards
+    pool.run(lambda item: None, [1, 2, 3, 4])
+    pool.stop()
@@ -0,0 +1,41 @@
+import hashlib
+import os
+from pathlib import Path
+
+from twisted.internet import defer
+
+from helpers import get_result
+from singtserver.content_hashes import ContentHashes
+
+
+def create_file(test_name, contents):
+    path = Path.cwd() / ("test_content_hashes__"+test_name+".opus")
+    path.write_bytes(contents)
+    return path
+
+def test_hash_is_remembered():
+    path = create_file("test_hash_is_remembered", b"some audio")
+    calls = []
+    def defer_to_thread(function, *args):
+        calls.append(args)
+        return defer.succeed(function(*args))
+    content_hashes = ContentHashes(defer_to_thread=defer_to_thread)
+
+    expected = hashlib.sha256(b"some audio").hexdigest()
+    assert get_result(content_hashes.get_hash(path)) == expected
+    assert get_result(content_hashes.get_hash(path)) == expected
+    assert len(calls) == 1
+
+    # Changing the file means it's hashed again
+    path.write_bytes(b"some other audio")
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    expected = hashlib.sha256(b"some other audio").hexdigest()
+    assert get_result(content_hashes.get_hash(path)) == expected
+    assert len(calls) == 2
+
+def test_missing_file_fails():
+    content_hashes = ContentHashes()
+    d = content_hashes.get_hash(Path.cwd() / "test_content_hashes__missing")
+    failure = get_result(d)
+    assert failure.check(FileNotFoundError)
@@ -0,0 +1,92 @@
+from twisted.internet import task
+
+from helpers import FakeEventSource
+from helpers import get_result
+from singtserver.download_coordinator import DownloadCoordinator
+from singtserver.download_coordinator import gather_downloads
+from singtserver.download_coordinator import merge_download_results
+
+
+def create_coordinator(timeout=10):
+    clock = task.Clock()
+    eventsource = FakeEventSource()
+    coordinator = DownloadCoordinator(eventsource, timeout=timeout, reactor=clock)
+    return coordinator, clock, eventsource
+
+def test_complete():
+    coordinator, clock, eventsource = create_coordinator()
+    d = coordinator.request(1, 10)
+    assert coordinator.is_pending(1, 10)
+    coordinator.update_progress(1, 10, 0.5)
+    coordinator.complete(1, 10)
+    assert get_result(d) == (1, 10)
+    assert not coordinator.is_pending(1, 10)
+    assert [event["state"] for _, event in eventsource.events] == [
+        "requested", "downloading", "downloaded"
+    ]
+    assert eventsource.events[1][1]["progress"] == 0.5
+    assert eventsource.events[1][1]["client_id"] == "1"
+
+    # The deadline was cancelled
+    assert len(clock.getDelayedCalls()) == 0
+
+def test_timeout():
+    coordinator, clock, eventsource = create_coordinator(timeout=10)
+    d = coordinator.request(1, 10)
+    clock.advance(10)
+    failure = get_result(d)
+    assert "Timed out" in failure.getErrorMessage()
+    assert not coordinator.is_pending(1, 10)
+    assert eventsource.events[-1][1]["state"] == "failed"
+
+def test_progress_resets_deadline():
+    coordinator, clock, eventsource = create_coordinator(timeout=10)
+    d = coordinator.request(1, 10)
+    for _ in range(5):
+        clock.advance(8)
+        coordinator.update_progress(1, 10, 0.1)
+    assert coordinator.is_pending(1, 10)
+    clock.advance(10)
+    assert not coordinator.is_pending(1, 10)
+    get_result(d)
+
+def test_cancel_client():
+    coordinator, clock, eventsource = create_coordinator()
+    d1 = coordinator.request(1, 10)
+    d2 = coordinator.request(1, 11)
+    d3 = coordinator.request(2, 10)
+    coordinator.cancel_client(1)
+    assert "Connection lost" in get_result(d1).getErrorMessage()
+    assert "Connection lost" in get_result(d2).getErrorMessage()
+    assert coordinator.is_pending(2, 10)
+    assert len(clock.getDelayedCalls()) == 1
+    coordinator.complete(2, 10)
+    assert get_result(d3) == (2, 10)
+
+def test_gather_downloads():
+    coordinator, clock, eventsource = create_coordinator(timeout=10)
+    d = gather_downloads({
+        client_id: coordinator.request(client_id, 10)
+        for client_id in [1, 2, 3]
+    })
+    coordinator.complete(1, 10)
+    coordinator.fail(2, 10, "Disk full")
+
+    # One straggler holds things up only until their deadline
+    clock.advance(10)
+    result = get_result(d)
+    assert result["ready"] == [1]
+    assert result["failed"][2] == "Disk full"
+    assert "Timed out" in result["failed"][3]
+
+def test_merge_download_results():
+    results = [
+        {"ready": [1, 2, 3], "failed": {}},
+        {"ready": [1, 3], "failed": {2: "Disk full"}},
+    ]
+    result = merge_download_results(results, [1, 2, 3])
+    assert result == {"ready": [1, 3], "failed": {2: "Disk full"}}
+
+    # Without downloads, everyone's ready
+    result = merge_download_results([], [1, 2])
+    assert result == {"ready": [1, 2], "failed": {}}
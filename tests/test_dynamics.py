@@ -0,0 +1,85 @@
+import numpy
+
+from singtserver.dynamics import AutomaticGainControl
+from singtserver.dynamics import LookAheadLimiter
+from singtserver.dynamics import MixBusDynamics
+from singtserver.dynamics import soft_clip
+
+def test_automatic_gain_control_levels_sources():
+    agc = AutomaticGainControl(480, 3, target_rms=0.1)
+    frames = numpy.zeros((3, 480), dtype=numpy.float32)
+    active = numpy.array([True, True, False])
+
+    for _ in range(100):
+        frames[0] = 0.04
+        frames[1] = 0.5
+        frames[2] = 0.3
+        agc.apply(frames, active)
+
+    assert numpy.allclose(frames[0], 0.1, rtol=0.01)
+    assert numpy.allclose(frames[1], 0.1, rtol=0.01)
+    # Inactive sources are untouched
+    assert numpy.allclose(frames[2], 0.3)
+    assert agc.gains[2] == 1
+
+def test_automatic_gain_control_holds_gain_below_gate():
+    agc = AutomaticGainControl(480, 1, gate_rms=0.005)
+    frames = numpy.full((1, 480), 0.001, dtype=numpy.float32)
+    agc.apply(frames, numpy.array([True]))
+    assert agc.gains[0] == 1
+
+def test_limiter_keeps_signals_below_threshold():
+    limiter = LookAheadLimiter(480, 2, threshold=0.9, lookahead=48)
+    assert limiter.latency == 48
+
+    outputs = []
+    for frame in range(5):
+        signals = numpy.zeros((2, 480), dtype=numpy.float32)
+        signals[0] = 0.5
+        if frame == 2:
+            # A sudden peak, part way through the frame
+            signals[0, 200:210] = 3.0
+        signals[1] = 0.5
+        limiter.apply(signals)
+        outputs.append(signals.copy())
+    outputs = numpy.concatenate(outputs, axis=1)
+
+    assert numpy.all(numpy.abs(outputs) <= 0.9 + 1e-6)
+    # The peak is delayed by the look-ahead
+    assert numpy.isclose(outputs[0, 2*480+200+48], 0.9)
+    # A quiet signal passes through unchanged, once delayed
+    assert numpy.allclose(outputs[1, 48:], 0.5)
+
+def test_limiter_block_divides_the_frame():
+    limiter = LookAheadLimiter(882, 1, lookahead=48)
+    assert limiter.latency == 42
+
+def test_soft_clip():
+    signals = numpy.array([[0.5, -0.5, 0.9, -2.0, 100.0]], dtype=numpy.float32)
+    soft_clip(signals, knee=0.8)
+    assert signals[0, 0] == 0.5 and signals[0, 1] == -0.5
+    assert 0.8 < signals[0, 2] < 0.9
+    assert -1 <= signals[0, 3] < -0.8
+    assert signals[0, 4] <= 1
+
+def test_loud_signals_below_the_threshold_are_untouched():
+    dynamics = MixBusDynamics(480, 1, threshold=0.9)
+    outputs = []
+    for _ in range(3):
+        signals = numpy.full((2, 480), 0.85, dtype=numpy.float32)
+        dynamics.process_outputs(signals)
+        outputs.append(signals.copy())
+    outputs = numpy.concatenate(outputs, axis=1)
+
+    # Once delayed by the limiter, the signal is neither limited nor
+    # clipped
+    latency = dynamics.limiter.latency
+    assert numpy.all(outputs[:, latency:] == numpy.float32(0.85))
+
+def test_knee_below_threshold_fails():
+    try:
+        MixBusDynamics(480, 1, threshold=0.9, knee=0.8)
+    except Exception as e:
+        assert "knee" in str(e)
+    else:
+        raise AssertionError("Expected an exception")
@@ -0,0 +1,61 @@
+from twisted.internet import defer
+from twisted.internet import task
+
+from helpers import FakeEventSource
+from singtserver.eventsource_level_meters import EventSourceLevelMeters
+
+class SlowUDPServer:
+    def __init__(self):
+        self.requests = []
+        self.clients = True
+
+    def has_clients(self):
+        return self.clients
+
+    def get_levels(self):
+        d = defer.Deferred()
+        self.requests.append(d)
+        return d
+
+def test_levels_are_published_on_their_own_schedule():
+    clock = task.Clock()
+    udp_server = SlowUDPServer()
+    eventsource = FakeEventSource()
+    meters = EventSourceLevelMeters(udp_server, eventsource, interval=0.1)
+    meters._looping_call.clock = clock
+    meters.start()
+
+    clock.advance(0.1)
+    # The first request hasn't been answered, so none is made
+    clock.advance(0.1)
+    assert len(udp_server.requests) == 1
+
+    levels = {"default": {"mix": [0.1, 0.2], "participants": {}}}
+    udp_server.requests[0].callback(levels)
+    assert eventsource.events == [("update_levels", levels)]
+
+    clock.advance(0.1)
+    assert len(udp_server.requests) == 2
+    meters.stop()
+
+def test_nothing_is_read_without_clients_or_listeners():
+    clock = task.Clock()
+    udp_server = SlowUDPServer()
+    eventsource = FakeEventSource()
+    meters = EventSourceLevelMeters(udp_server, eventsource, interval=0.1)
+    meters._looping_call.clock = clock
+    meters.start()
+
+    udp_server.clients = False
+    clock.advance(0.1)
+    assert len(udp_server.requests) == 0
+
+    udp_server.clients = True
+    eventsource.listeners = 0
+    clock.advance(0.1)
+    assert len(udp_server.requests) == 0
+
+    eventsource.listeners = 1
+    clock.advance(0.1)
+    assert len(udp_server.requests) == 1
+    meters.stop()
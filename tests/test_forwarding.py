@@ -0,0 +1,42 @@
+import pytest
+
+from singtserver.forwarding import pack_bundle
+from singtserver.forwarding import unpack_bundle
+from singtserver.forwarding import SpeakerSelector
+
+def test_bundle_round_trip():
+    packets = [(0, b"playback"), (2**64-1, b"\x01\x02\x03"), (42, b"")]
+    data = pack_bundle(packets)
+    assert unpack_bundle(data) == packets
+
+def test_empty_bundle():
+    assert unpack_bundle(pack_bundle([])) == []
+
+def test_truncated_bundle_fails():
+    data = pack_bundle([(1, b"abc")])
+    with pytest.raises(Exception):
+        unpack_bundle(data[:-1])
+
+def test_selects_most_active_speakers():
+    selector = SpeakerSelector(2, smoothing=1)
+    selected = selector.select([
+        (1, b"x"*10),
+        (2, b"x"*100),
+        (3, b"x"*50),
+        (4, None)
+    ])
+    assert [source_id for source_id, _ in selected] == [2, 3]
+
+def test_dtx_packets_are_not_selected():
+    selector = SpeakerSelector(3)
+    selected = selector.select([(1, b"\x00"), (2, None), (3, b"x"*20)])
+    assert selected == [(3, b"x"*20)]
+
+def test_activity_is_smoothed():
+    selector = SpeakerSelector(1, smoothing=0.5)
+    for _ in range(10):
+        selector.select([(1, b"x"*100), (2, b"x"*10)])
+
+    # A single large packet from a quiet source doesn't win
+    selected = selector.select([(1, b"x"*100), (2, b"x"*150)])
+    assert selected[0][0] == 1
@@ -0,0 +1,98 @@
+from singtserver.jitter_buffer import AdaptiveJitterBuffer
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def create_jitter_buffer(**kwargs):
+    clock = FakeClock()
+    jitter_buffer = AdaptiveJitterBuffer(0.02, monotonic=clock, **kwargs)
+    return clock, jitter_buffer
+
+def test_buffers_before_playing():
+    clock, jitter_buffer = create_jitter_buffer(initial_depth=2)
+    jitter_buffer.put_packet(0, b"0")
+    assert jitter_buffer.get_packet() is None
+    jitter_buffer.put_packet(1, b"1")
+    assert jitter_buffer.get_packet() == b"0"
+    assert jitter_buffer.get_packet() == b"1"
+
+def test_reorders_and_reports_loss():
+    clock, jitter_buffer = create_jitter_buffer(initial_depth=2,
+                                                adaptation_window=4)
+    jitter_buffer.put_packet(1, b"1")
+    jitter_buffer.put_packet(0, b"0")
+    jitter_buffer.put_packet(3, b"3")
+    assert jitter_buffer.get_packet() == b"0"
+    assert jitter_buffer.get_packet() == b"1"
+    assert jitter_buffer.peek_packet(1) == b"3"
+    assert jitter_buffer.get_packet() is None
+    assert jitter_buffer.get_packet() == b"3"
+    assert jitter_buffer.loss_rate == 1/4
+
+    # A packet that turns up after its turn is discarded
+    jitter_buffer.put_packet(2, b"2")
+    assert jitter_buffer.get_statistics()["late"] == 1
+
+def test_sequence_numbers_wrap():
+    clock, jitter_buffer = create_jitter_buffer(initial_depth=1)
+    jitter_buffer.put_packet(2**16-1, b"a")
+    jitter_buffer.put_packet(0, b"b")
+    assert jitter_buffer.get_packet() == b"a"
+    assert jitter_buffer.get_packet() == b"b"
+
+def test_underrun_grows_depth():
+    clock, jitter_buffer = create_jitter_buffer(initial_depth=1)
+    jitter_buffer.put_packet(0, b"audio")
+    assert jitter_buffer.get_packet() == b"audio"
+    assert jitter_buffer.get_packet() is None
+    assert jitter_buffer.depth == 2
+    assert jitter_buffer.get_statistics()["underruns"] == 1
+
+def test_gap_after_dtx_packet_is_not_loss():
+    clock, jitter_buffer = create_jitter_buffer(initial_depth=1,
+                                                adaptation_window=10)
+    jitter_buffer.put_packet(0, b"audio")
+    assert jitter_buffer.get_packet() == b"audio"
+    clock.now = 0.02
+    jitter_buffer.put_packet(1, b"\0")
+    assert jitter_buffer.get_packet() == b"\0"
+
+    # The client stops sending while they're silent, which isn't an
+    # underrun, doesn't grow the buffer, and isn't jitter
+    for _ in range(8):
+        assert jitter_buffer.get_packet() is None
+    statistics = jitter_buffer.get_statistics()
+    assert statistics["underruns"] == 0
+    assert statistics["lost"] == 0
+    assert jitter_buffer.depth == 1
+    assert jitter_buffer.loss_rate == 0
+
+    clock.now = 1
+    jitter_buffer.put_packet(2, b"audio")
+    assert jitter_buffer.get_packet() == b"audio"
+    assert jitter_buffer.get_statistics()["jitter_ms"] == 0
+
+def test_depth_follows_jitter():
+    clock, jitter_buffer = create_jitter_buffer(
+        initial_depth=5,
+        adaptation_window=50
+    )
+
+    # Perfectly timed packets shrink the buffer to the minimum
+    for seq_no in range(200):
+        clock.now = seq_no * 0.02
+        jitter_buffer.put_packet(seq_no, b"audio")
+        jitter_buffer.get_packet()
+    assert jitter_buffer.depth == 1
+
+    # Packets arriving in bursts grow it
+    for seq_no in range(200, 400):
+        clock.now = (seq_no // 4) * 4 * 0.02 + 0.1
+        jitter_buffer.put_packet(seq_no, b"audio")
+        if seq_no % 4 == 3:
+            for _ in range(4):
+                jitter_buffer.get_packet()
+    assert jitter_buffer.depth > 1
@@ -0,0 +1,230 @@
+import json
+
+from twisted.internet import defer
+from twisted.internet import task
+
+from singtserver.audio_format import AudioFormat
+from singtserver.media_workers import MediaWorkerPool
+
+class FakeWorkerProtocol:
+    def __init__(self):
+        self.sent = []
+        self.transport = None
+        self.ended = defer.succeed(None)
+
+    def send(self, message):
+        self.sent.append(message)
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def write(self, data):
+        self.sent.append(json.loads(data))
+
+class FakeReactor(task.Clock):
+    def __init__(self):
+        super().__init__()
+        self.spawned = []
+
+    def spawnProcess(self, process_protocol, executable, args, **kwargs):
+        process_protocol.transport = FakeTransport()
+        self.spawned.append(process_protocol)
+
+class FakeTCPProtocol:
+    def __init__(self):
+        self.reannounce_requests = 0
+
+    def send_reannounce_request(self):
+        self.reannounce_requests += 1
+
+class FakeTCPServerFactory:
+    def __init__(self):
+        self.protocols = {}
+
+    def get_protocol(self, client_id):
+        return self.protocols.get(client_id)
+
+class FakeParticipants:
+    def __init__(self):
+        self.calls = []
+
+    def join_udp(self, client_id):
+        self.calls.append(("join_udp", client_id))
+
+    def leave(self, client_id):
+        self.calls.append(("leave", client_id))
+
+def make_pool(workers, reactor=None):
+    participants = FakeParticipants()
+    context = {
+        "participants": participants,
+        "tcp_server_factory": FakeTCPServerFactory()
+    }
+    pool = MediaWorkerPool(context, workers, 1000,
+                           reactor=reactor or FakeReactor())
+    pool._protocols = [FakeWorkerProtocol() for _ in range(workers)]
+    return pool, participants
+
+def find_room_on_worker(pool, index):
+    for number in range(1000):
+        room = f"room-{number}"
+        if pool.get_udp_port(room) == 1000 + index:
+            return room
+
+def test_default_room_is_on_first_worker():
+    pool, _ = make_pool(4)
+    assert pool.get_udp_port("default") == 1000
+
+def test_assign_room_moves_client_between_workers():
+    pool, _ = make_pool(2)
+    room = find_room_on_worker(pool, 1)
+
+    port = pool.assign_room(42, room)
+    assert port == 1001
+    worker_0, worker_1 = pool._protocols
+    assert worker_0.sent == [
+        {"command": "remove_client", "client_id": 42, "leave": False}
+    ]
+    assert worker_1.sent == [
+        {"command": "assign_room", "client_id": 42, "room": room}
+    ]
+
+def test_events_are_passed_to_participants():
+    pool, participants = make_pool(1)
+    pool._process_event(0, {"event": "join_udp", "client_id": 7})
+    pool._process_event(0, {"event": "leave", "client_id": 7})
+    assert participants.calls == [("join_udp", 7), ("leave", 7)]
+
+def test_statistics_are_gathered_from_every_worker():
+    pool, _ = make_pool(2)
+    results = []
+    pool.get_audio_statistics().addCallback(results.append)
+
+    for index, worker in enumerate(pool._protocols):
+        request_id = worker.sent[0]["request_id"]
+        pool._process_event(index, {
+            "event": "reply",
+            "request_id": request_id,
+            "result": {"connections": index}
+        })
+
+    assert results == [{"workers": [
+        {"connections": 0, "udp_port": 1000},
+        {"connections": 1, "udp_port": 1001}
+    ]}]
+
+def test_failed_request():
+    pool, _ = make_pool(1)
+    failures = []
+    pool.stop_recording().addErrback(failures.append)
+    request_id = pool._protocols[0].sent[0]["request_id"]
+    pool._process_event(0, {
+        "event": "reply",
+        "request_id": request_id,
+        "error": "Room 'default' is not recording"
+    })
+    assert "not recording" in str(failures[0].value)
+
+def test_ended_worker_fails_its_requests():
+    pool, _ = make_pool(1)
+    failures = []
+    pool.get_audio_statistics().addErrback(failures.append)
+    pool._worker_ended(0)
+    assert len(failures) == 1
+
+def test_audio_format_is_set_once_the_worker_replies():
+    pool, _ = make_pool(1)
+    audio_format = AudioFormat(frame_duration_ms=10)
+    pool.set_audio_format(audio_format, room="choir")
+    assert pool.get_audio_format("choir") == AudioFormat()
+
+    request_id = pool._protocols[0].sent[0]["request_id"]
+    pool._process_event(0, {
+        "event": "reply",
+        "request_id": request_id,
+        "result": None
+    })
+    assert pool.get_audio_format("choir") == audio_format
+    assert pool.get_audio_format("default") == AudioFormat()
+
+def reply(pool, index, **result):
+    request = pool._protocols[index].sent[-1]
+    pool._process_event(index, dict(
+        event="reply",
+        request_id=request["request_id"],
+        **result
+    ))
+
+def test_playback_errors_are_passed_on():
+    pool, _ = make_pool(1)
+    results = []
+    pool.play_audio(["a.opus"]).addBoth(results.append)
+    assert pool._protocols[0].sent[0]["command"] == "play_audio"
+    reply(pool, 0, error="Failed to open OpusFileStream")
+    assert "Failed to open" in str(results[0].value)
+
+    pool.start_recording("mix.opus").addBoth(results.append)
+    reply(pool, 0, result=None)
+    assert results[1] is None
+
+def test_moving_between_workers_isnt_leaving():
+    pool, participants = make_pool(2)
+    room = find_room_on_worker(pool, 1)
+
+    pool.assign_room(42, "default")
+    pool._process_event(0, {"event": "join_udp", "client_id": 42})
+    pool.assign_room(42, room)
+    pool._process_event(1, {"event": "join_udp", "client_id": 42})
+    assert participants.calls == [("join_udp", 42)]
+
+    # When they disconnect, they leave just once
+    pool.remove_client(42)
+    assert participants.calls == [("join_udp", 42), ("leave", 42)]
+    for worker in pool._protocols:
+        assert worker.sent[-1] == {
+            "command": "remove_client",
+            "client_id": 42,
+            "leave": False
+        }
+
+def test_crashed_worker_is_restarted():
+    reactor = FakeReactor()
+    pool, _ = make_pool(2, reactor)
+    room = find_room_on_worker(pool, 1)
+    pool.assign_room(42, room)
+    tcp_protocol = FakeTCPProtocol()
+    pool._context["tcp_server_factory"].protocols[42] = tcp_protocol
+
+    pool._worker_ended(1)
+
+    # Until it's restarted, the worker's rooms fail loudly
+    failures = []
+    pool.play_audio(["a.opus"], room=room).addErrback(failures.append)
+    assert "not running" in str(failures[0].value)
+
+    # Once it's restarted, its clients are put back in their rooms and
+    # asked to announce themselves to it
+    reactor.advance(1)
+    assert len(reactor.spawned) == 1
+    assert pool._protocols[1] is reactor.spawned[0]
+    assert reactor.spawned[0].transport.sent == [
+        {"command": "assign_room", "client_id": 42, "room": room}
+    ]
+    assert tcp_protocol.reannounce_requests == 1
+
+def test_stopped_worker_isnt_restarted():
+    reactor = FakeReactor()
+    pool, _ = make_pool(1, reactor)
+    pool.stop()
+    pool._worker_ended(0)
+    reactor.advance(10)
+    assert reactor.spawned == []
+
+def test_workers_reannounce_requests_reach_the_client():
+    pool, participants = make_pool(1)
+    tcp_protocol = FakeTCPProtocol()
+    pool._context["tcp_server_factory"].protocols[42] = tcp_protocol
+    pool._process_event(0, {"event": "reannounce", "client_id": 42})
+    assert tcp_protocol.reannounce_requests == 1
+    assert participants.calls == []
@@ -0,0 +1,33 @@
+import numpy
+
+from singtserver.meters import LevelMeters
+from singtserver.mixer import Mixer
+
+def test_levels_accumulate_until_read():
+    meters = LevelMeters(2)
+    signals = numpy.zeros((2, 4), dtype=numpy.float32)
+    signals[0] = [0.5, -0.5, 0.5, -0.5]
+    signals[1] = [0, 0, -0.8, 0]
+    meters.measure(signals)
+    signals[0] = 0
+    meters.measure(signals)
+
+    rms, peaks = meters.read(2)
+    assert numpy.allclose(rms, [0.5 / numpy.sqrt(2), 0.4 / 1])
+    assert numpy.allclose(peaks, [0.5, 0.8])
+
+    rms, peaks = meters.read(2)
+    assert numpy.all(rms == 0) and numpy.all(peaks == 0)
+
+def test_mixer_meters_sources_and_mix():
+    mixer = Mixer(4, dynamics=False)
+    slot_a = mixer.add_source()
+    slot_b = mixer.add_source()
+    mixer.get_frame(slot_a)[:] = 0.25
+    mixer.clear_frame(slot_b)
+    mixer.mix()
+
+    source_rms, source_peaks, mix_rms, mix_peak = mixer.read_levels()
+    assert numpy.allclose(source_rms, [0.25, 0])
+    assert numpy.allclose(source_peaks, [0.25, 0])
+    assert numpy.isclose(mix_rms, 0.25) and numpy.isclose(mix_peak, 0.25)
@@ -0,0 +1,120 @@
+import concurrent.futures
+from pathlib import Path
+
+import numpy
+
+from helpers import get_result
+from singtserver import mixdown
+from singtserver import SessionFiles
+from singtserver.mixdown import MixdownRenderer
+from singtserver.mixdown import render_mixdown
+
+class FakeOpusFileStream:
+    """Returns stereo int16 buffers of a constant, like OpusFileStream."""
+    def __init__(self, value, total_samples):
+        self._value = value
+        self._remaining = total_samples
+
+    def get_buffer_as_array(self):
+        if self._remaining == 0:
+            return None
+        count = min(self._remaining, 500)
+        self._remaining -= count
+        return numpy.full((count, 2), self._value, dtype=numpy.int16)
+
+class FakeWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.encoded = []
+
+    def encode(self, pcm_bytes):
+        self.encoded.append(numpy.frombuffer(pcm_bytes, dtype=numpy.int16))
+
+    def close(self):
+        Path(self.filename).write_bytes(b"mixdown")
+
+class FakeExecutor:
+    """Runs a render function straight away in place of the one submitted."""
+    def __init__(self, render):
+        self.submitted = []
+        self._render = render
+
+    def submit(self, function, *args):
+        self.submitted.append(args)
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(self._render(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def create_renderer(test_name, executor):
+    session_files = SessionFiles(Path.cwd() / ("test_mixdown__"+test_name))
+    return MixdownRenderer(
+        session_files,
+        executor=executor,
+        call_from_thread=lambda function, *args: function(*args)
+    )
+
+def test_render_mixdown(monkeypatch):
+    streams = {
+        "track.opus": FakeOpusFileStream(8000, 2000),
+        "take.opus": FakeOpusFileStream(4000, 1000),
+    }
+    writers = []
+    def create_writer(filename, samples_per_second, channels):
+        writer = FakeWriter(filename)
+        writers.append(writer)
+        return writer
+    monkeypatch.setattr(mixdown.pyogg, "OpusFileStream", streams.get, raising=False)
+    monkeypatch.setattr(mixdown, "_create_writer", create_writer)
+
+    output = Path.cwd() / "test_mixdown__render.opus"
+    render_mixdown(["track.opus", "take.opus"], [0.5, 0.5], output,
+                   samples_per_frame=100)
+
+    # The partial file was renamed once complete
+    assert output.read_bytes() == b"mixdown"
+    assert not Path(str(output) + ".partial").exists()
+
+    # The take is mixed in until it finishes, then the track plays
+    # on alone
+    pcm = numpy.concatenate(writers[0].encoded)
+    assert len(pcm) == 2000
+    assert numpy.all(numpy.abs(pcm[:1000] - 6000) <= 1)
+    assert numpy.all(numpy.abs(pcm[1000:] - 4000) <= 1)
+
+def test_mixdown_is_reused():
+    def render(filenames, gains, path):
+        Path(path).write_bytes(b"mixdown")
+        return path
+    executor = FakeExecutor(render)
+    renderer = create_renderer("test_mixdown_is_reused", executor)
+
+    path = get_result(renderer.render(42, ["a.opus", "b.opus"]))
+    assert path == renderer.get_path(42)
+    assert renderer.has_mixdown(42)
+    assert executor.submitted[0][1] == [0.5, 0.5]
+
+    # A second request uses the existing file
+    assert get_result(renderer.render(42, ["a.opus", "b.opus"])) == path
+    assert len(executor.submitted) == 1
+
+def test_concurrent_requests_share_render():
+    futures = []
+    class PendingExecutor:
+        def submit(self, function, *args):
+            futures.append(concurrent.futures.Future())
+            return futures[-1]
+    renderer = create_renderer("test_concurrent_requests_share_render",
+                               PendingExecutor())
+    results = []
+    renderer.render(7, ["a.opus", "b.opus"]).addBoth(results.append)
+    renderer.render(7, ["a.opus", "b.opus"]).addBoth(results.append)
+    assert len(futures) == 1
+    assert results == []
+
+    futures[0].set_exception(Exception("Corrupt file"))
+    assert len(results) == 2
+    assert all(result.getErrorMessage() == "Corrupt file" for result in results)
+    assert not renderer.has_mixdown(7)
@@ -0,0 +1,104 @@
+import numpy
+
+from singtserver.mixer import Mixer
+
+def test_mix_minus():
+    mixer = Mixer(4, dynamics=False)
+    slot_a = mixer.add_source()
+    slot_b = mixer.add_source()
+    slot_c = mixer.add_source()
+
+    mixer.get_frame(slot_a)[:] = 0.1
+    mixer.get_frame(slot_b)[:] = 0.2
+    mixer.clear_frame(slot_c)
+
+    combined, mix_minus = mixer.mix()
+
+    assert numpy.allclose(combined, 0.3)
+    assert numpy.allclose(mix_minus[slot_a], 0.2)
+    assert numpy.allclose(mix_minus[slot_b], 0.1)
+    assert numpy.allclose(mix_minus[slot_c], 0.3)
+
+def test_extra_is_heard_by_everyone():
+    mixer = Mixer(4, dynamics=False)
+    slot_a = mixer.add_source()
+    slot_b = mixer.add_source()
+
+    mixer.get_frame(slot_a)[:] = 0.2
+    mixer.clear_frame(slot_b)
+    extra = numpy.full(4, 0.1, dtype=numpy.float32)
+
+    combined, mix_minus = mixer.mix(extra)
+
+    assert numpy.allclose(combined, 0.3)
+    assert numpy.allclose(mix_minus[slot_a], 0.1)
+    assert numpy.allclose(mix_minus[slot_b], 0.3)
+
+def test_slots_are_reused_and_matrix_grows():
+    mixer = Mixer(4, capacity=2)
+    slots = [mixer.add_source() for _ in range(3)]
+    assert slots == [0, 1, 2]
+    assert mixer.rows == 3
+
+    mixer.remove_source(1)
+    assert mixer.add_source() == 1
+
+    mixer.remove_source(2)
+    assert mixer.rows == 2
+
+def test_has_signal():
+    mixer = Mixer(4)
+    slot = mixer.add_source()
+    assert not mixer.has_signal(slot)
+
+    mixer.get_frame(slot)[:] = 0.1
+    assert mixer.has_signal(slot)
+
+    mixer.clear_frame(slot)
+    assert not mixer.has_signal(slot)
+
+def test_many_loud_sources_stay_in_range():
+    mixer = Mixer(480)
+    slots = [mixer.add_source() for _ in range(50)]
+
+    for _ in range(10):
+        for slot in slots:
+            mixer.get_frame(slot)[:] = 0.9
+        combined, mix_minus = mixer.mix()
+        assert numpy.all(numpy.abs(combined) <= 1)
+        assert numpy.all(numpy.abs(mix_minus[:len(slots)]) <= 1)
+
+def test_monitor_mixes_and_groups():
+    mixer = Mixer(4, dynamics=False)
+    slot_a = mixer.add_source()
+    slot_b = mixer.add_source()
+    slot_c = mixer.add_source()
+    slot_d = mixer.add_source()
+
+    mixer.get_frame(slot_a)[:] = 0.1
+    mixer.get_frame(slot_b)[:] = 0.2
+    mixer.clear_frame(slot_c)
+    mixer.clear_frame(slot_d)
+
+    # c and d both want more of a and less of the playback
+    for slot in [slot_c, slot_d]:
+        mixer.set_gains(slot, {slot_a: 2}, extra_gain=0.5)
+    assert mixer.has_custom_gains
+    extra = numpy.full(4, 0.1, dtype=numpy.float32)
+
+    combined, mixes = mixer.mix(extra)
+
+    assert numpy.allclose(combined, 0.4)
+    assert numpy.allclose(mixes[slot_a], 0.3)
+    assert numpy.allclose(mixes[slot_b], 0.2)
+    assert numpy.allclose(mixes[slot_c], 0.45)
+    groups = mixer.mix_groups
+    assert groups[slot_c] == groups[slot_d] != -1
+    assert len(set(groups)) == 3
+
+    mixer.reset_gains(slot_c)
+    mixer.reset_gains(slot_d)
+    assert not mixer.has_custom_gains
+    combined, mixes = mixer.mix(extra)
+    assert numpy.allclose(mixes[slot_c], 0.4)
+    assert list(mixer.mix_groups) == [slot_a, slot_b, -1, -1]
@@ -0,0 +1,92 @@
+import math
+
+import numpy
+import pyogg
+import pytest
+
+from singtserver.opus_codec import FloatOpusDecoder
+from singtserver.opus_codec import FloatOpusEncoder
+from singtserver.opus_codec import is_dtx_packet
+
+# These tests need libopus, which PyOgg loads if it can find it
+pytestmark = pytest.mark.skipif(
+    not getattr(pyogg, "PYOGG_OPUS_AVAIL", False),
+    reason="libopus isn't available"
+)
+
+samples_per_second = 48000
+samples_per_frame = 960
+
+def create_codec():
+    encoder = FloatOpusEncoder(samples_per_second, 1, samples_per_frame)
+    decoder = FloatOpusDecoder(samples_per_second, 1, samples_per_frame)
+    return encoder, decoder
+
+def make_tone(frames, amplitude=0.5, frequency=440):
+    t = numpy.arange(frames * samples_per_frame) / samples_per_second
+    tone = amplitude * numpy.sin(2 * math.pi * frequency * t)
+    return tone.astype(numpy.float32).reshape(frames, samples_per_frame)
+
+def test_round_trip_keeps_the_signal():
+    encoder, decoder = create_codec()
+    tone = make_tone(50)
+    decoded = numpy.concatenate([
+        decoder.decode(encoder.encode(frame)).copy()
+        for frame in tone
+    ])
+    original = tone.reshape(-1)
+
+    # Opus delays the signal by a few milliseconds; find the delay
+    # from the correlation, ignoring the first frames while the codec
+    # settles
+    start = 10 * samples_per_frame
+    length = 20 * samples_per_frame
+    lags = range(0, samples_per_frame)
+    correlations = [
+        numpy.dot(original[start:start+length],
+                  decoded[start+lag:start+lag+length])
+        for lag in lags
+    ]
+    lag = int(numpy.argmax(correlations))
+    a = original[start:start+length]
+    b = decoded[start+lag:start+lag+length]
+    correlation = numpy.dot(a, b) / numpy.sqrt(numpy.dot(a, a) * numpy.dot(b, b))
+    assert correlation > 0.95
+
+    rms = lambda x: numpy.sqrt(numpy.mean(x**2))
+    assert rms(b) == pytest.approx(rms(a), rel=0.1)
+
+def test_out_of_range_input_is_clipped():
+    encoder, decoder = create_codec()
+    frame = make_tone(1, amplitude=3)[0]
+    original = frame.copy()
+    packet = encoder.encode(frame)
+    assert len(packet) > 0
+
+    # The frame is clipped into the encoder's staging buffer, leaving
+    # the caller's frame alone
+    assert numpy.max(numpy.abs(encoder._pcm)) <= 1
+    assert numpy.array_equal(frame, original)
+
+    # Clipped input decodes to (roughly) full scale, rather than
+    # wrapping around
+    for frame in make_tone(10, amplitude=3):
+        pcm = decoder.decode(encoder.encode(frame))
+    assert numpy.max(numpy.abs(pcm)) <= 1.2
+    assert numpy.max(numpy.abs(pcm)) > 0.5
+
+def test_decoder_returns_its_reusable_buffer():
+    encoder, decoder = create_codec()
+    packets = [encoder.encode(frame) for frame in make_tone(3)]
+    assert decoder.decode(packets[0]) is decoder.pcm
+    assert decoder.decode_missing_packet() is decoder.pcm
+    assert decoder.decode_fec(packets[2]) is decoder.pcm
+    assert decoder.pcm.dtype == numpy.float32
+    assert len(decoder.pcm) == samples_per_frame
+
+def test_silence_is_dtx_when_enabled():
+    encoder, decoder = create_codec()
+    encoder.set_dtx(True)
+    silence = numpy.zeros(samples_per_frame, dtype=numpy.float32)
+    packets = [encoder.encode(silence) for _ in range(50)]
+    assert is_dtx_packet(packets[-1])
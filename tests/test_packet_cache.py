@@ -0,0 +1,86 @@
+from twisted.internet import defer
+
+from singtserver.packet_cache import CachedPlayback
+from singtserver.packet_cache import PlaybackPacketCache
+from singtserver.packet_cache import encode_playback
+
+def defer_immediately(function, *args):
+    return defer.succeed(function(*args))
+
+class FakePlayback:
+    def __init__(self, frames):
+        self._frames = list(frames)
+        self.refills = 0
+
+    def read_frame(self):
+        if len(self._frames) == 0:
+            return None
+        return self._frames.pop(0)
+
+    def refill(self):
+        self.refills += 1
+
+class FakeEncoder:
+    def encode(self, frame):
+        return bytes([frame])
+
+def test_encode_playback():
+    playback = FakePlayback([1, 2, 3])
+    packets = encode_playback(playback, FakeEncoder())
+    assert packets == [b"\x01", b"\x02", b"\x03"]
+    assert playback.refills == 3
+
+def test_build_and_get():
+    cache = PlaybackPacketCache(
+        lambda name: [name.encode()],
+        defer_to_thread=defer_immediately
+    )
+    assert cache.get("a") is None
+
+    results = []
+    cache.build("a", "track").addCallback(results.append)
+    assert results == [[b"track"]]
+    assert cache.get("a") == [b"track"]
+
+def test_least_recently_used_is_evicted():
+    cache = PlaybackPacketCache(
+        lambda name: [name],
+        max_entries=2,
+        defer_to_thread=defer_immediately
+    )
+    cache.build("a", "a")
+    cache.build("b", "b")
+    cache.get("a")
+    cache.build("c", "c")
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == ["a"]
+    assert cache.get("c") == ["c"]
+
+def test_concurrent_builds_are_shared():
+    pending = defer.Deferred()
+    calls = []
+    def defer_later(function, *args):
+        calls.append(args)
+        return pending
+
+    cache = PlaybackPacketCache(lambda: None, defer_to_thread=defer_later)
+    d1 = cache.build("a")
+    d2 = cache.build("a")
+    assert d1 is d2
+    assert len(calls) == 1
+
+    pending.callback([b"x"])
+    assert cache.get("a") == [b"x"]
+
+def test_cached_playback():
+    class FakeDecoder:
+        def decode(self, packet):
+            return packet * 2
+
+    playback = CachedPlayback([b"a", b"b"], FakeDecoder())
+    assert playback.decode(playback.read_packet()) == b"aa"
+    assert playback.read_packet() == b"b"
+    assert playback.finished
+    assert playback.read_packet() is None
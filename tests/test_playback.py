@@ -0,0 +1,108 @@
+import numpy
+
+from singtserver.playback import PlaybackMixer
+from singtserver.playback import PlaybackStream
+
+class FakeOpusFileStream:
+    """Returns stereo int16 buffers of a ramp, like OpusFileStream."""
+    def __init__(self, total_samples, buffer_size):
+        self._samples = numpy.arange(total_samples, dtype=numpy.int16)
+        self._buffer_size = buffer_size
+        self._position = 0
+
+    def get_buffer_as_array(self):
+        if self._position >= len(self._samples):
+            return None
+        mono = self._samples[self._position:self._position+self._buffer_size]
+        self._position += len(mono)
+        return numpy.stack([mono, mono], axis=1)
+
+def test_frames_are_read_in_order():
+    stream = FakeOpusFileStream(100, buffer_size=7)
+    playback_stream = PlaybackStream(stream, 10, frames_to_buffer=3)
+
+    samples = []
+    while True:
+        frame = playback_stream.read_frame()
+        if frame is None:
+            break
+        assert len(frame) == 10
+        samples.append(frame.copy())
+        playback_stream.refill()
+
+    samples = numpy.concatenate(samples) * 2**15
+    assert numpy.allclose(samples, numpy.arange(100))
+    assert playback_stream.finished
+
+def test_final_frame_is_padded():
+    stream = FakeOpusFileStream(25, buffer_size=25)
+    playback_stream = PlaybackStream(stream, 10, frames_to_buffer=4)
+
+    frames = [playback_stream.read_frame() for _ in range(3)]
+    assert playback_stream.read_frame() is None
+    assert numpy.all(frames[2][5:] == 0)
+
+def test_gain_is_applied():
+    stream = FakeOpusFileStream(10, buffer_size=10)
+    playback_stream = PlaybackStream(stream, 10, gain=0.5)
+
+    frame = playback_stream.read_frame()
+    assert numpy.allclose(frame * 2**15, numpy.arange(10) * 0.5)
+
+def test_streams_are_mixed_with_gains():
+    streams = [
+        PlaybackStream(FakeOpusFileStream(20, buffer_size=10), 10),
+        PlaybackStream(FakeOpusFileStream(10, buffer_size=10), 10),
+    ]
+    playback_mixer = PlaybackMixer(streams, 10, gains=[1.0, 0.5])
+
+    frame = playback_mixer.read_frame()
+    assert numpy.allclose(frame * 2**15, numpy.arange(10) * 1.5)
+
+    # The second stream has finished, so only the first is heard
+    frame = playback_mixer.read_frame()
+    assert numpy.allclose(frame * 2**15, numpy.arange(10, 20))
+
+    assert playback_mixer.read_frame() is None
+    assert playback_mixer.finished
+
+def test_decimation():
+    # Buffers that aren't a whole number of groups are carried over
+    stream = FakeOpusFileStream(60, buffer_size=7)
+    playback_stream = PlaybackStream(stream, 10, decimation=3)
+
+    samples = []
+    for _ in range(2):
+        samples.append(playback_stream.read_frame().copy())
+    samples = numpy.concatenate(samples) * 2**15
+    assert numpy.allclose(samples, numpy.arange(60).reshape(-1, 3).mean(axis=1))
+
+class CountingStream(FakeOpusFileStream):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.reads = 0
+
+    def get_buffer_as_array(self):
+        self.reads += 1
+        return super().get_buffer_as_array()
+
+def test_refilling_is_spread_across_ticks():
+    # Many streams, started together and read in lockstep
+    sources = [CountingStream(960 * 500, 960) for _ in range(20)]
+    mixer = PlaybackMixer(
+        [PlaybackStream(source, 960) for source in sources],
+        960,
+        frames_per_refill=2
+    )
+
+    def total_reads():
+        return sum(source.reads for source in sources)
+
+    for _ in range(400):
+        reads = total_reads()
+        assert mixer.read_frame() is not None
+        # No stream runs dry and has to be read while playing...
+        assert total_reads() == reads
+        mixer.refill()
+        # ...and no tick reads more than two frames from each stream
+        assert total_reads() - reads <= 2 * len(sources)
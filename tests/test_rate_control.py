@@ -0,0 +1,32 @@
+from singtserver.rate_control import BitrateController
+from singtserver.rate_control import ComplexityController
+
+def test_bitrate_backs_off_under_loss_and_recovers():
+    controller = BitrateController(
+        min_bitrate=16000,
+        max_bitrate=96000,
+        initial_bitrate=64000,
+        step=8000
+    )
+    assert controller.update(0.1, 0) == 48000
+    assert controller.update(0.02, 0.05) == 36000
+    # Moderate loss holds the bitrate
+    assert controller.update(0.03, 0) == 36000
+    assert controller.update(0, 0) == 44000
+
+    for _ in range(20):
+        controller.update(0, 0)
+    assert controller.bitrate == 96000
+    for _ in range(20):
+        controller.update(0.5, 0)
+    assert controller.bitrate == 16000
+
+def test_complexity_follows_headroom():
+    controller = ComplexityController(min_complexity=2, max_complexity=10)
+    assert controller.complexity == 10
+    assert controller.update(0.1) == 9
+    assert controller.update(0.3) == 9
+    for _ in range(20):
+        controller.update(0)
+    assert controller.complexity == 2
+    assert controller.update(0.9) == 3
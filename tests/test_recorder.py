@@ -0,0 +1,127 @@
+import threading
+
+import numpy
+import pytest_twisted
+
+from singtserver.recorder import Recorder
+
+class FakeWriter:
+    def __init__(self, filename, writers, block=None):
+        self.filename = filename
+        self.encoded = []
+        self.closed = False
+        self._block = block
+        writers.append(self)
+
+    def encode(self, pcm_bytes):
+        if self._block is not None:
+            self._block.wait()
+        self.encoded.append(numpy.frombuffer(pcm_bytes, dtype=numpy.int16))
+
+    def close(self):
+        self.closed = True
+
+@pytest_twisted.inlineCallbacks
+def test_frames_are_written_per_source():
+    writers = []
+    recorder = Recorder(
+        lambda source: f"{source}.opus",
+        48000,
+        1,
+        create_writer=lambda filename, *args: FakeWriter(filename, writers)
+    )
+
+    frame = numpy.full(4, 0.5, dtype=numpy.float32)
+    recorder.record("mix", frame)
+    frame[:] = 2  # The recorder must have taken a copy
+    recorder.record("mix", frame)
+    recorder.record(42, frame)
+
+    filenames = yield recorder.stop()
+    assert filenames == {"mix": "mix.opus", 42: "42.opus"}
+
+    mix_writer, participant_writer = writers
+    assert len(mix_writer.encoded) == 2
+    assert mix_writer.encoded[0][0] == (2**15-1) // 2
+    assert mix_writer.encoded[1][0] == 2**15-1  # Clipped
+    assert len(participant_writer.encoded) == 1
+    assert mix_writer.closed and participant_writer.closed
+
+@pytest_twisted.inlineCallbacks
+def test_frames_are_dropped_rather_than_blocking():
+    writers = []
+    block = threading.Event()
+    recorder = Recorder(
+        lambda source: "mix.opus",
+        48000,
+        1,
+        queue_size=2,
+        create_writer=lambda filename, *args: FakeWriter(filename, writers,
+                                                          block)
+    )
+
+    frame = numpy.zeros(4, dtype=numpy.float32)
+    for _ in range(10):
+        recorder.record("mix", frame)
+    assert recorder.frames_dropped > 0
+
+    block.set()
+    yield recorder.stop()
+    assert len(writers[0].encoded) == 10 - recorder.frames_dropped
+
+@pytest_twisted.inlineCallbacks
+def test_sources_are_padded_to_line_up():
+    writers = []
+    recorder = Recorder(
+        lambda source: f"{source}.opus",
+        48000,
+        1,
+        create_writer=lambda filename, *args: FakeWriter(filename, writers)
+    )
+
+    frame = numpy.full(4, 0.5, dtype=numpy.float32)
+    recorder.record("mix", frame)
+    recorder.next_frame()
+    recorder.record("mix", frame)
+    recorder.record(42, frame)
+    recorder.next_frame()
+    recorder.next_frame()
+    recorder.record("mix", frame)
+    recorder.record(42, frame)
+
+    yield recorder.stop()
+    mix_writer, participant_writer = writers
+
+    # The participant's file starts with silence, as does the frame
+    # that everyone missed
+    assert [encoded[0] for encoded in mix_writer.encoded] == [
+        16383, 16383, 0, 16383
+    ]
+    assert [encoded[0] for encoded in participant_writer.encoded] == [
+        0, 16383, 0, 16383
+    ]
+
+@pytest_twisted.inlineCallbacks
+def test_stopping_doesnt_block():
+    writers = []
+    block = threading.Event()
+    recorder = Recorder(
+        lambda source: "mix.opus",
+        48000,
+        1,
+        queue_size=2,
+        create_writer=lambda filename, *args: FakeWriter(filename, writers,
+                                                          block)
+    )
+
+    frame = numpy.zeros(4, dtype=numpy.float32)
+    for _ in range(10):
+        recorder.record("mix", frame)
+
+    # The queue is full, but stopping returns straight away
+    d = recorder.stop()
+    assert not d.called
+
+    block.set()
+    yield d
+    assert len(writers[0].encoded) == 10 - recorder.frames_dropped
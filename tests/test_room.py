@@ -0,0 +1,299 @@
+import numpy
+from twisted.internet import task
+
+from singtserver import room as room_module
+from singtserver.audio_format import AudioFormat
+from singtserver.codec_workers import CodecWorkerPool
+from singtserver.forwarding import unpack_bundle
+from singtserver.jitter_buffer import AdaptiveJitterBuffer
+from singtserver.rate_control import BitrateController
+from singtserver.room import Room
+
+class FakeUDPServer:
+    def __init__(self):
+        self.codec_workers = CodecWorkerPool(1)
+        self.packet_cache = None
+
+    def create_encoder(self, audio_format):
+        return None
+
+    def create_decoder(self, audio_format):
+        return None
+
+class FakePacketizer:
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+def make_connection(client_id):
+    return {
+        "client_id": client_id,
+        "udp_packetizer": FakePacketizer(),
+        "jitter_buffer": AdaptiveJitterBuffer(0.02, min_depth=1,
+                                              initial_depth=1),
+        "opus_decoder": None,
+        "opus_encoder": None,
+        "started": False,
+        "missing_packets": 0,
+        "dtx": False,
+        "bitrate_controller": BitrateController()
+    }
+
+def make_room(monkeypatch, **settings):
+    monkeypatch.setattr(room_module, "reactor", task.Clock())
+    return Room("test", FakeUDPServer(), AudioFormat(), **settings)
+
+def test_connections_are_given_mixer_rows(monkeypatch):
+    room = make_room(monkeypatch)
+    assert room.is_idle()
+
+    a = make_connection(1)
+    b = make_connection(2)
+    room.add_connection(a)
+    room.add_connection(b)
+    assert a["mixer_slot"] != b["mixer_slot"]
+    assert a["room"] is room
+    assert not room.is_idle()
+
+    room.remove_connection(1)
+    room.remove_connection(2)
+    assert a["room"] is None
+    assert room.is_idle()
+    assert room.get_statistics()["connections"] == 0
+
+def test_forwarding_excludes_own_packet(monkeypatch):
+    room = make_room(monkeypatch, mode="forward", forward_speakers=2)
+    singer = make_connection(1)
+    listener = make_connection(2)
+    room.add_connection(singer)
+    room.add_connection(listener)
+
+    singer["jitter_buffer"].put_packet(0, b"singing")
+    room.process_audio_frame()
+
+    assert singer["udp_packetizer"].written == []
+    assert unpack_bundle(listener["udp_packetizer"].written[0]) == [
+        (1, b"singing")
+    ]
+
+def test_unknown_mode_fails(monkeypatch):
+    try:
+        make_room(monkeypatch, mode="unknown")
+    except Exception:
+        return
+    assert False
+
+class FakeEncoder:
+    def __init__(self, name="encoder"):
+        self.name = name
+        self.bitrate = None
+        self.complexity = None
+        self.resets = 0
+
+    def encode(self, pcm):
+        return self.name.encode()
+
+    def reset_state(self):
+        self.resets += 1
+
+    def set_bitrate(self, bitrate):
+        self.bitrate = bitrate
+
+    def set_complexity(self, complexity):
+        self.complexity = complexity
+
+class FakeJitterBuffer:
+    def __init__(self, loss_rate):
+        self.loss_rate = loss_rate
+        self.late_rate = 0
+
+def test_rates_follow_each_connections_loss(monkeypatch):
+    room = make_room(monkeypatch)
+    room._shared_encoder = FakeEncoder()
+    clear = make_connection(1)
+    lossy = make_connection(2)
+    for connection in [clear, lossy]:
+        connection["opus_encoder"] = FakeEncoder()
+        room.add_connection(connection)
+    lossy["jitter_buffer"] = FakeJitterBuffer(loss_rate=0.2)
+
+    room.control_rates(5)
+
+    assert clear["opus_encoder"].bitrate > 64000
+    assert lossy["opus_encoder"].bitrate < 64000
+    assert room._shared_encoder.bitrate == lossy["opus_encoder"].bitrate
+    assert clear["opus_encoder"].complexity == 5
+
+def test_monitor_gains_are_set_by_client_id(monkeypatch):
+    room = make_room(monkeypatch)
+    listener = make_connection(1)
+    singer = make_connection(2)
+    room.add_connection(listener)
+    room.add_connection(singer)
+
+    room.set_monitor_gains(1, {"2": 0.5, "playback": 0.25})
+    assert room._mixer.has_custom_gains
+
+    try:
+        room.set_monitor_gains(1, {"3": 1})
+    except Exception as e:
+        assert "not in room" in str(e)
+    else:
+        raise AssertionError("Expected an exception")
+
+    room.set_monitor_gains(1)
+    assert not room._mixer.has_custom_gains
+
+class FakeDecoder:
+    def __init__(self):
+        self.pcm = numpy.full(960, 0.1, dtype=numpy.float32)
+        self.calls = []
+
+    def decode(self, packet):
+        self.calls.append(("decode", packet))
+        return self.pcm
+
+    def decode_missing_packet(self):
+        self.calls.append(("conceal", None))
+        return self.pcm
+
+    def decode_fec(self, next_packet):
+        self.calls.append(("fec", next_packet))
+        return self.pcm
+
+def test_listeners_keep_their_encoder_between_phrases(monkeypatch):
+    room = make_room(monkeypatch, encoder_hold=3)
+    room._shared_encoder = FakeEncoder("shared")
+    singer = make_connection(1)
+    listener = make_connection(2)
+    for connection in [singer, listener]:
+        client_id = connection["client_id"]
+        connection["opus_encoder"] = FakeEncoder(f"own {client_id}")
+        connection["opus_decoder"] = FakeDecoder()
+        room.add_connection(connection)
+
+    # The singer sings, pauses briefly (DTX packets are silence), and
+    # sings again
+    phrases = [b"singing"] * 2 + [b"\0"] * 2 + [b"singing"] * 2
+    for seq_no, packet in enumerate(phrases):
+        singer["jitter_buffer"].put_packet(seq_no, packet)
+        listener["jitter_buffer"].put_packet(seq_no, b"\0")
+        room.process_audio_frame()
+
+    # Their packets kept coming from their own encoder, which wasn't
+    # reset, while the listener's all came from the shared one
+    assert singer["udp_packetizer"].written == [b"own 1"] * 6
+    assert singer["opus_encoder"].resets == 1
+    assert listener["udp_packetizer"].written == [b"shared"] * 6
+
+    # After a longer pause they move to the shared encoder, and their
+    # own is reset when they sing again
+    phrases = [b"\0"] * 4 + [b"singing"]
+    for seq_no, packet in enumerate(phrases, start=6):
+        singer["jitter_buffer"].put_packet(seq_no, packet)
+        listener["jitter_buffer"].put_packet(seq_no, b"\0")
+        room.process_audio_frame()
+    assert singer["udp_packetizer"].written[6:] == (
+        [b"own 1"] * 3 + [b"shared", b"own 1"]
+    )
+    assert singer["opus_encoder"].resets == 2
+
+def make_singer(room):
+    singer = make_connection(1)
+    singer["opus_decoder"] = FakeDecoder()
+    room.add_connection(singer)
+    return singer
+
+def test_lost_packet_is_recovered_from_fec(monkeypatch):
+    room = make_room(monkeypatch)
+    room._shared_encoder = FakeEncoder("shared")
+    singer = make_singer(room)
+    singer["opus_encoder"] = FakeEncoder("own")
+
+    singer["jitter_buffer"].put_packet(0, b"packet 0")
+    room.process_audio_frame()
+    singer["jitter_buffer"].put_packet(2, b"packet 2")
+    room.process_audio_frame()
+    room.process_audio_frame()
+
+    assert singer["opus_decoder"].calls == [
+        ("decode", b"packet 0"),
+        ("fec", b"packet 2"),
+        ("decode", b"packet 2")
+    ]
+
+def test_lost_packets_are_concealed_up_to_the_limit(monkeypatch):
+    room = make_room(monkeypatch, concealment_limit=2)
+    room._shared_encoder = FakeEncoder("shared")
+    singer = make_singer(room)
+    singer["opus_encoder"] = FakeEncoder("own")
+
+    singer["jitter_buffer"].put_packet(0, b"packet 0")
+    for _ in range(5):
+        room.process_audio_frame()
+
+    # Beyond the limit, the singer is taken to be silent
+    assert singer["opus_decoder"].calls == [
+        ("decode", b"packet 0"),
+        ("conceal", None),
+        ("conceal", None)
+    ]
+    assert not room._mixer.has_signal(singer["mixer_slot"])
+
+def test_dtx_is_silence_rather_than_loss(monkeypatch):
+    room = make_room(monkeypatch)
+    room._shared_encoder = FakeEncoder("\0")
+    singer = make_singer(room)
+    singer["opus_encoder"] = FakeEncoder("\0")
+    listener = make_connection(2)
+    room.add_connection(listener)
+
+    singer["jitter_buffer"].put_packet(0, b"packet 0")
+    singer["jitter_buffer"].put_packet(1, b"\0")
+    for _ in range(10):
+        room.process_audio_frame()
+
+    # The DTX packet and the gap after it aren't decoded or
+    # concealed, and aren't counted as lost
+    assert singer["opus_decoder"].calls == [("decode", b"packet 0")]
+    statistics = singer["jitter_buffer"].get_statistics()
+    assert statistics["lost"] == 0
+    assert statistics["underruns"] == 0
+
+    # Nor are the DTX packets encoded for the listeners sent
+    assert singer["udp_packetizer"].written == []
+    assert listener["udp_packetizer"].written == []
+
+class FakeRecorder:
+    def __init__(self, get_filename, samples_per_second, channels):
+        self.frames = []
+
+    def record(self, source, pcm):
+        self.frames.append((source, pcm.copy()))
+
+    def next_frame(self):
+        self.frames.append("next")
+
+def test_participants_are_recorded_before_levelling(monkeypatch):
+    monkeypatch.setattr(room_module, "Recorder", FakeRecorder)
+    room = make_room(monkeypatch)
+    room._shared_encoder = FakeEncoder("shared")
+    singer = make_singer(room)
+    singer["opus_encoder"] = FakeEncoder("own")
+
+    # Halve every source as it's levelled
+    def process_sources(frames, has_signal):
+        frames *= 0.5
+    room._mixer._dynamics.process_sources = process_sources
+
+    room.start_recording("mix.opus", "{client_id}.opus")
+    singer["jitter_buffer"].put_packet(0, b"packet 0")
+    room.process_audio_frame()
+
+    (source, pcm), (mix_source, _), next_frame = room._recorder.frames
+    assert source == 1
+    assert numpy.allclose(pcm, 0.1)
+    assert mix_source == "mix"
+    assert next_frame == "next"
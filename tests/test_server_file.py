@@ -0,0 +1,61 @@
+import json
+from pathlib import Path
+
+from singtserver import SessionFiles
+from singtserver.server_file import FileTransportServer
+
+
+class FakeTakeTracker:
+    def __init__(self, tracked):
+        self._tracked = tracked
+        self.calls = []
+    def is_tracked(self, audio_id):
+        return audio_id in self._tracked
+    def upload_started(self, audio_id):
+        self.calls.append(("started", audio_id))
+    def upload_progress(self, audio_id, byte_count):
+        self.calls.append(("progress", audio_id, byte_count))
+    def upload_finished(self, audio_id):
+        self.calls.append(("finished", audio_id))
+    def upload_failed(self, audio_id, reason):
+        self.calls.append(("failed", audio_id, reason))
+
+class FakeTransport:
+    def loseConnection(self):
+        pass
+
+def upload(test_name, tracker, audio_id, packets):
+    context = {
+        "session_files": SessionFiles(Path.cwd() / ("test_server_file__"+test_name)),
+        "take_tracker": tracker
+    }
+    server = FileTransportServer(context)
+    server.transport = FakeTransport()
+    command = {"command": "receive_file", "audio_id": audio_id}
+    server._process_command(json.dumps(command).encode("utf-8"))
+    for packet in packets:
+        server._process_data(packet)
+    return server
+
+def test_tracked_upload_is_reported():
+    tracker = FakeTakeTracker(tracked=[7])
+    upload("test_tracked_upload_is_reported", tracker, 7,
+           [b"DATAabc", b"DATAde", b"END"])
+    assert tracker.calls == [
+        ("started", 7),
+        ("progress", 7, 3),
+        ("progress", 7, 2),
+        ("finished", 7),
+    ]
+
+def test_untracked_upload_is_not_reported():
+    tracker = FakeTakeTracker(tracked=[])
+    upload("test_untracked_upload_is_not_reported", tracker, 8,
+           [b"DATAabc", b"END"])
+    assert tracker.calls == []
+
+def test_lost_upload_fails():
+    tracker = FakeTakeTracker(tracked=[9])
+    server = upload("test_lost_upload_fails", tracker, 9, [b"DATAabc"])
+    server.connectionLost("test")
+    assert tracker.calls[-1] == ("failed", 9, "Connection lost during upload")
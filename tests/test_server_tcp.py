@@ -0,0 +1,166 @@
+from twisted.internet import defer
+
+from helpers import FakeEventSource
+from singtserver import TCPServerFactory
+from singtserver.take_tracker import TakeTracker
+
+
+class FakeWebServer:
+    def __init__(self):
+        self.eventsource_resource = FakeEventSource()
+        self.backing_track_resource = self
+    def initialise_eventsource(self):
+        pass
+
+class FakeDatabase:
+    def assign_participant(self, client_id, name):
+        return defer.succeed(client_id)
+
+class FakeUDPServer:
+    def __init__(self):
+        self.removed = []
+    def remove_client(self, client_id):
+        self.removed.append(client_id)
+
+class FakeProtocol:
+    def __init__(self):
+        self.requests = []
+        self.cached_audio = {}
+    def has_cached(self, audio_id, content_hash):
+        return (content_hash is not None
+                and self.cached_audio.get(audio_id) == content_hash)
+    def send_download_request(self, audio_id, partial_url, content_hash=None):
+        self.requests.append(audio_id)
+
+def create_factory():
+    context = {
+        "web_server": FakeWebServer(),
+        "database": FakeDatabase(),
+        "udp_server": FakeUDPServer(),
+    }
+    context["take_tracker"] = TakeTracker(
+        context["database"],
+        context["web_server"].eventsource_resource
+    )
+    return TCPServerFactory(context)
+
+def connect(factory, client_id):
+    # Makes a connection as far as the client's announcement
+    protocol = factory.buildProtocol(None)
+    protocol.transport = None
+    protocol.connectionMade()
+    protocol.username = f"user {client_id}"
+    protocol.client_id = client_id
+    protocol._shared_context.register_protocol(protocol)
+    return protocol
+
+def test_register_and_lose_connection():
+    factory = create_factory()
+    shared_context = factory._shared_context
+    protocol = connect(factory, 1)
+    assert factory.get_protocol(1) is protocol
+    assert protocol in shared_context.connected_protocols
+
+    protocol.connectionLost("test")
+    assert factory.get_protocol(1) is None
+    assert len(shared_context.connected_protocols) == 0
+    assert shared_context.udp_server.removed == [1]
+
+def test_unannounced_connection_is_pruned():
+    factory = create_factory()
+    shared_context = factory._shared_context
+    protocol = factory.buildProtocol(None)
+    protocol.transport = None
+    protocol.connectionMade()
+    protocol.connectionLost("test")
+    assert len(shared_context.connected_protocols) == 0
+
+def test_reconnect_replaces_old_connection():
+    factory = create_factory()
+    shared_context = factory._shared_context
+    old_protocol = connect(factory, 1)
+    new_protocol = connect(factory, 1)
+    assert factory.get_protocol(1) is new_protocol
+
+    # Losing the old connection leaves the new one registered, and
+    # the client in their room
+    old_protocol.connectionLost("test")
+    assert factory.get_protocol(1) is new_protocol
+    assert shared_context.connected_protocols == {new_protocol}
+    assert shared_context.udp_server.removed == []
+
+def test_broadcast_looks_up_participants():
+    factory = create_factory()
+    protocols = {
+        client_id: FakeProtocol()
+        for client_id in [1, 2, 3]
+    }
+    factory._shared_context.protocols_by_client_id.update(protocols)
+
+    # Client 4 isn't connected, so is skipped
+    d = factory.broadcast_download_request(10, "url", [1, 3, 4])
+    assert protocols[1].requests == [10]
+    assert protocols[2].requests == []
+    assert protocols[3].requests == [10]
+
+    # ...and fails straight away, while the others are awaited
+    download_coordinator = factory._shared_context.download_coordinator
+    assert download_coordinator.is_pending(1, 10)
+    download_coordinator.complete(1, 10)
+    download_coordinator.complete(3, 10)
+    results = []
+    d.addCallback(results.append)
+    assert results == [{"ready": [1, 3], "failed": {4: "Not connected"}}]
+
+def test_lost_connection_fails_downloads():
+    factory = create_factory()
+    protocol = connect(factory, 1)
+    protocol.send_download_request = lambda *args: None
+    d = factory.broadcast_download_request(10, "url", [1])
+    protocol.connectionLost("test")
+    results = []
+    d.addCallback(results.append)
+    assert results == [{"ready": [], "failed": {1: "Connection lost"}}]
+
+def test_cached_audio_is_not_downloaded_again():
+    factory = create_factory()
+    protocol = connect(factory, 1)
+    requests = []
+    protocol.send_download_request = lambda *args: requests.append(args)
+    protocol._set_cached_audio({"10": "abc"})
+
+    # Audio with a matching hash is skipped
+    d = factory.broadcast_download_request(10, "url", [1], "abc")
+    results = []
+    d.addCallback(results.append)
+    assert results == [{"ready": [1], "failed": {}}]
+    assert requests == []
+
+    # ...but audio that's changed isn't
+    factory.broadcast_download_request(10, "url", [1], "def")
+    assert requests == [(10, "url", "def")]
+
+    # Once it's downloaded, the manifest is updated
+    protocol._requested_hashes[10] = "def"
+    protocol._command_update_downloaded({"audio_id": 10, "result": "success"})
+    assert protocol.has_cached(10, "def")
+
+def test_broadcast_record_request_tracks_take():
+    factory = create_factory()
+    protocol = connect(factory, 1)
+    requests = []
+    protocol.send_record_request = lambda *args: requests.append(args)
+
+    # Client 2 isn't connected, so fails straight away
+    d = factory.broadcast_record_request(5, [20], {1: 100, 2: 101}, [1, 2])
+    assert requests == [([20], 100)]
+    assert not d.called
+
+    take_tracker = factory._context["take_tracker"]
+    take_tracker.upload_failed(100, "Upload aborted by client")
+    results = []
+    d.addCallback(results.append)
+    assert results[0]["failed"] == {
+        1: "Upload aborted by client",
+        2: "Not connected"
+    }
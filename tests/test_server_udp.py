@@ -0,0 +1,181 @@
+import struct
+
+from twisted.internet import task
+
+import json
+
+from singtserver import room as room_module
+from singtserver.media_worker import ControlProtocol
+from singtserver.media_worker import ParticipantsProxy
+from singtserver.media_worker import TCPServerProxy
+from singtserver import server_udp as server_udp_module
+from singtserver.server_udp import UDPServer
+
+class FakeParticipants:
+    def __init__(self):
+        self.joined = []
+        self.left = []
+
+    def join_udp(self, client_id):
+        self.joined.append(client_id)
+
+    def leave(self, client_id):
+        self.left.append(client_id)
+
+class FakePacketizer:
+    # Packets are passed around as (timestamp, seq_no, data) tuples
+    def __init__(self, transport, addr):
+        self.addr = addr
+
+    @staticmethod
+    def decode(packet):
+        return packet
+
+class FakeTCPProtocol:
+    def __init__(self):
+        self.reannounce_requests = 0
+
+    def send_reannounce_request(self):
+        self.reannounce_requests += 1
+
+class FakeTCPServerFactory:
+    def __init__(self):
+        self.protocols = {}
+
+    def get_protocol(self, client_id):
+        return self.protocols.get(client_id)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+def create_server(monkeypatch, context=None):
+    monkeypatch.setattr(room_module, "reactor", task.Clock())
+    monkeypatch.setattr(server_udp_module, "UDPPacketizer", FakePacketizer)
+    monkeypatch.setattr(UDPServer, "create_encoder",
+                        lambda self, audio_format: None)
+    monkeypatch.setattr(UDPServer, "create_decoder",
+                        lambda self, audio_format: None)
+    clock = FakeClock()
+    if context is None:
+        context = {
+            "participants": FakeParticipants(),
+            "tcp_server_factory": FakeTCPServerFactory()
+        }
+    server = UDPServer(context, codec_workers=1, connection_timeout=10,
+                       monotonic=clock.monotonic)
+    server.transport = None
+    return server, context, clock
+
+def announcement(client_id):
+    return (0, -1, struct.pack(">Q", client_id))
+
+def test_silent_connection_without_tcp_is_reaped(monkeypatch):
+    server, context, clock = create_server(monkeypatch)
+    server.datagramReceived(announcement(1), "addr 1")
+    assert context["participants"].joined == [1]
+
+    clock.now = 5
+    server._reap_stale_connections()
+    assert server.has_clients()
+
+    clock.now = 11
+    server._reap_stale_connections()
+    assert not server.has_clients()
+    assert context["participants"].left == [1]
+
+    # The client can announce itself again from the same address
+    server.datagramReceived(announcement(1), "addr 1")
+    assert server.has_clients()
+    assert context["participants"].joined == [1, 1]
+
+def test_silent_connection_with_tcp_is_kept(monkeypatch):
+    server, context, clock = create_server(monkeypatch)
+    tcp_protocol = FakeTCPProtocol()
+    context["tcp_server_factory"].protocols[1] = tcp_protocol
+    server.datagramReceived(announcement(1), "addr 1")
+
+    # The silent client is kept, and asked to announce themselves
+    # again, but not every second
+    clock.now = 11
+    server._reap_stale_connections()
+    clock.now = 12
+    server._reap_stale_connections()
+    assert server.has_clients()
+    assert context["participants"].left == []
+    assert tcp_protocol.reannounce_requests == 1
+
+    # Their announcement from the same address isn't taken as audio
+    server.datagramReceived(announcement(1), "addr 1")
+    connection = server._connections_by_address["addr 1"]
+    assert connection["announced"] == 12
+    assert connection["jitter_buffer"].last_arrival is None
+
+    clock.now = 23
+    server._reap_stale_connections()
+    assert tcp_protocol.reannounce_requests == 2
+
+def test_announcement_from_new_address_rebinds(monkeypatch):
+    server, context, clock = create_server(monkeypatch)
+    server.datagramReceived(announcement(1), "addr 1")
+    connection = server._connections_by_address["addr 1"]
+
+    clock.now = 8
+    server.datagramReceived(announcement(1), "addr 2")
+    assert list(server._connections_by_address) == ["addr 2"]
+    assert server._connections_by_address["addr 2"] is connection
+    assert connection["udp_packetizer"].addr == "addr 2"
+    assert context["participants"].joined == [1]
+
+    # Audio from the new address reaches the connection
+    server.datagramReceived((0, 0, b"audio"), "addr 2")
+    assert connection["jitter_buffer"].last_arrival == 8
+
+    # ...and the rebound connection isn't reaped early
+    clock.now = 15
+    server._reap_stale_connections()
+    assert server.has_clients()
+    assert context["participants"].left == []
+
+def test_media_worker_keeps_silent_connection(monkeypatch):
+    # A media worker's context, as made by media_worker.main()
+    control_protocol = ControlProtocol()
+    events = []
+    control_protocol.send_event = (
+        lambda event, **data: events.append((event, data))
+    )
+    control_protocol.tcp_server = TCPServerProxy(control_protocol)
+    context = {
+        "participants": ParticipantsProxy(control_protocol),
+        "tcp_server_factory": control_protocol.tcp_server
+    }
+    server, context, clock = create_server(monkeypatch, context)
+    control_protocol.udp_server = server
+
+    def command(**json_data):
+        control_protocol.lineReceived(json.dumps(json_data).encode())
+
+    command(command="assign_room", client_id=1, room="default")
+    server.datagramReceived(announcement(1), "addr 1")
+
+    # The control plane is asked to have the silent client announce
+    # themselves again, rather than being told they've left
+    clock.now = 11
+    server._reap_stale_connections()
+    assert server.has_clients()
+    assert events == [
+        ("join_udp", {"client_id": 1}),
+        ("reannounce", {"client_id": 1})
+    ]
+
+    # Once the client has gone from the control plane, they're reaped
+    command(command="assign_room", client_id=2, room="default")
+    command(command="remove_client", client_id=2)
+    server.datagramReceived(announcement(2), "addr 2")
+    clock.now = 30
+    server._reap_stale_connections()
+    assert list(server._connections_by_address) == ["addr 1"]
+    assert events[-1] == ("leave", {"client_id": 2})
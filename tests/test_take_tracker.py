@@ -0,0 +1,113 @@
+from twisted.internet import defer
+from twisted.internet import task
+
+from helpers import FakeEventSource
+from helpers import get_result
+from singtserver.take_tracker import TakeTracker
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.completed = []
+        self.fail = False
+    def mark_recording_complete(self, audio_id):
+        if self.fail:
+            return defer.fail(Exception("Database is locked"))
+        self.completed.append(audio_id)
+        return defer.succeed((1, False))
+
+def create_tracker(**kwargs):
+    clock = task.Clock()
+    eventsource = FakeEventSource()
+    database = FakeDatabase()
+    tracker = TakeTracker(database, eventsource, reactor=clock, **kwargs)
+    return tracker, clock, eventsource, database
+
+def test_take_finishes_when_last_upload_lands():
+    tracker, clock, eventsource, database = create_tracker()
+    d = tracker.track_take(1, {10: 100, 11: 101})
+
+    tracker.upload_started(100)
+    tracker.upload_progress(100, 1000)
+    tracker.upload_finished(100)
+    assert database.completed == [100]
+    assert not d.called
+
+    tracker.upload_started(101)
+    tracker.upload_finished(101)
+    result = get_result(d)
+    assert result == {
+        "take_id": 1,
+        "uploaded": [10, 11],
+        "failed": {},
+        "complete": True
+    }
+    assert eventsource.events[-1] == ("take_finished", {
+        "take_id": 1,
+        "uploaded": ["10", "11"],
+        "failed": {},
+        "complete": True
+    })
+    assert len(clock.getDelayedCalls()) == 0
+
+def test_recording_timeout():
+    tracker, clock, eventsource, database = create_tracker(
+        recording_timeout=100,
+        upload_timeout=10
+    )
+    d = tracker.track_take(1, {10: 100, 11: 101})
+    clock.advance(90)
+    tracker.upload_started(100)
+
+    # Once the upload has started, it has the upload timeout
+    clock.advance(9)
+    tracker.upload_progress(100, 1000)
+    clock.advance(9)
+    tracker.upload_finished(100)
+
+    # Client 11 never uploaded
+    clock.advance(100)
+    result = get_result(d)
+    assert result["uploaded"] == [10]
+    assert "Timed out" in result["failed"][11]
+    assert not result["complete"]
+
+def test_stalled_upload_times_out():
+    tracker, clock, eventsource, database = create_tracker(upload_timeout=10)
+    d = tracker.track_take(1, {10: 100})
+    tracker.upload_started(100)
+    tracker.upload_progress(100, 1000)
+    clock.advance(10)
+    result = get_result(d)
+    assert "without receiving" in result["failed"][10]
+    assert not tracker.is_tracked(100)
+
+def test_failures():
+    tracker, clock, eventsource, database = create_tracker()
+    d = tracker.track_take(1, {10: 100, 11: 101})
+    tracker.upload_failed(100, "Upload aborted by client")
+
+    # The database failing to record the upload fails the recording
+    database.fail = True
+    tracker.upload_finished(101)
+    result = get_result(d)
+    assert result["failed"][10] == "Upload aborted by client"
+    assert "Database is locked" in result["failed"][11]
+
+    # Unknown audio ids are ignored
+    tracker.upload_finished(999)
+    tracker.upload_failed(999, "Whatever")
+
+def test_progress_is_published_in_intervals():
+    tracker, clock, eventsource, database = create_tracker(
+        progress_interval=1000
+    )
+    tracker.track_take(1, {10: 100})
+    tracker.upload_started(100)
+    for _ in range(10):
+        tracker.upload_progress(100, 300)
+    progress = [
+        event["bytes"] for name, event in eventsource.events
+        if name == "take_progress" and event["state"] == "uploading"
+    ]
+    assert progress == [0, 1200, 2100, 3000]